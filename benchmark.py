@@ -0,0 +1,1016 @@
+#!/usr/bin/env python3
+
+"""
+Throughput benchmarks for the DeepSDF pipeline.
+
+Every benchmark is a sub-command, e.g.:
+
+    python benchmark.py decode -e examples/torus --devices cpu cuda
+"""
+
+import argparse
+import json
+import logging
+import numpy as np
+import os
+import time
+import torch
+import trimesh
+import torch.utils.data as data_utils
+
+import deep_sdf
+import deep_sdf.workspace as ws
+from deep_sdf import metrics
+import deep_sdf.isosurface
+import deep_sdf.metrics.sampling
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn, device, repeats=5, warmup=1):
+    """Returns the mean wall time of `fn()` in seconds."""
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.time()
+    for _ in range(repeats):
+        fn()
+    synchronize(device)
+    return (time.time() - start) / repeats
+
+
+def get_devices(devices):
+    if devices:
+        return [deep_sdf.get_device(d) for d in devices]
+    devices = [torch.device("cpu")]
+    if torch.cuda.is_available():
+        devices.append(torch.device("cuda"))
+    return devices
+
+
+def load_benchmark_decoder(experiment_directory, checkpoint, device):
+    """Builds the decoder of an experiment, with trained weights if `checkpoint` is given."""
+    specs = ws.load_experiment_specifications(experiment_directory)
+    if checkpoint is None:
+        decoder = ws.build_decoder(experiment_directory, specs, device)
+    else:
+        decoder, _ = ws.load_decoder(experiment_directory, specs, checkpoint, data_parallel=False, device=device)
+    decoder.eval()
+    return decoder, specs
+
+
+def load_benchmark_latent(experiment_directory, checkpoint, specs, device, index=0):
+    """Returns a trained latent code if `checkpoint` is given and a random one otherwise."""
+    if checkpoint is None:
+        return torch.randn(1, specs["CodeLength"], device=device) / specs["CodeLength"] ** 0.5
+    latent_vectors = ws.load_latent_vectors(experiment_directory, checkpoint, device)
+    return latent_vectors[index].reshape(1, -1).to(device)
+
+
+class QueryCounter(torch.nn.Module):
+    """Wraps a decoder and counts the number of points it is queried with."""
+
+    def __init__(self, decoder):
+        super(QueryCounter, self).__init__()
+        self.decoder = decoder
+        self.num_queries = 0
+
+    def forward(self, input, xyz=None):
+        self.num_queries += input.shape[0] if xyz is None else xyz.numel() // 3
+        return self.decoder(input, xyz)
+
+
+def benchmark_decode(args):
+    """Reports decoder throughput in points/sec for every device."""
+    for device in get_devices(args.devices):
+        decoder, specs = load_benchmark_decoder(args.experiment_directory, args.checkpoint, device)
+        latent = torch.randn(1, specs["CodeLength"], device=device)
+        queries = torch.rand(args.batch_size, 3, device=device) * 2 - 1
+
+        def decode():
+            with torch.no_grad():
+                deep_sdf.decode_sdf(decoder, latent, queries)
+
+        seconds = timeit(decode, device, args.repeats)
+        logging.info(
+            f"[decode] {device}: {args.batch_size / seconds:,.0f} points/sec "
+            f"(batch of {args.batch_size}, {torch.get_num_threads()} CPU threads)"
+        )
+
+
+def benchmark_meshing(args):
+    """Compares query counts, wall time and Chamfer distance of coarse-to-fine and dense meshing."""
+    device = get_devices(args.devices)[0]
+    decoder, specs = load_benchmark_decoder(args.experiment_directory, args.checkpoint, device)
+    latent = load_benchmark_latent(args.experiment_directory, args.checkpoint, specs, device, args.shape_index)
+    decoder = QueryCounter(decoder)
+
+    # Compilation time would go into the first timed configuration (see the compile benchmark).
+    meshes = {}
+    for levels in sorted(set([0] + args.levels)):
+        decoder.num_queries = 0
+        start = time.time()
+        with torch.no_grad():
+            meshes[levels] = deep_sdf.mesh.create_mesh(
+                decoder, latent, N=args.resolution, max_batch=args.max_batch, return_trimesh=True,
+                refinement_levels=levels, use_compile=False,
+            )
+        seconds = time.time() - start
+        if meshes[levels] is None or meshes[0] is None:
+            chamfer = float("nan")
+        else:
+            chamfer, _ = metrics.compute_metric(gt_mesh=meshes[0], gen_mesh=meshes[levels], metric="chamfer")
+        logging.info(
+            f"[meshing] N={args.resolution} levels={levels}: {decoder.num_queries:,} queries "
+            f"({decoder.num_queries / args.resolution ** 3:.1%} of dense), {seconds:.2f} s, "
+            f"Chamfer to dense {chamfer:.3e}"
+        )
+
+
+def benchmark_batched_meshing(args):
+    """Compares shapes/hour of create_mesh in a loop with the batched create_meshes."""
+    device = get_devices(args.devices)[0]
+    decoder, specs = load_benchmark_decoder(args.experiment_directory, args.checkpoint, device)
+    latents = [
+        load_benchmark_latent(args.experiment_directory, args.checkpoint, specs, device, i)
+        for i in range(args.num_shapes)
+    ]
+
+    # Compilation time would go into the first timed configuration (see the compile benchmark).
+    start = time.time()
+    with torch.no_grad():
+        for latent in latents:
+            deep_sdf.mesh.create_mesh(
+                decoder, latent, N=args.resolution, max_batch=args.max_batch, return_trimesh=True, use_compile=False
+            )
+    seconds = time.time() - start
+    logging.info(f"[batched_meshing] create_mesh: {args.num_shapes / seconds * 3600:.0f} shapes/hour")
+
+    for shapes_per_batch in args.shapes_per_batch:
+        start = time.time()
+        with torch.no_grad():
+            deep_sdf.mesh.create_meshes(
+                decoder, latents, N=args.resolution, max_batch=args.max_batch, return_trimesh=True,
+                shapes_per_batch=shapes_per_batch, use_compile=False,
+            )
+        seconds = time.time() - start
+        logging.info(
+            f"[batched_meshing] create_meshes (shapes_per_batch={shapes_per_batch}): "
+            f"{args.num_shapes / seconds * 3600:.0f} shapes/hour"
+        )
+
+
+def benchmark_data(args):
+    """Compares the training batch throughput of the DataLoader and DeviceSDFSampler."""
+    device = get_devices(args.devices)[0]
+    specs = ws.load_experiment_specifications(args.experiment_directory)
+    with open(specs["TrainSplit"], "r") as f:
+        train_split = json.load(f)
+    num_samp_per_scene = specs["SamplesPerScene"]
+    scene_per_batch = specs["ScenesPerBatch"]
+    packed_data_source = specs.get("PackedDataSource", None)
+    if packed_data_source is not None:
+        sdf_dataset = deep_sdf.data.PackedSDFSamples(packed_data_source, train_split, num_samp_per_scene)
+    else:
+        sdf_dataset = deep_sdf.data.SDFSamples(
+            specs["DataSource"], train_split, num_samp_per_scene, load_ram=specs.get("LoadDatasetIntoRAM", False)
+        )
+
+    def run(loader, name):
+        num_batches = 0
+        start = time.time()
+        while num_batches < args.num_batches:
+            for sdf_data, indices, labels, _ in loader:
+                # Like the training loop, which moves the samples to the device.
+                sdf_data = sdf_data.reshape(-1, 4).to(device)
+                labels = labels.to(device)
+                num_batches += 1
+                if num_batches == args.num_batches:
+                    break
+        synchronize(device)
+        seconds = time.time() - start
+        logging.info(
+            f"[data] {name}: {num_batches / seconds:.1f} batches/sec, "
+            f"{num_batches * scene_per_batch * num_samp_per_scene / seconds:,.0f} samples/sec"
+        )
+
+    loader = data_utils.DataLoader(
+        sdf_dataset,
+        batch_size=scene_per_batch,
+        shuffle=True,
+        num_workers=specs.get("DataLoaderThreads", 1),
+        drop_last=True,
+    )
+    run(loader, f"DataLoader ({type(sdf_dataset).__name__}, {loader.num_workers} workers)")
+
+    start = time.time()
+    sampler = deep_sdf.data.DeviceSDFSampler(sdf_dataset, num_samp_per_scene, scene_per_batch, device)
+    logging.info(f"[data] DeviceSDFSampler setup on {device}: {time.time() - start:.2f} s")
+    run(sampler, f"DeviceSDFSampler ({device})")
+
+
+def benchmark_compile(args):
+    """
+    Compares the first-call (startup) and steady-state latency of the eager and the compiled
+    decoder, for inference at several batch sizes and for a latent optimization step.
+    """
+    device = get_devices(args.devices)[0]
+    decoder, specs = load_benchmark_decoder(args.experiment_directory, args.checkpoint, device)
+    latent = load_benchmark_latent(args.experiment_directory, args.checkpoint, specs, device)
+    decoders = {"eager": decoder, "compiled": deep_sdf.utils.compile_decoder(decoder)}
+
+    def infer(decoder, xyz):
+        with torch.no_grad():
+            decoder(latent, xyz)
+
+    def optimize(decoder, xyz):
+        code = latent.detach().clone().requires_grad_(True)
+        decoder(code, xyz).abs().mean().backward()
+
+    for name, decoder in decoders.items():
+        for step, num_points in [(infer, n) for n in args.batch_sizes] + [(optimize, args.reconstruct_samples)]:
+            xyz = torch.rand(1, num_points, 3, device=device) * 2 - 1
+            start = time.time()
+            step(decoder, xyz)
+            synchronize(device)
+            first = time.time() - start
+            seconds = timeit(lambda: step(decoder, xyz), device, args.repeats, warmup=0)
+            logging.info(
+                f"[compile] {name} {step.__name__} {num_points} points: first call {first * 1000:.1f} ms, "
+                f"steady state {seconds * 1000:.2f} ms"
+            )
+
+
+def benchmark_snn(args):
+    """
+    Compares the per-dimension SNN losses with the fused implementation, unchunked and with
+    `chunk_size` dimensions per op, reporting the forward + backward time and the largest
+    difference of the losses and latent gradients. Fails if they are not equal up to float32
+    rounding.
+    """
+    specs = ws.load_experiment_specifications(args.experiment_directory)
+    for device in get_devices(args.devices):
+        for b in args.batch_sizes:
+            x = torch.randn(b, specs["CodeLength"], device=device)
+            labels = torch.randint(0, 2, (b, 1), device=device).float()
+            losses = {
+                "cls": (
+                    deep_sdf.loss.SNNLoss(args.temp),
+                    lambda chunk_size: deep_sdf.loss.FusedSNNLoss(args.temp, chunk_size=chunk_size),
+                    labels,
+                ),
+                "reg": (
+                    deep_sdf.loss.SNNRegLoss(args.temp_reg, args.threshold),
+                    lambda chunk_size: deep_sdf.loss.FusedSNNLoss(args.temp_reg, args.threshold, chunk_size=chunk_size),
+                    torch.rand(b, 1, device=device),
+                ),
+            }
+            for name, (reference, fused, y) in losses.items():
+                results = []
+                for loss_fn in (reference, fused(None), fused(args.chunk_size)):
+                    code = x.clone().requires_grad_(True)
+
+                    def step():
+                        code.grad = None
+                        loss = loss_fn(code, y)
+                        loss.backward()
+                        return loss
+
+                    seconds = timeit(step, device, args.repeats)
+                    results.append((seconds, step().detach(), code.grad.clone()))
+                ref_seconds, ref_loss, ref_grad = results[0]
+                for chunk_size, (fused_seconds, fused_loss, fused_grad) in zip((None, args.chunk_size), results[1:]):
+                    logging.info(
+                        f"[snn] {device} {name} b={b} chunk_size={chunk_size}: {ref_seconds * 1000:.2f} ms -> "
+                        f"{fused_seconds * 1000:.2f} ms ({ref_seconds / fused_seconds:.1f}x), "
+                        f"max |loss diff| {(ref_loss - fused_loss).abs().item():.2e}, "
+                        f"max |grad diff| {(ref_grad - fused_grad).abs().max().item():.2e}"
+                    )
+                    torch.testing.assert_close(fused_loss, ref_loss, msg=lambda m: f"[snn] {name} loss differs: {m}")
+                    torch.testing.assert_close(fused_grad, ref_grad, msg=lambda m: f"[snn] {name} gradient differs: {m}")
+
+
+def benchmark_latent_optimizer(args):
+    """
+    Reports the time of a latent code optimization step (lookup, backward and Adam step) with dense
+    and sparse gradients for growing numbers of shapes. The decoder is left out.
+    """
+    specs = ws.load_experiment_specifications(args.experiment_directory)
+    for device in get_devices(args.devices):
+        for num_shapes in args.num_shapes:
+            seconds = {}
+            for sparse in (False, True):
+                lat_vecs = torch.nn.Embedding(num_shapes, specs["CodeLength"], max_norm=specs.get("CodeBound", None), sparse=sparse)
+                lat_vecs = lat_vecs.to(device)
+                optimizer = deep_sdf.utils.build_training_optimizer(torch.nn.Linear(1, 1), lat_vecs, 1e-3, 1e-3)
+
+                def step():
+                    indices = torch.randint(0, num_shapes, (specs["ScenesPerBatch"],), device=device)
+                    optimizer.zero_grad()
+                    lat_vecs(indices).square().sum().backward()
+                    optimizer.step()
+
+                seconds[sparse] = timeit(step, device, args.repeats)
+            logging.info(
+                f"[latent_optimizer] {device} {num_shapes} shapes: dense {seconds[False] * 1000:.2f} ms, "
+                f"sparse {seconds[True] * 1000:.2f} ms per step"
+            )
+
+
+def ddp_worker(rank, world_size, port, args, results):
+    """Trains the experiment's decoder for a fixed number of iterations as one of `world_size` processes."""
+    os.environ.update(
+        MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port), RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(world_size)
+    )
+    device = get_devices(args.devices)[0]
+    if device.type == "cpu":
+        torch.set_num_threads(args.num_threads or max(1, os.cpu_count() // world_size))
+    device = deep_sdf.init_distributed(device)
+    specs = ws.load_experiment_specifications(args.experiment_directory)
+    with open(specs["TrainSplit"], "r") as f:
+        train_split = json.load(f)
+    num_samp_per_scene = specs["SamplesPerScene"]
+    scene_per_batch = specs["ScenesPerBatch"]
+    clamp_dist = specs["ClampingDistance"]
+    sdf_dataset = deep_sdf.data.SDFSamples(specs["DataSource"], train_split, num_samp_per_scene, load_ram=True)
+    sampler = deep_sdf.data.DeviceSDFSampler(
+        sdf_dataset, num_samp_per_scene, scene_per_batch, device, rank=rank, world_size=world_size
+    )
+
+    torch.manual_seed(0)
+    decoder = ws.build_decoder(args.experiment_directory, specs, device)
+    if deep_sdf.is_distributed():
+        decoder = torch.nn.parallel.DistributedDataParallel(
+            decoder, device_ids=[device] if device.type == "cuda" else None
+        )
+    lat_vecs = torch.nn.Embedding(len(sdf_dataset), specs["CodeLength"], max_norm=specs.get("CodeBound", None))
+    torch.nn.init.normal_(lat_vecs.weight.data, 0.0, 1.0 / specs["CodeLength"] ** 0.5)
+    lat_vecs = lat_vecs.to(device)
+    deep_sdf.broadcast_latent_vectors(lat_vecs)
+    optimizer = torch.optim.Adam(
+        [
+            {"params": decoder.parameters(), "lr": specs["LearningRateSchedule"][0]["Initial"]},
+            {"params": lat_vecs.parameters(), "lr": specs["LearningRateSchedule"][1]["Initial"]},
+        ]
+    )
+
+    def step(sdf_data, indices):
+        indices = indices.to(device)
+        all_indices = deep_sdf.all_gather_cat(indices)
+        deep_sdf.renorm_latent_vectors(lat_vecs, all_indices)
+        xyz = sdf_data[:, :, 0:3]
+        sdf_gt = torch.clamp(sdf_data[:, :, 3].reshape(-1, 1), -clamp_dist, clamp_dist)
+        optimizer.zero_grad()
+        pred_sdf = torch.clamp(decoder(lat_vecs(indices), xyz), -clamp_dist, clamp_dist)
+        torch.nn.functional.l1_loss(pred_sdf, sdf_gt).backward()
+        deep_sdf.sync_latent_gradients(lat_vecs, indices, all_indices)
+        optimizer.step()
+
+    num_iterations = -args.warmup
+    while num_iterations < args.iterations:
+        for sdf_data, indices, _, _ in sampler:
+            if num_iterations == 0:
+                synchronize(device)
+                start = time.time()
+            step(sdf_data, indices)
+            num_iterations += 1
+            if num_iterations == args.iterations:
+                break
+    synchronize(device)
+    seconds = time.time() - start
+    if rank == 0:
+        results.put(seconds)
+    deep_sdf.cleanup_distributed()
+
+
+def benchmark_ddp(args):
+    """
+    Reports the training samples/sec of distributed data-parallel training per number of processes,
+    and the speedup over the first process count. Every process draws batches of
+    ScenesPerBatch shapes from its shard, so the global batch grows with the number of processes.
+    """
+    specs = ws.load_experiment_specifications(args.experiment_directory)
+    samples_per_iteration = specs["ScenesPerBatch"] * specs["SamplesPerScene"]
+    context = torch.multiprocessing.get_context("spawn")
+    logging.info("[ddp] | processes | samples/sec | speedup |")
+    base = None
+    for world_size in args.world_sizes:
+        results = context.SimpleQueue()
+        port = 29500 + world_size
+        torch.multiprocessing.spawn(ddp_worker, args=(world_size, port, args, results), nprocs=world_size)
+        samples_per_sec = world_size * samples_per_iteration * args.iterations / results.get()
+        base = base or samples_per_sec
+        logging.info(f"[ddp] | {world_size} | {samples_per_sec:,.0f} | {samples_per_sec / base:.2f}x |")
+
+
+def benchmark_precision(args):
+    """
+    Trains the experiment's decoder for a fixed number of iterations in every precision and
+    reports training samples/sec and, if the ground truth meshes are available ('TorusPath'),
+    the mean Chamfer distance of the meshes of the first training shapes.
+    """
+    device = get_devices(args.devices)[0]
+    specs = ws.load_experiment_specifications(args.experiment_directory)
+    with open(specs["TrainSplit"], "r") as f:
+        train_split = json.load(f)
+    num_samp_per_scene = specs["SamplesPerScene"]
+    scene_per_batch = specs["ScenesPerBatch"]
+    clamp_dist = specs["ClampingDistance"]
+    sdf_dataset = deep_sdf.data.SDFSamples(specs["DataSource"], train_split, num_samp_per_scene, load_ram=True)
+    sampler = deep_sdf.data.DeviceSDFSampler(sdf_dataset, num_samp_per_scene, scene_per_batch, device)
+    gt_path = specs.get("TorusPath", None)
+
+    logging.info("[precision] | precision | samples/sec | final loss | Chamfer |")
+    for precision in args.precisions:
+        torch.manual_seed(0)
+        decoder = ws.build_decoder(args.experiment_directory, specs, device)
+        decoder.train()
+        lat_vecs = torch.nn.Embedding(len(sdf_dataset), specs["CodeLength"], max_norm=specs.get("CodeBound", None))
+        torch.nn.init.normal_(lat_vecs.weight.data, 0.0, 1.0 / specs["CodeLength"] ** 0.5)
+        lat_vecs = lat_vecs.to(device)
+        optimizer = torch.optim.Adam(
+            [
+                {"params": decoder.parameters(), "lr": specs["LearningRateSchedule"][0]["Initial"]},
+                {"params": lat_vecs.parameters(), "lr": specs["LearningRateSchedule"][1]["Initial"]},
+            ]
+        )
+        autocast, grad_scaler = deep_sdf.utils.get_precision(precision, device)
+
+        num_iterations = 0
+        start = time.time()
+        while num_iterations < args.iterations:
+            for sdf_data, indices, _, _ in sampler:
+                xyz = sdf_data[:, :, 0:3]
+                sdf_gt = torch.clamp(sdf_data[:, :, 3].reshape(-1, 1), -clamp_dist, clamp_dist)
+                optimizer.zero_grad()
+                with autocast():
+                    pred_sdf = decoder(lat_vecs(indices.to(device)), xyz)
+                pred_sdf = torch.clamp(pred_sdf.float(), -clamp_dist, clamp_dist)
+                loss = torch.nn.functional.l1_loss(pred_sdf, sdf_gt)
+                grad_scaler.scale(loss).backward()
+                grad_scaler.step(optimizer)
+                grad_scaler.update()
+                num_iterations += 1
+                if num_iterations == args.iterations:
+                    break
+        synchronize(device)
+        seconds = time.time() - start
+
+        chamfer = float("nan")
+        if gt_path is not None and os.path.isdir(gt_path):
+            decoder.eval()
+            num_shapes = min(args.num_shapes, len(sdf_dataset))
+            with torch.no_grad():
+                meshes = deep_sdf.mesh.create_meshes(
+                    decoder, lat_vecs.weight[:num_shapes].detach(), N=args.resolution, return_trimesh=True
+                )
+            chamfers = [
+                metrics.compute_metric(gt_mesh=f"{gt_path}/{sampler.names[i]}.obj", gen_mesh=m, metric="chamfer")[0]
+                for i, m in enumerate(meshes)
+                if m is not None
+            ]
+            if chamfers:
+                chamfer = sum(chamfers) / len(chamfers)
+
+        logging.info(
+            f"[precision] | {precision} | {num_iterations * scene_per_batch * num_samp_per_scene / seconds:,.0f} | "
+            f"{loss.item():.5f} | {chamfer:.3e} |"
+        )
+
+
+def benchmark_eval_sampling(args):
+    """
+    Reports the per-shape time of compute_trimesh_chamfer with the previous sampling, which always
+    built the Laplacian, and with the surface sampler, for every curvature weight. The GT is a
+    point cloud sampled from the mesh itself.
+    """
+    device = get_devices(args.devices)[0]
+    decoder, specs = load_benchmark_decoder(args.experiment_directory, args.checkpoint, device)
+    latent = load_benchmark_latent(args.experiment_directory, args.checkpoint, specs, device, args.shape_index)
+    with torch.no_grad():
+        mesh = deep_sdf.mesh.create_mesh(decoder, latent, N=args.resolution, return_trimesh=True)
+    if mesh is None:
+        logging.error("[eval_sampling] The decoder produced no surface, pass a trained --checkpoint")
+        return
+    gt_points = trimesh.PointCloud(trimesh.sample.sample_surface(mesh, args.num_mesh_samples)[0])
+    offset, scale = np.zeros(3), 1.0
+
+    def sample_without_sampler(gen_mesh, num_samples, curvature_sampling=0.):
+        face_curvatures = metrics.sampling.compute_face_curvatures(gen_mesh)
+        face_areas = metrics.sampling.normalize_weights(trimesh.triangles.area(gen_mesh.triangles))
+        weights = curvature_sampling * face_curvatures + (1 - curvature_sampling) * face_areas
+        return trimesh.sample.sample_surface(gen_mesh, num_samples, face_weight=weights)[0]
+
+    for curvature_sampling in args.curvature_samplings:
+        seconds = {}
+        for name, sample_surface in (("before", sample_without_sampler), ("after", metrics.sampling.sample_surface)):
+            metrics.sampling.surface_sampler.clear()
+            metrics.chamfer.sample_surface = sample_surface
+            seconds[name] = timeit(
+                lambda: metrics.chamfer.compute_trimesh_chamfer(
+                    gt_points, mesh, offset, scale, args.num_mesh_samples, curvature_sampling
+                ),
+                device,
+                args.repeats,
+            )
+        metrics.chamfer.sample_surface = metrics.sampling.sample_surface
+        logging.info(
+            f"[eval_sampling] curvature_sampling={curvature_sampling} ({len(mesh.faces):,} faces): "
+            f"{seconds['before'] * 1000:.1f} ms -> {seconds['after'] * 1000:.1f} ms per shape "
+            f"({seconds['before'] / seconds['after']:.1f}x)"
+        )
+
+
+def benchmark_metrics(args):
+    """
+    Compares the time of the Chamfer distances of a batch of point cloud pairs with the KD-tree
+    backend, shape by shape and as a batch, and with the torch backend on every device. Reports
+    the largest relative difference of the Chamfer and Hausdorff distances to the scipy KD-tree
+    path and to point_cloud_utils.
+    """
+    import point_cloud_utils as pcu
+
+    rng = np.random.default_rng(0)
+
+    def sample_sphere(radius):
+        points = rng.normal(size=(args.num_mesh_samples, 3))
+        return radius * points / np.linalg.norm(points, axis=1, keepdims=True)
+
+    gen_points = [sample_sphere(1.0 + 0.01 * i) for i in range(args.num_shapes)]
+    gt_points = [sample_sphere(1.0) for _ in range(args.num_shapes)]
+    reference = [metrics.compute_chamfer(gen, gt) for gen, gt in zip(gen_points, gt_points)]
+    reference_hausdorff = [pcu.hausdorff_distance(gen, gt) for gen, gt in zip(gen_points, gt_points)]
+
+    def relative_difference(results):
+        chamfer = max(abs(r[0] - ref[0]) / ref[0] for r, ref in zip(results, reference))
+        hausdorff = max(
+            abs(np.max(r[1]) - ref) / ref for r, ref in zip(results, reference_hausdorff)
+        )
+        return f"max rel. Chamfer diff {chamfer:.1e}, max rel. Hausdorff diff {hausdorff:.1e}"
+
+    backends = [("kdtree", metrics.get_backend("kdtree"))]
+    backends += [(f"torch {device}", metrics.get_backend("torch", device)) for device in get_devices(args.devices)]
+    for name, backend in backends:
+        device = getattr(backend, "device", torch.device("cpu"))
+        for batched in (False, True):
+            if batched:
+                compute = lambda: metrics.chamfer.compute_chamfer_batch(gen_points, gt_points, backend=backend)
+            else:
+                compute = lambda: [
+                    metrics.compute_chamfer(gen, gt, backend=backend) for gen, gt in zip(gen_points, gt_points)
+                ]
+            seconds = timeit(compute, device, args.repeats)
+            logging.info(
+                f"[metrics] {name} {'batched' if batched else 'per shape'}: "
+                f"{seconds / args.num_shapes * 1000:.1f} ms per shape, {relative_difference(compute())}"
+            )
+
+
+def benchmark_iou_emd(args):
+    """
+    Checks the IoU of a sphere with holes against the closed sphere, since the torus GT meshes are
+    watertight. Then reports the time and mean value of the IoU of the first training shapes with
+    their GT meshes ('TorusPath'), from the sign of the decoded SDF for all shapes at once (with
+    cold and warm GT occupancy cache) and from the winding numbers of their meshes, and of the
+    sliced and the exact EMD of their surface samples.
+    """
+    from deep_sdf.metrics import emd, iou
+
+    device = get_devices(args.devices)[0]
+    sphere = trimesh.creation.icosphere(subdivisions=3, radius=0.5)
+    open_sphere = sphere.copy()
+    open_sphere.update_faces(np.arange(len(sphere.faces)) >= 6)
+    points = iou.get_query_points(args.num_points)
+    start = time.time()
+    open_iou = iou.compute_iou(
+        iou.compute_mesh_occupancy(open_sphere, points, device), iou.compute_mesh_occupancy(sphere, points, device)
+    )
+    logging.info(f"[iou_emd] IoU of a sphere with 6 faces removed: {open_iou:.4f} in {time.time() - start:.1f} s")
+    assert open_iou > 0.99, f"IoU of the open sphere is {open_iou:.4f}, expected about 1"
+
+    decoder, specs = load_benchmark_decoder(args.experiment_directory, args.checkpoint, device)
+    gt_path = specs.get("TorusPath", None)
+    if args.checkpoint is None or gt_path is None or not os.path.isdir(gt_path):
+        logging.error("[iou_emd] Needs a trained --checkpoint and the GT meshes of the experiment ('TorusPath')")
+        return
+    with open(specs["TrainSplit"], "r") as f:
+        names = [os.path.splitext(name)[0] for name in json.load(f)]
+    latents = ws.load_latent_vectors(args.experiment_directory, args.checkpoint, device)[: args.num_shapes]
+    names = names[: len(latents)]
+    gt_meshes = [f"{gt_path}/{name}.obj" for name in names]
+    # Keep the cold GT occupancy timing cold.
+    gt_cache_disk = metrics.gt_cache.gt_cache.disk
+    metrics.gt_cache.gt_cache.disk = False
+
+    def mean_iou(cache):
+        if not cache:
+            metrics.gt_cache.gt_cache.clear()
+        start = time.time()
+        ious = iou.compute_decoder_iou(decoder, latents, gt_meshes, args.num_points, device=device)
+        return time.time() - start, ious
+
+    for name, cache in (("decoder SDF, cold GT cache", False), ("decoder SDF, warm GT cache", True)):
+        seconds, decoder_ious = mean_iou(cache)
+        logging.info(
+            f"[iou_emd] IoU from {name}: {seconds / len(latents) * 1000:.1f} ms per shape, mean {decoder_ious.mean():.4f}"
+        )
+
+    with torch.no_grad():
+        meshes = deep_sdf.mesh.create_meshes(decoder, latents, N=args.resolution, return_trimesh=True)
+    start = time.time()
+    mesh_ious = [
+        metrics.chamfer.compute_trimesh_iou(gt_mesh, mesh, num_points=args.num_points, device=device)
+        for gt_mesh, mesh in zip(gt_meshes, meshes)
+        if mesh is not None
+    ]
+    seconds = time.time() - start
+    logging.info(
+        f"[iou_emd] IoU from meshes (winding numbers, warm GT cache): {seconds / len(mesh_ious) * 1000:.1f} ms per shape, "
+        f"mean {np.mean(mesh_ious):.4f}"
+    )
+
+    gen_points = [trimesh.sample.sample_surface(mesh, args.emd_samples)[0] for mesh in meshes if mesh is not None]
+    gt_points = [
+        metrics.gt_cache.get_gt_points(gt_mesh, args.emd_samples)[0]
+        for gt_mesh, mesh in zip(gt_meshes, meshes)
+        if mesh is not None
+    ]
+    for name, compute in (
+        ("sliced", lambda: emd.sliced_emd(np.stack(gen_points), np.stack(gt_points), device=device)),
+        ("exact", lambda: [emd.emd(gen, gt) for gen, gt in zip(gen_points, gt_points)]),
+    ):
+        start = time.time()
+        distances = compute()
+        seconds = time.time() - start
+        logging.info(
+            f"[iou_emd] {name} EMD of {args.emd_samples} points: {seconds / len(gen_points) * 1000:.1f} ms per shape, "
+            f"mean {np.mean(distances):.4e}"
+        )
+    metrics.gt_cache.gt_cache.disk = gt_cache_disk
+
+
+def benchmark_isosurface(args):
+    """
+    Reports the isosurface extraction time of every backend on the analytic SDF of a torus per grid
+    resolution and device, together with the number of faces and the Chamfer distance to the
+    scikit-image mesh. Volumes are built on the device; scikit-image copies them to the host.
+    """
+    for device in get_devices(args.devices):
+        for N in args.resolutions:
+            axis = torch.linspace(-1, 1, N, device=device)
+            x, y, z = torch.meshgrid(axis, axis, axis, indexing="ij")
+            volume = torch.sqrt((torch.sqrt(x ** 2 + y ** 2) - 0.5) ** 2 + z ** 2) - 0.25
+            del x, y, z
+            reference = None
+            for name in args.backends:
+                backend = deep_sdf.isosurface.get_isosurface_backend(name)
+                seconds = timeit(lambda: backend(volume, 0.0, 2.0 / (N - 1)), device, args.repeats)
+                verts, faces = backend(volume, 0.0, 2.0 / (N - 1))
+                points = trimesh.sample.sample_surface(trimesh.Trimesh(verts, faces, process=False), 30000)[0]
+                reference = points if reference is None else reference
+                chamfer, _ = metrics.compute_chamfer(points, reference)
+                logging.info(
+                    f"[isosurface] {device} N={N} {name}: {seconds * 1000:.0f} ms, {len(faces):,} faces, "
+                    f"Chamfer to {args.backends[0]} {chamfer:.2e}"
+                )
+            del volume
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(description="Benchmark the DeepSDF pipeline.")
+    subparsers = arg_parser.add_subparsers(dest="benchmark", required=True)
+
+    def add_benchmark(name, fn, help):
+        parser = subparsers.add_parser(name, help=help)
+        parser.set_defaults(fn=fn)
+        parser.add_argument(
+            "--experiment",
+            "-e",
+            dest="experiment_directory",
+            required=True,
+            help="The experiment directory whose specifications define the decoder.",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            "-c",
+            dest="checkpoint",
+            default=None,
+            help="The checkpoint to load. Randomly initialized weights are used if not set.",
+        )
+        parser.add_argument(
+            "--devices",
+            dest="devices",
+            nargs="+",
+            default=None,
+            help="The devices to benchmark. Defaults to the CPU and, if available, CUDA.",
+        )
+        parser.add_argument(
+            "--threads",
+            dest="num_threads",
+            default=None,
+            type=int,
+            help="Number of intra-op threads used on the CPU.",
+        )
+        parser.add_argument(
+            "--repeats",
+            dest="repeats",
+            default=5,
+            type=int,
+            help="Number of timed repetitions.",
+        )
+        deep_sdf.add_common_args(parser)
+        return parser
+
+    parser = add_benchmark("decode", benchmark_decode, "Decoder throughput in points/sec per device.")
+    parser.add_argument(
+        "--batch_size",
+        dest="batch_size",
+        default=2 ** 18,
+        type=int,
+        help="Number of query points per forward pass.",
+    )
+
+    parser = add_benchmark("meshing", benchmark_meshing, "Coarse-to-fine versus dense mesh extraction.")
+    parser.add_argument(
+        "--resolution",
+        "-N",
+        dest="resolution",
+        default=256,
+        type=int,
+        help="The resolution of the marching cubes grid.",
+    )
+    parser.add_argument(
+        "--levels",
+        dest="levels",
+        nargs="+",
+        default=[1, 2, 3],
+        type=int,
+        help="The refinement levels to compare against the dense evaluation.",
+    )
+    parser.add_argument(
+        "--max_batch",
+        dest="max_batch",
+        default=2 ** 18,
+        type=int,
+        help="Number of query points per forward pass.",
+    )
+    parser.add_argument(
+        "--shape_index",
+        dest="shape_index",
+        default=0,
+        type=int,
+        help="Index of the training latent code to mesh (only used with a checkpoint).",
+    )
+
+    parser = add_benchmark("batched_meshing", benchmark_batched_meshing, "Shapes/hour of batched mesh extraction.")
+    parser.add_argument(
+        "--resolution",
+        "-N",
+        dest="resolution",
+        default=256,
+        type=int,
+        help="The resolution of the marching cubes grid.",
+    )
+    parser.add_argument(
+        "--max_batch",
+        dest="max_batch",
+        default=2 ** 18,
+        type=int,
+        help="Number of query points per forward pass.",
+    )
+    parser.add_argument(
+        "--num_shapes",
+        dest="num_shapes",
+        default=16,
+        type=int,
+        help="Number of shapes to mesh.",
+    )
+    parser.add_argument(
+        "--shapes_per_batch",
+        dest="shapes_per_batch",
+        nargs="+",
+        default=[1, 4, 8],
+        type=int,
+        help="The numbers of shapes per forward pass to compare.",
+    )
+
+    parser = add_benchmark("data", benchmark_data, "Training batches/sec of the DataLoader and the device sampler.")
+    parser.add_argument(
+        "--batches",
+        dest="num_batches",
+        default=100,
+        type=int,
+        help="Number of batches to draw from every loader.",
+    )
+
+    parser = add_benchmark("compile", benchmark_compile, "Startup and steady-state latency of the compiled decoder.")
+    parser.add_argument(
+        "--batch_sizes",
+        dest="batch_sizes",
+        nargs="+",
+        default=[64, 8000, 2 ** 18],
+        type=int,
+        help="Numbers of query points per inference call.",
+    )
+    parser.add_argument(
+        "--reconstruct_samples",
+        dest="reconstruct_samples",
+        default=8000,
+        type=int,
+        help="Number of SDF samples per latent optimization step.",
+    )
+
+    parser = add_benchmark("snn", benchmark_snn, "Per-dimension versus fused SNN loss time and equivalence.")
+    parser.add_argument(
+        "--batch_sizes",
+        dest="batch_sizes",
+        nargs="+",
+        default=[16, 64, 256],
+        type=int,
+        help="Numbers of latent codes per loss evaluation.",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        dest="chunk_size",
+        default=4,
+        type=int,
+        help="Number of latent dimensions per op of the chunked fused loss.",
+    )
+    parser.add_argument("--temp", dest="temp", default=181.0, type=float, help="Temperature of the class loss.")
+    parser.add_argument("--temp_reg", dest="temp_reg", default=20.0, type=float, help="Temperature of the regression loss.")
+    parser.add_argument("--threshold", dest="threshold", default=0.5, type=float, help="Label threshold of the regression loss.")
+
+    parser = add_benchmark("latent_optimizer", benchmark_latent_optimizer, "Latent code step time with dense and sparse gradients.")
+    parser.add_argument(
+        "--num_shapes",
+        dest="num_shapes",
+        nargs="+",
+        default=[1000, 10000, 100000],
+        type=int,
+        help="The numbers of latent codes to compare.",
+    )
+
+    parser = add_benchmark("ddp", benchmark_ddp, "Training samples/sec of distributed training per process count.")
+    parser.add_argument(
+        "--world_sizes",
+        dest="world_sizes",
+        nargs="+",
+        default=[1, 2, 4],
+        type=int,
+        help="The numbers of processes to compare. On the CPU, the cores are split between the processes "
+        + "unless --threads is set.",
+    )
+    parser.add_argument(
+        "--iterations",
+        dest="iterations",
+        default=100,
+        type=int,
+        help="Number of timed training iterations per process.",
+    )
+    parser.add_argument(
+        "--warmup",
+        dest="warmup",
+        default=5,
+        type=int,
+        help="Number of untimed training iterations per process.",
+    )
+
+    parser = add_benchmark("precision", benchmark_precision, "Training samples/sec and Chamfer per precision.")
+    parser.add_argument(
+        "--precisions",
+        dest="precisions",
+        nargs="+",
+        default=["fp32", "fp16", "bf16"],
+        help="The precisions to compare.",
+    )
+    parser.add_argument(
+        "--iterations",
+        dest="iterations",
+        default=1000,
+        type=int,
+        help="Number of training iterations per precision.",
+    )
+    parser.add_argument(
+        "--num_shapes",
+        dest="num_shapes",
+        default=10,
+        type=int,
+        help="Number of training shapes to mesh for the Chamfer distance.",
+    )
+    parser.add_argument(
+        "--resolution",
+        "-N",
+        dest="resolution",
+        default=128,
+        type=int,
+        help="The resolution of the marching cubes grid.",
+    )
+
+    parser = add_benchmark("eval_sampling", benchmark_eval_sampling, "Per-shape Chamfer evaluation time per curvature weight.")
+    parser.add_argument(
+        "--curvature_samplings",
+        dest="curvature_samplings",
+        nargs="+",
+        default=[0.0, 0.5],
+        type=float,
+        help="The curvature weights to compare.",
+    )
+    parser.add_argument(
+        "--num_mesh_samples",
+        dest="num_mesh_samples",
+        default=30000,
+        type=int,
+        help="Number of points sampled from the mesh.",
+    )
+    parser.add_argument(
+        "--shape_index",
+        dest="shape_index",
+        default=0,
+        type=int,
+        help="The training shape whose latent code is used if a checkpoint is given.",
+    )
+    parser.add_argument(
+        "--resolution",
+        "-N",
+        dest="resolution",
+        default=128,
+        type=int,
+        help="The resolution of the marching cubes grid.",
+    )
+
+    parser = add_benchmark("metrics", benchmark_metrics, "Chamfer/Hausdorff time and equivalence per metric backend.")
+    parser.add_argument(
+        "--num_shapes",
+        dest="num_shapes",
+        default=8,
+        type=int,
+        help="Number of point cloud pairs per batch.",
+    )
+    parser.add_argument(
+        "--num_mesh_samples",
+        dest="num_mesh_samples",
+        default=30000,
+        type=int,
+        help="Number of points per point cloud.",
+    )
+
+    parser = add_benchmark("iou_emd", benchmark_iou_emd, "IoU and EMD time and values of the training shapes.")
+    parser.add_argument(
+        "--num_shapes",
+        dest="num_shapes",
+        default=8,
+        type=int,
+        help="Number of training shapes to evaluate.",
+    )
+    parser.add_argument(
+        "--num_points",
+        dest="num_points",
+        default=100000,
+        type=int,
+        help="Number of IoU query points.",
+    )
+    parser.add_argument(
+        "--emd_samples",
+        dest="emd_samples",
+        default=2000,
+        type=int,
+        help="Number of surface points per shape for the EMD.",
+    )
+    parser.add_argument(
+        "--resolution",
+        "-N",
+        dest="resolution",
+        default=128,
+        type=int,
+        help="The resolution of the marching cubes grid.",
+    )
+
+    parser = add_benchmark("isosurface", benchmark_isosurface, "Isosurface extraction time per backend and resolution.")
+    parser.add_argument(
+        "--resolutions",
+        dest="resolutions",
+        nargs="+",
+        default=[128, 256, 512],
+        type=int,
+        help="The grid resolutions N to compare.",
+    )
+    parser.add_argument(
+        "--backends",
+        dest="backends",
+        nargs="+",
+        default=["skimage", "torch"],
+        help="The isosurface backends to compare, the first one is the Chamfer reference.",
+    )
+
+    args = arg_parser.parse_args()
+
+    deep_sdf.configure_logging(args)
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    args.fn(args)
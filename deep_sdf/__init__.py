@@ -3,6 +3,7 @@
 
 import os
 from deep_sdf.data import *
+from deep_sdf.distributed import *
 from deep_sdf.mesh import *
 from deep_sdf.metrics.chamfer import *
 from deep_sdf.utils import *
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 # Copyright 2004-present Facebook. All Rights Reserved.
 
+import concurrent.futures
 import glob
+import hashlib
+import json
 import logging
+import shutil
 import time
 import numpy as np
 import os
@@ -11,6 +15,8 @@ import torch
 import torch.utils.data
 import logging
 import deep_sdf.workspace as ws
+from deep_sdf.utils import TimingHistogram
+from deep_sdf.distributed import shard_indices
 from typing import Tuple, List
 
 
@@ -70,6 +76,33 @@ def read_sdf_samples_into_ram(filename) -> Tuple[torch.Tensor, torch.Tensor]:
     return [pos_tensor, neg_tensor]
 
 
+def load_shuffled_sdf_samples(filename, shuffle=True):
+    """Like read_sdf_samples_into_ram, but with NaNs removed and the samples shuffled once."""
+    pos_tensor, neg_tensor = read_sdf_samples_into_ram(filename)
+    pos_tensor = remove_nans(pos_tensor)
+    neg_tensor = remove_nans(neg_tensor)
+    if shuffle:
+        pos_tensor = pos_tensor[torch.randperm(pos_tensor.shape[0])]
+        neg_tensor = neg_tensor[torch.randperm(neg_tensor.shape[0])]
+    return [pos_tensor, neg_tensor]
+
+
+def load_shuffled_sdf_samples_parallel(filenames, num_workers=8, shuffle=True):
+    """
+    Yields load_shuffled_sdf_samples of every file, in order, loading them on a thread pool.
+    Decompressing the .npz files releases the GIL, so threads suffice and the arrays are not
+    copied between processes. Progress is logged every 10%.
+    """
+    start = time.time()
+    log_every = max(1, len(filenames) // 10)
+    with concurrent.futures.ThreadPoolExecutor(max(1, num_workers)) as executor:
+        shapes = executor.map(lambda f: load_shuffled_sdf_samples(f, shuffle), filenames)
+        for i, shape in enumerate(shapes):
+            if (i + 1) % log_every == 0 or i + 1 == len(filenames):
+                logging.info(f"Loaded {i + 1}/{len(filenames)} shapes in {time.time() - start:.1f} s")
+            yield shape
+
+
 def unpack_sdf_samples(filename, subsample=None):
     npz = np.load(filename)
     if subsample is None:
@@ -127,12 +160,24 @@ class SDFSamples(torch.utils.data.Dataset):
         load_ram=False,
         print_filename=False,
         num_files=1000000,
+        num_load_workers=8,
+        ram_cache=True,
+        lazy_load=False,
     ):
+        """
+        With `load_ram`, the samples of all shapes are loaded into memory on `num_load_workers`
+        threads. If `ram_cache` is set, they are then written to a cache in the data source that
+        is keyed by the split and read instead on the next run. With `lazy_load`, shapes that are
+        not cached yet are only loaded when they are first accessed, which must happen in the
+        main process, and the cache is written once all of them are loaded.
+        """
         self.subsample = subsample
 
         self.data_source = data_source
         self.npyfiles = get_instance_filenames(data_source, split)
         self.labels = self.load_labels()
+        # Time to get an item, recorded by all DataLoader workers.
+        self.item_times = TimingHistogram()
 
         logging.debug(
             "using "
@@ -144,43 +189,338 @@ class SDFSamples(torch.utils.data.Dataset):
         self.load_ram = load_ram
         TIME = time.time()
         if load_ram:
-            self.loaded_data = []
-            for f in self.npyfiles:
-                filename = os.path.join(self.data_source, f)
-                npz = np.load(filename)
-                pos_tensor = remove_nans(torch.from_numpy(npz["pos"]))
-                neg_tensor = remove_nans(torch.from_numpy(npz["neg"]))
-                self.loaded_data.append(
-                    [
-                        pos_tensor[torch.randperm(pos_tensor.shape[0])],
-                        neg_tensor[torch.randperm(neg_tensor.shape[0])],
-                    ]
-                )
+            self.loaded_data = self.load_into_ram(num_load_workers, ram_cache, lazy_load)
         logging.debug(f"Time for loading into RAM: {(time.time() - TIME)*1000} ms"); TIME = time.time()
 
+    def get_ram_cache_dir(self):
+        """The cache is keyed by the files of the split, their sizes and modification times."""
+        key = []
+        for f in self.npyfiles:
+            stat = os.stat(os.path.join(self.data_source, f))
+            key.append([f, stat.st_size, stat.st_mtime_ns])
+        split_hash = hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16]
+        return os.path.join(self.data_source, ".ram_cache", split_hash)
+
+    def load_into_ram(self, num_workers=8, use_cache=True, lazy=False):
+        cache_dir = self.get_ram_cache_dir() if use_cache else None
+        self.ram_cache_dir = None
+        self.num_lazily_loaded = len(self.npyfiles)
+        if cache_dir is not None and os.path.isfile(os.path.join(cache_dir, packed_index_filename)):
+            logging.info(f"Reading SDF samples from the cache {cache_dir}")
+            index, pos, neg = read_packed_sdf_samples(cache_dir)
+            pos_offsets, neg_offsets = index["pos_offsets"], index["neg_offsets"]
+            # Every shape's samples are views into the two arrays read from the cache.
+            return [
+                [pos[pos_offsets[i] : pos_offsets[i + 1]], neg[neg_offsets[i] : neg_offsets[i + 1]]]
+                for i in range(len(self.npyfiles))
+            ]
+
+        if lazy:
+            # Written by get_loaded_data once the last shape is loaded.
+            self.ram_cache_dir = cache_dir
+            self.num_lazily_loaded = 0
+            return [None] * len(self.npyfiles)
+
+        filenames = [os.path.join(self.data_source, f) for f in self.npyfiles]
+        loaded_data = list(load_shuffled_sdf_samples_parallel(filenames, num_workers))
+
+        if cache_dir is not None:
+            self.write_ram_cache(cache_dir, loaded_data)
+        return loaded_data
+
+    def write_ram_cache(self, cache_dir, loaded_data):
+        # Unique per process, distributed training processes may write the cache at once.
+        tmp_dir = cache_dir + f".tmp{os.getpid()}"
+        try:
+            write_packed_sdf_samples(
+                tmp_dir, [get_instance_name(f) for f in self.npyfiles], loaded_data, self.labels.numpy()
+            )
+            os.replace(tmp_dir, cache_dir)
+            logging.info(f"Cached the SDF samples in {cache_dir}")
+        except OSError as e:
+            logging.warning(f"Could not cache the SDF samples in {cache_dir}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def loads_lazily(self):
+        """Whether shapes are still loaded on first access, so only the main process may access them."""
+        return self.load_ram and self.num_lazily_loaded < len(self.npyfiles)
+
+    def get_loaded_data(self, idx):
+        if self.loaded_data[idx] is None:
+            # Shapes loaded by a DataLoader worker would be lost with the worker at the end of
+            # the epoch and never reach the cache.
+            if torch.utils.data.get_worker_info() is not None:
+                raise RuntimeError(
+                    "SDFSamples with lazy_load must be accessed in the main process (DataLoader num_workers=0)"
+                )
+            self.loaded_data[idx] = load_shuffled_sdf_samples(os.path.join(self.data_source, self.npyfiles[idx]))
+            self.num_lazily_loaded += 1
+            if self.num_lazily_loaded == len(self.npyfiles) and self.ram_cache_dir is not None:
+                self.write_ram_cache(self.ram_cache_dir, self.loaded_data)
+        return self.loaded_data[idx]
+
     def load_labels(self):
+        """Returns the labels of all shapes as one tensor whose rows are aligned with npyfiles."""
         labels = torch.load(self.data_source + "/labels.pt")
-        return labels
+        names = [get_instance_name(f) for f in self.npyfiles]
+        missing = [name for name in names if name not in labels]
+        if missing:
+            raise RuntimeError(
+                f"{len(missing)} shapes have no label in {self.data_source}/labels.pt, e.g. {missing[:5]}"
+            )
+        # Shared with the DataLoader workers instead of being copied into each of them.
+        return torch.tensor([labels[name] for name in names]).share_memory_()
     
     def __len__(self):
         return len(self.npyfiles)
 
+    def get_shape(self, idx):
+        """Returns the shuffled positive and negative samples and the label of a shape."""
+        label = self.labels[idx]
+        if self.load_ram:
+            pos_tensor, neg_tensor = self.get_loaded_data(idx)
+        else:
+            pos_tensor, neg_tensor = load_shuffled_sdf_samples(os.path.join(self.data_source, self.npyfiles[idx]))
+        return pos_tensor, neg_tensor, label
+
     def __getitem__(self, idx):
         TIME = time.time()
         filename = os.path.join(
             self.data_source, self.npyfiles[idx]
         )
         
-        label = self.labels[os.path.splitext(os.path.basename(self.npyfiles[idx]))[0]]
-        label = torch.tensor(label)
+        label = self.labels[idx]
         
         if self.load_ram:
             retval = (
-                unpack_sdf_samples_from_ram(self.loaded_data[idx], self.subsample),
-                idx, label,
+                unpack_sdf_samples_from_ram(self.get_loaded_data(idx), self.subsample),
+                idx, label, filename,
             )
         else:
             retval = unpack_sdf_samples(filename, self.subsample), idx, label, filename
         
-        logging.debug(f"Time for getting item: {(time.time() - TIME)*1000} ms"); TIME = time.time()
+        self.item_times.add(time.time() - TIME)
         return retval
+
+
+packed_pos_filename = "pos.bin"
+packed_neg_filename = "neg.bin"
+packed_index_filename = "index.npz"
+
+
+def get_instance_name(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def write_packed_sdf_samples(packed_dir, names, shapes, labels):
+    """
+    Writes the packed format read by PackedSDFSamples: all positive and all negative samples of
+    all shapes in one flat float32 N x 4 array each (pos.bin, neg.bin), plus index.npz with the
+    sample offsets of every shape, the instance names and the labels. `shapes` is an iterable of
+    [pos, neg] tensors in the order of `names`; they are written as they come.
+    """
+    os.makedirs(packed_dir, exist_ok=True)
+    pos_offsets = [0]
+    neg_offsets = [0]
+    with open(os.path.join(packed_dir, packed_pos_filename), "wb") as pos_file, open(
+        os.path.join(packed_dir, packed_neg_filename), "wb"
+    ) as neg_file:
+        for name, (pos_tensor, neg_tensor) in zip(names, shapes):
+            pos_file.write(pos_tensor.numpy().astype(np.float32).tobytes())
+            neg_file.write(neg_tensor.numpy().astype(np.float32).tobytes())
+            pos_offsets.append(pos_offsets[-1] + pos_tensor.shape[0])
+            neg_offsets.append(neg_offsets[-1] + neg_tensor.shape[0])
+            logging.debug(f"packed {name}: {pos_tensor.shape[0]} pos, {neg_tensor.shape[0]} neg samples")
+
+    np.savez(
+        os.path.join(packed_dir, packed_index_filename),
+        pos_offsets=np.array(pos_offsets, dtype=np.int64),
+        neg_offsets=np.array(neg_offsets, dtype=np.int64),
+        names=np.array(names),
+        labels=np.array(labels),
+    )
+
+
+def read_packed_sdf_samples(packed_dir):
+    """Reads the index and the complete positive and negative sample arrays of a packed directory."""
+    index = np.load(os.path.join(packed_dir, packed_index_filename))
+    pos = torch.from_numpy(np.fromfile(os.path.join(packed_dir, packed_pos_filename), dtype=np.float32).reshape(-1, 4))
+    neg = torch.from_numpy(np.fromfile(os.path.join(packed_dir, packed_neg_filename), dtype=np.float32).reshape(-1, 4))
+    return index, pos, neg
+
+
+def pack_sdf_samples(data_source, split, packed_dir, shuffle=True, num_workers=8):
+    """
+    Converts the .npz SDF samples of `split` into the packed format of write_packed_sdf_samples,
+    with the labels from labels.pt. NaNs are removed and, like with load_ram, the samples of
+    every shape are shuffled once so that contiguous windows are random subsamples.
+    """
+    npz_filenames = get_instance_filenames(data_source, split)
+    all_labels = torch.load(os.path.join(data_source, "labels.pt"))
+    names = [get_instance_name(f) for f in npz_filenames]
+    write_packed_sdf_samples(
+        packed_dir,
+        names,
+        load_shuffled_sdf_samples_parallel(npz_filenames, num_workers, shuffle),
+        [all_labels[name] for name in names],
+    )
+    logging.info(f"Packed {len(names)} shapes into {packed_dir}")
+
+
+class PackedSDFSamples(torch.utils.data.Dataset):
+    """
+    SDFSamples backed by the packed format of pack_sdf_samples. The sample arrays are memory
+    mapped, so DataLoader workers share the OS page cache instead of every process holding its
+    own copy, and subsamples are contiguous windows into the mapped arrays like with load_ram.
+    `split` selects and orders the shapes, so indices match those of SDFSamples.
+    """
+
+    def __init__(self, packed_dir, split, subsample):
+        self.subsample = subsample
+        self.packed_dir = packed_dir
+
+        index = np.load(os.path.join(packed_dir, packed_index_filename))
+        packed_names = {name: i for i, name in enumerate(index["names"])}
+        try:
+            order = np.array([packed_names[get_instance_name(name)] for name in split], dtype=np.int64)
+        except KeyError as e:
+            raise RuntimeError(f"Shape {e} of the split is not in the packed data {packed_dir}")
+        self.names = index["names"][order]
+        # Like SDFSamples.npyfiles, e.g. to name the shapes in evaluations.
+        self.npyfiles = [str(name) + ".npz" for name in self.names]
+        self.labels = torch.from_numpy(index["labels"][order]).share_memory_()
+        self.pos_offsets = index["pos_offsets"][order]
+        self.pos_sizes = index["pos_offsets"][order + 1] - self.pos_offsets
+        self.neg_offsets = index["neg_offsets"][order]
+        self.neg_sizes = index["neg_offsets"][order + 1] - self.neg_offsets
+        self.num_pos = int(index["pos_offsets"][-1])
+        self.num_neg = int(index["neg_offsets"][-1])
+
+        # Opened lazily in every worker, see _open.
+        self.pos = None
+        self.neg = None
+        # Time to get an item, recorded by all DataLoader workers.
+        self.item_times = TimingHistogram()
+
+        logging.debug(f"using {len(self.names)} shapes from packed data {packed_dir}")
+
+    def _open(self):
+        self.pos = np.memmap(
+            os.path.join(self.packed_dir, packed_pos_filename), dtype=np.float32, mode="r", shape=(self.num_pos, 4)
+        )
+        self.neg = np.memmap(
+            os.path.join(self.packed_dir, packed_neg_filename), dtype=np.float32, mode="r", shape=(self.num_neg, 4)
+        )
+
+    def __getstate__(self):
+        # Do not pickle the mapped arrays into spawned DataLoader workers.
+        state = self.__dict__.copy()
+        state["pos"] = None
+        state["neg"] = None
+        return state
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_shape(self, idx):
+        """Returns the (already shuffled) positive and negative samples and the label of a shape."""
+        if self.pos is None:
+            self._open()
+        pos_offset, neg_offset = self.pos_offsets[idx], self.neg_offsets[idx]
+        return (
+            torch.from_numpy(np.array(self.pos[pos_offset : pos_offset + self.pos_sizes[idx]])),
+            torch.from_numpy(np.array(self.neg[neg_offset : neg_offset + self.neg_sizes[idx]])),
+            self.labels[idx],
+        )
+
+    def _sample(self, samples, offset, size, num):
+        if size <= num:
+            indices = np.random.randint(0, size, num) + offset
+            return samples[indices]
+        start = offset + random.randint(0, size - num)
+        return samples[start : start + num]
+
+    def __getitem__(self, idx):
+        TIME = time.time()
+        if self.pos is None:
+            self._open()
+        half = int(self.subsample / 2)
+        sample_pos = self._sample(self.pos, self.pos_offsets[idx], self.pos_sizes[idx], half)
+        sample_neg = self._sample(self.neg, self.neg_offsets[idx], self.neg_sizes[idx], half)
+        samples = torch.from_numpy(np.concatenate([sample_pos, sample_neg], 0))
+        self.item_times.add(time.time() - TIME)
+        return samples, idx, self.labels[idx], str(self.names[idx])
+
+
+class DeviceSDFSampler:
+    """
+    Replaces a DataLoader over SDFSamples or PackedSDFSamples. The samples of all shapes are kept
+    in one buffer per sign on `device` with an offsets table, and every batch of `batch_size`
+    shapes is drawn with one vectorized gather on the device. Subsamples are chosen like
+    unpack_sdf_samples_from_ram. Iterating yields the same (samples, indices, labels, names)
+    batches as the DataLoader, with samples and labels already on `device`.
+
+    For distributed training, only the shard of shapes of `rank` (see shard_indices) is kept and
+    sampled from. The yielded indices are those of the whole dataset.
+    """
+
+    def __init__(self, dataset, subsample, batch_size, device, shuffle=True, drop_last=True, rank=0, world_size=1):
+        self.half = int(subsample / 2)
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.shape_indices = torch.tensor(shard_indices(len(dataset), rank, world_size), dtype=torch.long)
+
+        TIME = time.time()
+        pos, neg, labels = zip(*[dataset.get_shape(i) for i in self.shape_indices.tolist()])
+        self.names = [get_instance_name(dataset.npyfiles[i]) for i in self.shape_indices.tolist()]
+        self.labels = torch.stack(labels).to(self.device)
+        self.pos, self.pos_offsets, self.pos_sizes = self._to_buffer(pos)
+        self.neg, self.neg_offsets, self.neg_sizes = self._to_buffer(neg)
+        # Shapes with too few samples for a contiguous window are sampled with replacement.
+        self.pos_with_replacement = bool((self.pos_sizes <= self.half).any())
+        self.neg_with_replacement = bool((self.neg_sizes <= self.half).any())
+        logging.debug(
+            f"Time for loading {len(self.names)} shapes onto {self.device}: {(time.time() - TIME)*1000} ms"
+        )
+
+    def _to_buffer(self, tensors):
+        sizes = torch.tensor([t.shape[0] for t in tensors], dtype=torch.long)
+        offsets = torch.cumsum(sizes, 0) - sizes
+        buffer = torch.cat(tensors, 0).to(self.device)
+        return buffer, offsets.to(self.device), sizes.to(self.device)
+
+    def _gather(self, buffer, offsets, sizes, indices, with_replacement):
+        offsets = offsets[indices].unsqueeze(1)
+        sizes = sizes[indices].unsqueeze(1)
+        window = torch.arange(self.half, device=self.device).unsqueeze(0)
+        start = (torch.rand(sizes.shape, device=self.device) * (sizes - self.half + 1).clamp(min=1)).long()
+        samples = offsets + start + window
+        if with_replacement:
+            random_samples = offsets + (torch.rand(sizes.shape[0], self.half, device=self.device) * sizes).long()
+            samples = torch.where(sizes > self.half, samples, random_samples)
+        return buffer[samples]
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.names) // self.batch_size
+        return (len(self.names) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.names))
+        else:
+            order = torch.arange(len(self.names))
+        for i in range(len(self)):
+            # Positions in the buffers of this sampler's shard.
+            positions = order[i * self.batch_size : (i + 1) * self.batch_size]
+            device_indices = positions.to(self.device)
+            samples = torch.cat(
+                [
+                    self._gather(self.pos, self.pos_offsets, self.pos_sizes, device_indices, self.pos_with_replacement),
+                    self._gather(self.neg, self.neg_offsets, self.neg_sizes, device_indices, self.neg_with_replacement),
+                ],
+                1,
+            )
+            yield samples, self.shape_indices[positions], self.labels[device_indices], [self.names[j] for j in positions]
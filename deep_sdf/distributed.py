@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(device):
+    """
+    Joins the process group if the script was launched by torchrun with more than one process,
+    using NCCL on CUDA and gloo on the CPU. Every process then runs on the CUDA device of its
+    local rank. Only the main process logs at INFO level. Returns the device to run on.
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return device
+    if device.type == "cuda":
+        device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+        torch.cuda.set_device(device)
+    dist.init_process_group("nccl" if device.type == "cuda" else "gloo")
+    if not is_main_process():
+        logging.getLogger().setLevel(logging.WARNING)
+    logging.info(f"Training with {get_world_size()} processes ({dist.get_backend()} backend)")
+    return device
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def shard_indices(num_items, rank=None, world_size=None):
+    """
+    Returns the indices of the items of `rank`. Every process gets every world_size-th item, with
+    the first items repeated so that all processes get the same number of items.
+    """
+    rank = get_rank() if rank is None else rank
+    world_size = get_world_size() if world_size is None else world_size
+    shard_size = (num_items + world_size - 1) // world_size
+    indices = list(range(num_items))
+    indices += indices[: shard_size * world_size - num_items]
+    return indices[rank::world_size]
+
+
+def all_gather_cat(tensor):
+    """Concatenates `tensor` of all processes along the first dimension. The shapes must match."""
+    if not is_distributed():
+        return tensor
+    tensors = [torch.empty_like(tensor) for _ in range(get_world_size())]
+    dist.all_gather(tensors, tensor.contiguous())
+    return torch.cat(tensors, 0)
+
+
+def all_reduce_mean(value):
+    """Returns the mean of the float `value` over all processes."""
+    if not is_distributed():
+        return value
+    tensor = torch.tensor([float(value)], dtype=torch.float64)
+    if dist.get_backend() == "nccl":
+        tensor = tensor.cuda()
+    dist.all_reduce(tensor)
+    return tensor.item() / get_world_size()
+
+
+def broadcast_latent_vectors(lat_vecs):
+    """Copies the latent codes of the main process to all processes."""
+    if is_distributed():
+        dist.broadcast(lat_vecs.weight.data, 0)
+
+
+def renorm_latent_vectors(lat_vecs, indices):
+    """
+    Applies the max_norm of the embedding to the codes that any process is about to look up,
+    identically on every process. `indices` are the indices of all processes (see all_gather_cat).
+    The lookup of each process then leaves the codes unchanged.
+    """
+    if lat_vecs.max_norm is not None:
+        with torch.no_grad():
+            torch.embedding_renorm_(lat_vecs.weight, indices, lat_vecs.max_norm, lat_vecs.norm_type)
+
+
+def sync_latent_gradients(lat_vecs, indices, all_indices):
+    """
+    Averages the latent code gradients over all processes, like DistributedDataParallel does for
+    the decoder, so that every process applies the same update to its copy of the codes. Only the
+    rows of the codes looked up in the batch (`indices` locally, `all_indices` of all processes)
+    are exchanged instead of the whole embedding.
+    """
+    if not is_distributed() or lat_vecs.weight.grad is None:
+        return
+    grad = lat_vecs.weight.grad
+    indices = indices.to(grad.device)
+    all_indices = all_indices.to(grad.device)
+    # Shapes that occur several times in the batch share their row, so split it between them.
+    _, inverse, counts = torch.unique(indices, return_inverse=True, return_counts=True)
+    if grad.is_sparse:
+        grad = grad.coalesce()
+        rows = grad.values()[torch.searchsorted(grad.indices()[0], indices)]
+    else:
+        rows = grad[indices]
+    all_rows = all_gather_cat(rows / counts[inverse].unsqueeze(1).to(rows.dtype)) / get_world_size()
+    if grad.is_sparse:
+        lat_vecs.weight.grad = torch.sparse_coo_tensor(all_indices.unsqueeze(0), all_rows, grad.shape)
+    else:
+        grad.zero_()
+        grad.index_add_(0, all_indices, all_rows)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import itertools
+import numpy as np
+import skimage.measure
+import torch
+
+
+class SkimageMarchingCubes:
+    """Marching cubes (Lewiner) of scikit-image on the host, single-threaded."""
+
+    name = "skimage"
+    # Volumes are copied to the host anyway.
+    device_volumes = False
+
+    def __call__(self, volume, level=0.0, spacing=1.0, mask=None):
+        """
+        Extracts the isosurface at `level` of the (N0, N1, N2) tensor `volume`, only in the cells
+        where the boolean `mask` is set if given. Returns the float32 vertices (in voxel index
+        coordinates times `spacing`) and int32 faces, and raises ValueError if there is no surface.
+        """
+        if mask is not None:
+            mask = mask.cpu().numpy()
+        verts, faces, _, _ = skimage.measure.marching_cubes(
+            volume.cpu().numpy(), level=level, spacing=[spacing] * 3, method="lewiner", mask=mask
+        )
+        return verts.astype(np.float32), faces.astype(np.int32)
+
+
+# The 6 tetrahedra of the Kuhn decomposition of a cell, one per order of stepping along the axes
+# from its lower to its upper corner. Neighboring cells split their shared faces identically.
+TET_CORNERS = torch.tensor(
+    [
+        [[0, 0, 0], step_1, [a + b for a, b in zip(step_1, step_2)], [1, 1, 1]]
+        for step_1, step_2, _ in itertools.permutations([[1, 0, 0], [0, 1, 0], [0, 0, 1]])
+    ]
+)
+# Tetrahedra stepping along the axes in an odd order have the opposite orientation.
+TET_FLIPPED = torch.linalg.det((TET_CORNERS[:, 1:] - TET_CORNERS[:, :1]).double()) < 0
+TET_EDGES = torch.tensor([[0, 1], [0, 2], [0, 3], [1, 2], [1, 3], [2, 3]])
+# Up to two triangles (as edges of TET_EDGES) per case, the case being the bitmask of the
+# corners above the level.
+TET_TRIANGLES = torch.tensor(
+    [
+        [-1, -1, -1, -1, -1, -1],
+        [1, 0, 2, -1, -1, -1],
+        [4, 0, 3, -1, -1, -1],
+        [1, 4, 2, 1, 3, 4],
+        [3, 1, 5, -1, -1, -1],
+        [2, 3, 0, 2, 5, 3],
+        [1, 4, 0, 1, 5, 4],
+        [4, 2, 5, -1, -1, -1],
+        [4, 5, 2, -1, -1, -1],
+        [4, 1, 0, 4, 5, 1],
+        [3, 2, 0, 3, 5, 2],
+        [1, 3, 5, -1, -1, -1],
+        [4, 1, 2, 4, 3, 1],
+        [3, 0, 4, -1, -1, -1],
+        [2, 0, 1, -1, -1, -1],
+        [-1, -1, -1, -1, -1, -1],
+    ]
+)
+
+
+class TorchMarchingTetrahedra:
+    """
+    Vectorized isosurface extraction in torch, on the device of the volume and multi-threaded on
+    the CPU. Every cell is split into 6 tetrahedra (marching tetrahedra), which needs far smaller
+    case tables than marching cubes and yields a watertight mesh, but about twice as many
+    triangles. Only the cells whose corners cross the level are processed, and vertices on
+    the grid edges shared by several tetrahedra are merged.
+    """
+
+    name = "torch"
+    device_volumes = True
+
+    @torch.no_grad()
+    def __call__(self, volume, level=0.0, spacing=1.0, mask=None):
+        """See SkimageMarchingCubes.__call__."""
+        device = volume.device
+        shape = torch.tensor(volume.shape, device=device)
+        above = volume > level
+
+        # Cells whose 8 corners are neither all above nor all below the level.
+        corners = [
+            tuple(slice(offset, offset - 1 or None) for offset in corner)
+            for corner in itertools.product((0, 1), repeat=3)
+        ]
+        any_above = torch.zeros_like(above[:-1, :-1, :-1])
+        all_above = torch.ones_like(any_above)
+        for corner in corners:
+            any_above |= above[corner]
+            all_above &= above[corner]
+        crossing = any_above & ~all_above
+        del any_above, all_above
+        if mask is not None:
+            mask = mask.to(device)
+            for corner in corners:
+                crossing &= mask[corner]
+        cells = crossing.reshape(-1).nonzero().squeeze(1)
+        del crossing
+        if cells.shape[0] == 0:
+            raise ValueError("Surface level must be within volume data range.")
+        # Flat indices of the lower corners of the cells in the volume.
+        cell_shape = shape - 1
+        cells = unravel(cells, cell_shape).long()
+        strides = torch.stack([shape[1] * shape[2], shape[2], torch.ones_like(shape[2])])
+        cells = cells @ strides
+
+        # Flat offsets of the tetrahedron corners and edge ends from the lower corner of the cell,
+        # and the direction of the edges (the 3 bits of the axes they step along).
+        tet_corners, tet_edges = TET_CORNERS.to(device), TET_EDGES.to(device)
+        corner_offsets = tet_corners @ strides
+        edge_starts = corner_offsets[:, tet_edges[:, 0]]
+        edge_ends = corner_offsets[:, tet_edges[:, 1]]
+        edge_directions = (
+            (tet_corners[:, tet_edges[:, 1]] - tet_corners[:, tet_edges[:, 0]]) * torch.tensor([4, 2, 1], device=device)
+        ).sum(-1)
+
+        flat_volume = volume.reshape(-1)
+        tet_values = flat_volume[cells[:, None, None] + corner_offsets]
+        cases = ((tet_values > level).long() << torch.arange(4, device=device)).sum(-1)
+        del tet_values
+        cell_index, tet = ((cases > 0) & (cases < 15)).nonzero(as_tuple=True)
+        triangles = TET_TRIANGLES.to(device)[cases[cell_index, tet]]
+
+        # Faces as tetrahedron edges, flipping the winding of the odd tetrahedra.
+        triangle_index, slot = (triangles[:, ::3] >= 0).nonzero(as_tuple=True)
+        face_edges = triangles.reshape(-1, 2, 3)[triangle_index, slot]
+        cell_index, tet = cells[cell_index[triangle_index]], tet[triangle_index]
+        flipped = TET_FLIPPED.to(device)[tet]
+        face_edges[flipped] = face_edges[flipped][:, [0, 2, 1]]
+
+        # Edges shared by several tetrahedra are identified by their lower end and direction.
+        starts = cell_index[:, None] + edge_starts[tet[:, None], face_edges]
+        keys = starts * 8 + edge_directions[tet[:, None], face_edges]
+        unique_keys, faces = torch.unique(keys.reshape(-1), return_inverse=True)
+        faces = faces.reshape(-1, 3)
+
+        # One vertex per crossed edge, interpolated linearly between its end points.
+        first = torch.zeros_like(unique_keys)
+        first.scatter_(0, faces.reshape(-1), torch.arange(keys.numel(), device=device))
+        ends = (cell_index[:, None] + edge_ends[tet[:, None], face_edges]).reshape(-1)[first]
+        starts = starts.reshape(-1)[first]
+        t = ((level - flat_volume[starts]) / (flat_volume[ends] - flat_volume[starts])).unsqueeze(1)
+        verts = (unravel(starts, shape) * (1 - t) + unravel(ends, shape) * t) * spacing
+
+        return verts.float().cpu().numpy(), faces.int().cpu().numpy()
+
+
+def unravel(flat_index, shape):
+    return torch.stack(
+        [flat_index // (shape[1] * shape[2]), (flat_index // shape[2]) % shape[1], flat_index % shape[2]], dim=1
+    ).float()
+
+
+isosurface_backends = {SkimageMarchingCubes.name: SkimageMarchingCubes, TorchMarchingTetrahedra.name: TorchMarchingTetrahedra}
+
+
+def get_isosurface_backend(backend=None):
+    """
+    Returns the isosurface extraction backend called `backend` ("skimage" or "torch", scikit-image
+    if None). Backend instances are returned unchanged.
+    """
+    if backend is None:
+        backend = SkimageMarchingCubes.name
+    if not isinstance(backend, str):
+        return backend
+    if backend not in isosurface_backends:
+        raise ValueError(f"Unknown isosurface backend '{backend}', choose one of {list(isosurface_backends)}")
+    return isosurface_backends[backend]()
@@ -14,9 +14,8 @@ class SNNLoss(nn.Module):
         self.STABILITY_EPS = 0.00001
 
     def forward(self, x, y):
-        x = x.to('cuda')
         b = x.size(0)  # Batch size
-        y = y.squeeze()
+        y = y.to(x.device).squeeze()
 
         x_expanded = x[:,0].unsqueeze(1)
           # Expand dimensions for broadcasting
@@ -26,18 +25,18 @@ class SNNLoss(nn.Module):
 
         squared_distances = (x_expanded - x_expanded.t()) ** 2
         exp_distances = torch.exp(-(squared_distances / self.T))
-        exp_distances = exp_distances * (1 - torch.eye(b, device='cuda'))
+        exp_distances = exp_distances * (1 - torch.eye(b, device=x.device))
         #print(exp_distances)
 
         numerator = exp_distances * same_class_mask
         denominator = exp_distances
         # remaining elements
-        exp_distances_all = torch.zeros_like(exp_distances, device='cuda')
+        exp_distances_all = torch.zeros_like(exp_distances, device=x.device)
         for i in range(1, x.shape[1]):
             x_expanded = x[:,i].unsqueeze(1)
             squared_distances = (x_expanded - x_expanded.t()) ** 2
             exp_distances = torch.exp(-(squared_distances / self.T))
-            exp_distances = exp_distances * (1 - torch.eye(b, device='cuda'))
+            exp_distances = exp_distances * (1 - torch.eye(b, device=x.device))
             exp_distances = exp_distances * same_class_mask
             exp_distances_all = exp_distances_all + exp_distances
 
@@ -58,9 +57,8 @@ class SNNRegLoss(nn.Module):
         self.threshold = threshold
 
     def forward(self, x, y):
-        x = x.to('cuda')
         b = x.size(0)  # Batch size
-        y = y.squeeze()
+        y = y.to(x.device).squeeze()
 
         x_expanded = x[:,1].unsqueeze(1)  # Expand dimensions for broadcasting
         y_expanded = y.unsqueeze(0)
@@ -70,17 +68,17 @@ class SNNRegLoss(nn.Module):
 
         squared_distances = (x_expanded - x_expanded.t()) ** 2
         exp_distances = torch.exp(-(squared_distances / self.T))
-        exp_distances = exp_distances * (1 - torch.eye(b, device='cuda'))
+        exp_distances = exp_distances * (1 - torch.eye(b, device=x.device))
         #print(exp_distances)
 
         numerator = exp_distances * same_class_mask
         denominator = exp_distances
         # remaining elements
-        exp_distances_all = torch.zeros_like(exp_distances, device='cuda')
+        exp_distances_all = torch.zeros_like(exp_distances, device=x.device)
         x_expanded = x[:,0].unsqueeze(1)
         squared_distances = (x_expanded - x_expanded.t()) ** 2
         exp_distances = torch.exp(-(squared_distances / self.T))
-        exp_distances = exp_distances * (1 - torch.eye(b, device='cuda'))
+        exp_distances = exp_distances * (1 - torch.eye(b, device=x.device))
         exp_distances = exp_distances * same_class_mask
         exp_distances_all = exp_distances_all + exp_distances
         for i in range(2, x.shape[1]):
@@ -88,7 +86,7 @@ class SNNRegLoss(nn.Module):
             squared_distances = (x_expanded - x_expanded.t()) ** 2
             exp_distances = torch.exp(-(squared_distances / self.T))
             exp_distances = exp_distances
-            exp_distances = exp_distances * (1 - torch.eye(b, device='cuda'))
+            exp_distances = exp_distances * (1 - torch.eye(b, device=x.device))
             exp_distances = exp_distances * same_class_mask
             exp_distances_all = exp_distances_all + exp_distances
 
@@ -99,7 +97,61 @@ class SNNRegLoss(nn.Module):
 
         return lsn_loss
 
-    
+
+# SNNL loss fused over the latent dimensions
+class FusedSNNLoss(nn.Module):
+    """
+    Computes SNNLoss (threshold=None, dim=0) or SNNRegLoss (threshold set, dim=1) with the
+    per-dimension distance kernels of all latent dimensions in one batched b x b x D op.
+    chunk_size limits the number of dimensions per op to bound the memory.
+    The off-diagonal mask of the most recent batch size and device is kept, so one instance
+    should be reused across iterations.
+    """
+
+    def __init__(self, T, threshold=None, dim=None, chunk_size=None):
+        super(FusedSNNLoss, self).__init__()
+        self.T = T
+        self.STABILITY_EPS = 0.00001
+        self.threshold = threshold
+        self.dim = dim if dim is not None else (0 if threshold is None else 1)
+        self.chunk_size = chunk_size
+        self._off_diagonal = None
+
+    def off_diagonal(self, b, device):
+        mask = self._off_diagonal
+        if mask is None or mask.shape[0] != b or mask.device != device:
+            mask = self._off_diagonal = 1 - torch.eye(b, device=device)
+        return mask
+
+    def forward(self, x, y):
+        b, D = x.shape
+        y = y.to(x.device).reshape(b)
+
+        if self.threshold is None:
+            same_class_mask = y.unsqueeze(0) == y.unsqueeze(1)
+        else:
+            same_class_mask = torch.abs(y.unsqueeze(0) - y.unsqueeze(1)) <= self.threshold
+
+        # b x b sum of the kernels of all dimensions but self.dim
+        x_main = x[:, self.dim]
+        x_rest = torch.cat((x[:, :self.dim], x[:, self.dim + 1:]), dim=1)
+        chunk_size = self.chunk_size or D
+        exp_distances_all = 0
+        for x_chunk in x_rest.split(chunk_size, dim=1):
+            squared_distances = (x_chunk.unsqueeze(1) - x_chunk.unsqueeze(0)) ** 2
+            exp_distances_all = exp_distances_all + torch.exp(-(squared_distances / self.T)).sum(dim=2)
+
+        off_diagonal = self.off_diagonal(b, x.device)
+        exp_distances = torch.exp(-((x_main.unsqueeze(1) - x_main.unsqueeze(0)) ** 2 / self.T)) * off_diagonal
+        numerator = exp_distances * same_class_mask
+        denominator = exp_distances
+        denominator1 = exp_distances_all * off_diagonal * same_class_mask / float(D - 1)
+
+        lsn_loss = -torch.log(self.STABILITY_EPS + (numerator.sum(dim=1) / (self.STABILITY_EPS + (0.5*denominator.sum(dim=1)) + (0.5*denominator1.sum(dim=1))))).mean()
+
+        return lsn_loss
+
+
 # Attribute VAE loss
 class AttributeLoss(nn.Module):
     def __init__(self, factor=1.0):
@@ -109,7 +161,7 @@ class AttributeLoss(nn.Module):
 
     def forward(self, latent_code, attribute):
         # compute latent distance matrix
-        latent_code = latent_code.to('cuda')
+        attribute = attribute.to(latent_code.device)
         latent_code = latent_code.view(-1, 1).repeat(1, latent_code.shape[0])
         lc_dist_mat = (latent_code - latent_code.transpose(1, 0)).view(-1, 1)
 
@@ -308,7 +360,7 @@ class SNNLCrossEntropy():
         :returns: A tensor for the row normalized exponentiated pairwise distance
                   between all the elements of x.
         """
-        f = SNNLCrossEntropy.fits(x, x, temp, cos_distance) - torch.eye(x.shape[0], device='cuda')
+        f = SNNLCrossEntropy.fits(x, x, temp, cos_distance) - torch.eye(x.shape[0], device=x.device)
         return f / (SNNLCrossEntropy.STABILITY_EPS + f.sum(axis=1).unsqueeze(1))
     
     @staticmethod
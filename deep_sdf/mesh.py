@@ -3,131 +3,380 @@
 
 import logging
 import numpy as np
-import plyfile
-import skimage.measure
 import time
 import torch
-from typing import Optional
+from typing import List, Optional, Tuple
 import trimesh
 import os
 import subprocess
 import math
 from trimesh import creation, transformations
-import tempfile
+import itertools
+import concurrent.futures
 
 from deep_sdf import utils
+from deep_sdf.isosurface import get_isosurface_backend
 
 
-def create_mesh(decoder, latent_vec, filename=None, N=256, max_batch=32 ** 3, offset=None, scale=None, return_trimesh=False) -> Optional[trimesh.Trimesh]:
+@torch.no_grad()
+def create_mesh(decoder, latent_vec, filename=None, N=256, max_batch=32 ** 3, offset=None, scale=None, return_trimesh=False, device=None, refinement_levels=0, backend=None, use_compile=True) -> Optional[trimesh.Trimesh]:
     """Creates a mesh given the trained decoder and latent code by
     1. Sampling xyz query points
     2. Retrieving the SDF predictions
     3. Running marching cubes to get mesh vertices and faces.
     
     With settings N=256 and max_batch=int(2 ** 18) this takes about 10sec on GPU and 100sec on the CPU.
+    The queries are evaluated on `device`, which defaults to the device of the decoder.
+
+    If refinement_levels > 0, the SDF is evaluated coarse-to-fine (see get_sdf_grid_coarse_to_fine)
+    instead of densely, which only queries the decoder close to the surface.
+
+    `backend` selects the isosurface extraction (see isosurface.get_isosurface_backend). Backends
+    that run in torch get the dense volume on `device`, without copying it to the host.
+
+    The decoder is compiled for the queries (see utils.compile_decoder) unless `use_compile` is False.
     """
     start = time.time()
     ply_filename = filename
 
     decoder.eval()
+    decoder = utils.compile_decoder(decoder, use_compile)
+
+    if device is None:
+        device = utils.get_module_device(decoder)
+    if latent_vec is not None:
+        latent_vec = latent_vec.to(device)
+    backend = get_isosurface_backend(backend)
 
     # NOTE: the voxel_origin is actually the (bottom, left, down) corner, not the middle
     voxel_origin = [-1, -1, -1]
     voxel_size = 2.0 / (N - 1)
 
-    overall_index = torch.arange(0, N ** 3, 1, out=torch.LongTensor())
-    samples = torch.zeros(N ** 3, 4)
-    
-    # transform first 3 columns
-    # to be the x, y, z index
-    samples[:, 2] = overall_index % N
-    samples[:, 1] = (overall_index.long() / N) % N
-    samples[:, 0] = ((overall_index.long() / N) / N) % N
-
-    # transform first 3 columns
-    # to be the x, y, z coordinate
-    samples[:, 0] = (samples[:, 0] * voxel_size) + voxel_origin[2]
-    samples[:, 1] = (samples[:, 1] * voxel_size) + voxel_origin[1]
-    samples[:, 2] = (samples[:, 2] * voxel_size) + voxel_origin[0]
+    if refinement_levels > 0:
+        sdf_values, mask, num_queries = get_sdf_grid_coarse_to_fine(
+            decoder, latent_vec, N, voxel_origin, voxel_size, refinement_levels, max_batch, device
+        )
+    else:
+        num_queries = N ** 3
+        mask = None
 
-    num_samples = N ** 3
+        # Preallocated output volume, the query coordinates are generated per batch.
+        volume_device = device if backend.device_volumes else torch.device("cpu")
+        sdf_values = torch.empty(num_queries, dtype=torch.float32, device=volume_device)
+
+        for head, tail, sample_subset in get_grid_queries(N, voxel_origin, voxel_size, max_batch, device):
+            sdf_values[head:tail] = (
+                utils.decode_sdf(decoder, latent_vec, sample_subset)
+                .squeeze(1)
+                .detach()
+                .to(volume_device)
+            )
+
+        sdf_values = sdf_values.reshape(N, N, N)
+
+    end = time.time()
+    logging.debug("[create_mesh] sampling %d queries takes: %f" % (num_queries, end - start))
+
+    mesh = convert_sdf_samples_to_mesh(
+        sdf_values,
+        voxel_origin,
+        voxel_size,
+        offset,
+        scale,
+        mask,
+        backend,
+    )
+    if mesh is None:
+        return None
+
+    if ply_filename:
+        write_ply(ply_filename + ".ply", *mesh)
+
+    if return_trimesh:
+        # Built from the marching cubes output directly, without a round trip through disk.
+        return trimesh.Trimesh(vertices=mesh[0], faces=mesh[1])
+
+
+@torch.no_grad()
+def create_meshes(
+    decoder,
+    latent_vecs,
+    filenames=None,
+    N=256,
+    max_batch=32 ** 3,
+    offsets=None,
+    scales=None,
+    return_trimesh=False,
+    device=None,
+    shapes_per_batch=8,
+    backend=None,
+    use_compile=True,
+    refinement_levels=0,
+) -> List[Optional[trimesh.Trimesh]]:
+    """Creates meshes for several latent codes like create_mesh, but
+    1. evaluates the grid queries of `shapes_per_batch` latent codes in a single forward pass and
+    2. runs marching cubes and writes the meshes of one group of shapes in a background
+       thread while the decoder evaluates the next group.
+
+    The dense float32 volumes of a group take shapes_per_batch * N^3 * 4 bytes, and up to two
+    groups are in memory while the previous one is meshed: about 1 GB for the default 8 shapes
+    at N=256. Lower `shapes_per_batch` for larger N.
+
+    If refinement_levels > 0, every shape is evaluated coarse-to-fine like in create_mesh, one
+    shape after another since their queries differ; meshing still overlaps with decoding.
+
+    `filenames`, `offsets` and `scales` are optional per-shape lists. Returns a list with
+    one trimesh (or None) per latent code if return_trimesh is set. `backend` and `use_compile`
+    select the isosurface extraction and compilation like in create_mesh.
+    """
+    start = time.time()
+
+    decoder.eval()
+    decoder = utils.compile_decoder(decoder, use_compile)
+
+    if device is None:
+        device = utils.get_module_device(decoder)
+    latent_vecs = torch.stack([latent_vec.reshape(-1) for latent_vec in latent_vecs]).to(device)
+    backend = get_isosurface_backend(backend)
+    volume_device = device if backend.device_volumes else torch.device("cpu")
+
+    num_shapes = latent_vecs.shape[0]
+    filenames = filenames if filenames is not None else [None] * num_shapes
+    offsets = offsets if offsets is not None else [None] * num_shapes
+    scales = scales if scales is not None else [None] * num_shapes
+
+    # NOTE: the voxel_origin is actually the (bottom, left, down) corner, not the middle
+    voxel_origin = [-1, -1, -1]
+    voxel_size = 2.0 / (N - 1)
 
-    samples.requires_grad = False
+    def extract_mesh(i, sdf_values, mask):
+        mesh = convert_sdf_samples_to_mesh(
+            sdf_values, voxel_origin, voxel_size, offsets[i], scales[i], mask, backend
+        )
+        if mesh is None:
+            return None
+        if filenames[i]:
+            write_ply(filenames[i] + ".ply", *mesh)
+        if return_trimesh:
+            return trimesh.Trimesh(vertices=mesh[0], faces=mesh[1])
+
+    meshes = [None] * num_shapes
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        pending = []
+        for first in range(0, num_shapes, shapes_per_batch):
+            group = latent_vecs[first : first + shapes_per_batch]
+            if refinement_levels > 0:
+                grids = [
+                    get_sdf_grid_coarse_to_fine(
+                        decoder, latent_vec, N, voxel_origin, voxel_size, refinement_levels, max_batch, device
+                    )[:2]
+                    for latent_vec in group
+                ]
+            else:
+                sdf_values = decode_sdf_grids(
+                    decoder, group, N, voxel_origin, voxel_size, max_batch, device, volume_device
+                )
+                grids = [(sdf_values[k], None) for k in range(sdf_values.shape[0])]
+                del sdf_values
+            # Wait for the previous group, so at most two groups of volumes are in memory.
+            for i, future in pending:
+                meshes[i] = future.result()
+            pending = [
+                (first + k, executor.submit(extract_mesh, first + k, sdf_values, mask))
+                for k, (sdf_values, mask) in enumerate(grids)
+            ]
+            del grids
+        for i, future in pending:
+            meshes[i] = future.result()
+
+    seconds = time.time() - start
+    logging.info(
+        "[create_meshes] created {} meshes in {:.2f} s ({:.0f} shapes/hour)".format(
+            num_shapes, seconds, num_shapes / seconds * 3600
+        )
+    )
+    if return_trimesh:
+        return meshes
+
+
+def decode_sdf_grids(decoder, latent_vecs, N, voxel_origin, voxel_size, max_batch, device, volume_device=None):
+    """
+    Evaluates the N x N x N grid for all K latent codes in `latent_vecs` (K x L). Every forward
+    pass holds the same grid queries for all latent codes, max_batch points in total.
+    Returns a (K, N, N, N) tensor on `volume_device`, the host by default.
+    """
+    num_shapes = latent_vecs.shape[0]
+    volume_device = torch.device("cpu") if volume_device is None else volume_device
+    sdf_values = torch.empty(num_shapes, N ** 3, dtype=torch.float32, device=volume_device)
+    points_per_shape = max(1, max_batch // num_shapes)
+
+    for head, tail, xyz in get_grid_queries(N, voxel_origin, voxel_size, points_per_shape, device):
+        xyz = xyz.unsqueeze(0).expand(num_shapes, -1, -1)
+        sdf_values[:, head:tail] = decoder(latent_vecs, xyz).reshape(num_shapes, tail - head).detach().to(volume_device)
+
+    return sdf_values.reshape(num_shapes, N, N, N)
+
+
+def get_grid_queries(N, voxel_origin, voxel_size, max_batch, device=None):
+    """
+    Lazily generates the query points of an N x N x N grid in batches of at most
+    `max_batch` points. Yields tuples (head, tail, xyz) where xyz holds the
+    coordinates of the flattened grid indices [head, tail) in C order, i.e. the
+    last coordinate varies fastest. Only the current batch is kept in memory.
+    """
+    device = torch.device("cpu") if device is None else device
+    num_samples = N ** 3
 
-    head = 0
+    # Coordinates along each axis, looked up by the integer grid indices.
+    axis = torch.arange(N, dtype=torch.float32, device=device) * voxel_size
+    axes = [axis + voxel_origin[2], axis + voxel_origin[1], axis + voxel_origin[0]]
+
+    for head in range(0, num_samples, max_batch):
+        tail = min(head + max_batch, num_samples)
+        index = torch.arange(head, tail, dtype=torch.long, device=device)
+        xyz = torch.stack(
+            [
+                axes[0][index // (N * N)],
+                axes[1][(index // N) % N],
+                axes[2][index % N],
+            ],
+            dim=1,
+        )
+        yield head, tail, xyz
 
-    while head < num_samples:
-        sample_subset = samples[head : min(head + max_batch, num_samples), 0:3].cuda()
 
-        samples[head : min(head + max_batch, num_samples), 3] = (
-            utils.decode_sdf(decoder, latent_vec, sample_subset)
+def decode_sdf_batched(decoder, latent_vec, queries, max_batch, device):
+    """Decodes the (K, 3) host tensor `queries` in batches and returns the SDF values on the host."""
+    sdf_values = torch.empty(queries.shape[0], dtype=torch.float32)
+    for head in range(0, queries.shape[0], max_batch):
+        sdf_values[head : head + max_batch] = (
+            utils.decode_sdf(decoder, latent_vec, queries[head : head + max_batch].to(device))
             .squeeze(1)
             .detach()
             .cpu()
         )
-        head += max_batch
+    return sdf_values
 
-    sdf_values = samples[:, 3]
-    sdf_values = sdf_values.reshape(N, N, N)
 
-    end = time.time()
-    logging.debug("[create_mesh] sampling takes: %f" % (end - start))
+# Offsets of the 8 corners of a cell and of the 27 points of a cell subdivided into 8 children.
+CELL_CORNERS = torch.tensor(list(itertools.product((0, 1), repeat=3)))
+CELL_SUBDIVISION = torch.tensor(list(itertools.product((0, 1, 2), repeat=3)))
 
-    tmpdirname = None
-    if not ply_filename: 
-        tmpdirname = tempfile.TemporaryDirectory()
-        ply_filename = os.path.join(tmpdirname.name, "create_mesh_ply")
 
-    success = convert_sdf_samples_to_ply(
-        sdf_values.data.cpu(),
-        voxel_origin,
-        voxel_size,
-        ply_filename + ".ply",
-        offset,
-        scale,
-    )
-    if return_trimesh and success:
-        mesh = utils.as_mesh(trimesh.load(ply_filename + ".ply"))
-        if tmpdirname: 
-            tmpdirname.cleanup()
-        return mesh
+def get_sdf_grid_coarse_to_fine(decoder, latent_vec, N, voxel_origin, voxel_size, levels, max_batch, device):
+    """
+    Evaluates the SDF on an N x N x N grid coarse-to-fine. The decoder is first queried on a
+    grid with a stride of 2**levels voxels. On every finer level, only the cells whose corner
+    values change sign or come closer to the surface than the cell diagonal are subdivided and
+    queried. All other grid values are trilinearly interpolated from the coarser level, which
+    keeps their sign consistent.
 
+    Note that decoders trained with a clamped SDF never predict values above the clamping distance,
+    so cells with a diagonal longer than that are always refined.
 
-def convert_sdf_samples_to_ply(
+    Returns the (N, N, N) volume, a boolean (N, N, N) mask of the grid points around the surface
+    that can be passed to marching cubes and the number of decoder queries.
+    """
+    stride = 2 ** levels
+    # The coarse grid is padded so that its stride divides the (padded) fine grid.
+    size = math.ceil((N - 1) / stride) + 1
+
+    def get_lattice_queries(flat_index, size, step):
+        index = torch.stack(
+            [flat_index // (size * size), (flat_index // size) % size, flat_index % size], dim=1
+        )
+        return index.float() * step * voxel_size + torch.tensor(
+            [voxel_origin[2], voxel_origin[1], voxel_origin[0]], dtype=torch.float32
+        )
+
+    def to_flat_index(index, size):
+        return (index[:, 0] * size + index[:, 1]) * size + index[:, 2]
+
+    num_queries = size ** 3
+    volume = decode_sdf_batched(
+        decoder, latent_vec, get_lattice_queries(torch.arange(num_queries), size, stride), max_batch, device
+    ).reshape(size, size, size)
+
+    # Lower corners of all cells on the coarsest level.
+    cells = torch.stack(
+        torch.meshgrid(*[torch.arange(size - 1)] * 3, indexing="ij"), dim=-1
+    ).reshape(-1, 3)
+
+    for level in range(levels, -1, -1):
+        step = 2 ** level
+        flat_volume = volume.reshape(-1)
+
+        corner_values = torch.stack(
+            [flat_volume[to_flat_index(cells + corner, size)] for corner in CELL_CORNERS], dim=1
+        )
+        keep = (corner_values.min(dim=1)[0] <= 0) & (corner_values.max(dim=1)[0] >= 0)
+        if level > 0:
+            cell_diagonal = math.sqrt(3) * step * voxel_size
+            keep |= corner_values.abs().min(dim=1)[0] < cell_diagonal
+        cells = cells[keep]
+        del corner_values, keep
+
+        if level == 0:
+            break
+
+        # Upsample to the next level and query the new points of the kept cells.
+        size = 2 * size - 1
+        volume = torch.nn.functional.interpolate(
+            volume[None, None], size=(size,) * 3, mode="trilinear", align_corners=True
+        )[0, 0]
+        new_points = torch.zeros(size ** 3, dtype=torch.bool)
+        for offset in CELL_SUBDIVISION:
+            if (offset % 2).any():
+                new_points[to_flat_index(2 * cells + offset, size)] = True
+        new_points = new_points.nonzero().squeeze(1)
+        volume.view(-1)[new_points] = decode_sdf_batched(
+            decoder, latent_vec, get_lattice_queries(new_points, size, step // 2), max_batch, device
+        )
+        num_queries += new_points.shape[0]
+        del new_points
+
+        cells = (2 * cells[:, None, :] + CELL_CORNERS).reshape(-1, 3)
+
+    mask = torch.zeros(size ** 3, dtype=torch.bool)
+    for corner in CELL_CORNERS:
+        mask[to_flat_index(cells + corner, size)] = True
+    mask = mask.reshape(size, size, size)
+
+    return volume[:N, :N, :N].contiguous(), mask[:N, :N, :N].contiguous(), num_queries
+
+
+def convert_sdf_samples_to_mesh(
     pytorch_3d_sdf_tensor,
     voxel_grid_origin,
     voxel_size,
-    ply_filename_out,
     offset=None,
     scale=None,
-) -> bool:
+    mask=None,
+    backend=None,
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
     """
-    Convert sdf samples to .ply
+    Run marching cubes on sdf samples.
 
     :param pytorch_3d_sdf_tensor: a torch.FloatTensor of shape (n,n,n)
     :voxel_grid_origin: a list of three floats: the bottom, left, down origin of the voxel grid
     :voxel_size: float, the size of the voxels
-    :ply_filename_out: string, path of the filename to save to
+    :mask: optional torch.BoolTensor of shape (n,n,n), marching cubes is only run where it is set
+    :backend: the isosurface extraction, scikit-image by default (see isosurface.get_isosurface_backend)
+
+    Returns the float32 vertices and int32 faces of the mesh or None if no surface was found.
 
     This function adapted from: https://github.com/RobotLocomotion/spartan
     """
     start_time = time.time()
 
-    numpy_3d_sdf_tensor = pytorch_3d_sdf_tensor.numpy()
-
     try:
-        verts, faces, normals, values = skimage.measure.marching_cubes(
-            numpy_3d_sdf_tensor, level=0.0, spacing=[voxel_size] * 3, method="lewiner"
-        )
-    except ValueError as e:
+        verts, faces = get_isosurface_backend(backend)(pytorch_3d_sdf_tensor, level=0.0, spacing=voxel_size, mask=mask)
+    except (ValueError, RuntimeError) as e:
         logging.error(f"[create_mesh] Caught marching cubes error: {e}.")
-        return False
+        return None
     # transform from voxel coordinates to camera coordinates
     # note x and y are flipped in the output of marching_cubes
-    mesh_points = np.zeros_like(verts)
-    mesh_points[:, 0] = voxel_grid_origin[0] + verts[:, 0]
-    mesh_points[:, 1] = voxel_grid_origin[1] + verts[:, 1]
-    mesh_points[:, 2] = voxel_grid_origin[2] + verts[:, 2]
+    mesh_points = verts + np.asarray(voxel_grid_origin, dtype=verts.dtype)
 
     # apply additional offset and scale
     if scale is not None:
@@ -135,33 +384,74 @@ def convert_sdf_samples_to_ply(
     if offset is not None:
         mesh_points = mesh_points - offset
 
-    # try writing to the ply file
-
-    num_verts = verts.shape[0]
-    num_faces = faces.shape[0]
-
-    verts_tuple = np.zeros((num_verts,), dtype=[("x", "f4"), ("y", "f4"), ("z", "f4")])
+    logging.debug(
+        "[create_mesh] marching cubes took {} s".format(time.time() - start_time)
+    )
+    return mesh_points.astype(np.float32), faces.astype(np.int32)
 
-    for i in range(0, num_verts):
-        verts_tuple[i] = tuple(mesh_points[i, :])
 
-    faces_building = []
-    for i in range(0, num_faces):
-        faces_building.append(((faces[i, :].tolist(),)))
-    faces_tuple = np.array(faces_building, dtype=[("vertex_indices", "i4", (3,))])
+def write_ply(ply_filename_out, verts, faces):
+    """
+    Write a triangle mesh to a binary .ply file in one go from the (V, 3) vertex
+    and (F, 3) face arrays, without any per-element Python work. The layout matches
+    the one written by plyfile: float x, y, z and a uchar-sized list of int indices.
+    """
+    start_time = time.time()
 
-    el_verts = plyfile.PlyElement.describe(verts_tuple, "vertex")
-    el_faces = plyfile.PlyElement.describe(faces_tuple, "face")
+    verts = np.ascontiguousarray(verts, dtype="<f4")
+    faces_record = np.empty(faces.shape[0], dtype=[("count", "u1"), ("vertex_indices", "<i4", (3,))])
+    faces_record["count"] = 3
+    faces_record["vertex_indices"] = faces
+
+    header = (
+        "ply\n"
+        "format binary_little_endian 1.0\n"
+        f"element vertex {verts.shape[0]}\n"
+        "property float x\n"
+        "property float y\n"
+        "property float z\n"
+        f"element face {faces.shape[0]}\n"
+        "property list uchar int vertex_indices\n"
+        "end_header\n"
+    )
 
-    ply_data = plyfile.PlyData([el_verts, el_faces])
     logging.debug("[create_mesh] saving mesh to %s" % (ply_filename_out))
-    ply_data.write(ply_filename_out)
+    with open(ply_filename_out, "wb") as f:
+        f.write(header.encode("ascii"))
+        f.write(verts.tobytes())
+        f.write(faces_record.tobytes())
 
     logging.debug(
-        "[create_mesh] converting to ply format and writing to file took {} s".format(
-            time.time() - start_time
-        )
+        "[create_mesh] writing to ply file took {} s".format(time.time() - start_time)
     )
+
+
+def convert_sdf_samples_to_ply(
+    pytorch_3d_sdf_tensor,
+    voxel_grid_origin,
+    voxel_size,
+    ply_filename_out,
+    offset=None,
+    scale=None,
+    mask=None,
+    backend=None,
+) -> bool:
+    """
+    Convert sdf samples to .ply
+
+    :param pytorch_3d_sdf_tensor: a torch.FloatTensor of shape (n,n,n)
+    :voxel_grid_origin: a list of three floats: the bottom, left, down origin of the voxel grid
+    :voxel_size: float, the size of the voxels
+    :ply_filename_out: string, path of the filename to save to
+    :mask: optional torch.BoolTensor of shape (n,n,n), marching cubes is only run where it is set
+    :backend: the isosurface extraction, scikit-image by default (see isosurface.get_isosurface_backend)
+    """
+    mesh = convert_sdf_samples_to_mesh(
+        pytorch_3d_sdf_tensor, voxel_grid_origin, voxel_size, offset, scale, mask, backend
+    )
+    if mesh is None:
+        return False
+    write_ply(ply_filename_out, *mesh)
     return True
 
 
@@ -195,9 +485,9 @@ def get_SDFGen_voxels(
     os.remove(os.path.join(shapenet_path, class_id, shape_id, "models/normalized_unit.vti"))
     return {"voxel_size": voxel_size, "padding": padding, "voxels": voxels, "centroid": centroid, "scale": scale}
 
-def get_mesh_from_SDFGen_voxels(voxels, voxel_size, centroid, scale):
-    verts, faces, normals, _ = skimage.measure.marching_cubes(voxels, level=voxel_size/2, method="lewiner")
-    recon = trimesh.Trimesh(verts, faces, vertex_normals=normals)
+def get_mesh_from_SDFGen_voxels(voxels, voxel_size, centroid, scale, backend=None):
+    verts, faces = get_isosurface_backend(backend)(torch.from_numpy(voxels), level=voxel_size/2)
+    recon = trimesh.Trimesh(verts, faces)
     recon = utils.scale_to_unit_cube(recon)
     recon = utils.rescale_unit_mesh(recon, shift=centroid, scale=scale)
     return recon, voxel_size/2
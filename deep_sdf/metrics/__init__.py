@@ -1,24 +1,36 @@
 import os
 import trimesh
-from deep_sdf.metrics.chamfer import compute_chamfer
+from deep_sdf.metrics.backends import get_backend
+from deep_sdf.metrics.chamfer import compute_chamfer, compute_hausdorff, compute_trimesh_iou
+from deep_sdf.metrics.emd import sliced_emd
+from deep_sdf.metrics.gt_cache import get_gt_points
 from deep_sdf.metrics.mesh_normal_consistency import compute_mesh_normal_consistency
 from deep_sdf.utils import as_mesh
-import point_cloud_utils as pcu
 
 
-def compute_metric(gt_mesh=None, gen_mesh=None, num_mesh_samples=30000, metric="chamfer"):
-    if gt_mesh is not None and isinstance(gt_mesh, str):
-        gt_mesh = as_mesh(trimesh.load_mesh(gt_mesh))
+def compute_metric(gt_mesh=None, gen_mesh=None, num_mesh_samples=30000, metric="chamfer", backend=None):
+    """
+    If `gt_mesh` is a filename, the points sampled from it and their KD-tree are cached (see
+    gt_cache), so evaluating the same shapes again neither reloads nor resamples them. `backend`
+    selects how the Chamfer and Hausdorff distances are computed (see backends.get_backend).
+    """
     if gen_mesh is not None and isinstance(gen_mesh, str):
         gen_mesh = as_mesh(trimesh.load_mesh(gen_mesh))
         
-    if gt_mesh is not None and gen_mesh is not None:
+    if gt_mesh is not None and gen_mesh is not None and metric == "iou":
+        return compute_trimesh_iou(gt_mesh, gen_mesh)
+    elif gt_mesh is not None and gen_mesh is not None:
         gen_points_sampled = trimesh.sample.sample_surface(gen_mesh, num_mesh_samples)[0]
-        gt_points_sampled = trimesh.sample.sample_surface(gt_mesh, num_mesh_samples)[0]
+        if isinstance(gt_mesh, str):
+            gt_points_sampled, gt_kd_tree = get_gt_points(gt_mesh, num_mesh_samples)
+        else:
+            gt_points_sampled, gt_kd_tree = trimesh.sample.sample_surface(gt_mesh, num_mesh_samples)[0], None
         if metric == "chamfer": 
-            return compute_chamfer(gen_points_sampled, gt_points_sampled)
+            return compute_chamfer(gen_points_sampled, gt_points_sampled, gt_kd_tree, backend)
         elif metric == "hausdorff":
-            return pcu.hausdorff_distance(gen_points_sampled, gt_points_sampled)
+            return compute_hausdorff(gen_points_sampled, gt_points_sampled, gt_kd_tree, backend)
+        elif metric == "emd":
+            return sliced_emd(gen_points_sampled, gt_points_sampled)
     elif metric == "normal_consistency":
         return compute_mesh_normal_consistency(gen_mesh)
     else:
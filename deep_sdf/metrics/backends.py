@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import numpy as np
+import torch
+from scipy.spatial import cKDTree as KDTree
+
+
+class KDTreeBackend:
+    """
+    Nearest neighbor distances with scipy KD-trees, the reference implementation. Every query runs
+    on `workers` threads (all cores if -1), and the pairs of a batch are spread over a pool of
+    `pool_size` threads (one per core if None), which reuse the cached GT trees.
+    """
+
+    name = "kdtree"
+
+    def __init__(self, workers=1, pool_size=None):
+        self.workers = workers
+        self.pool_size = pool_size
+
+    def nearest_distances(self, queries, points, points_kd_tree=None):
+        """Returns the distance of every query point to its nearest neighbor in `points`."""
+        if points_kd_tree is None:
+            points_kd_tree = KDTree(points)
+        return points_kd_tree.query(queries, workers=self.workers)[0]
+
+    def batch_nearest_distances(self, queries, points, points_kd_trees=None):
+        """Runs `nearest_distances` for every pair of query and point sets."""
+        if points_kd_trees is None:
+            points_kd_trees = [None] * len(points)
+        with concurrent.futures.ThreadPoolExecutor(self.pool_size) as executor:
+            return list(executor.map(self.nearest_distances, queries, points, points_kd_trees))
+
+
+class TorchBackend:
+    """
+    Brute-force nearest neighbor distances with blocked matrix products on `device`, multi-threaded
+    on the CPU. The distance matrix is computed for at most `block_size` elements at a time
+    (2^20 on the CPU to stay in cache, 2^26 on the GPU). The nearest neighbors are found with the
+    matrix product form of the squared distance, and their distances are then recomputed exactly,
+    so they match the KD-tree up to float32 rounding. Pairs of a batch with equally many points
+    are processed together.
+    """
+
+    name = "torch"
+
+    def __init__(self, device=None, block_size=None):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        if block_size is None:
+            block_size = 2 ** 26 if self.device.type == "cuda" else 2 ** 20
+        self.block_size = block_size
+
+    def to_tensor(self, points):
+        return torch.as_tensor(np.asarray(points), dtype=torch.float32, device=self.device)
+
+    @torch.no_grad()
+    def nearest_tensor_distances(self, queries, points):
+        """Returns the nearest neighbor distances of the B x N x 3 `queries` in the B x M x 3 `points`."""
+        batch_size, num_queries, _ = queries.shape
+        num_points = points.shape[1]
+        step = max(1, self.block_size // (batch_size * num_points))
+        # |q - p|^2 = |q|^2 - 2 q.p + |p|^2, where |q|^2 does not change the nearest neighbor.
+        squared_norms = points.square().sum(2).unsqueeze(1)
+        points_t = points.transpose(1, 2)
+        # All blocks reuse one buffer, allocating a new one per block fragments the CPU heap.
+        products = points.new_empty(batch_size * min(step, num_queries) * num_points)
+        distances = queries.new_empty(batch_size, num_queries)
+        for start in range(0, num_queries, step):
+            block = queries[:, start : start + step]
+            block_products = products[: block.numel() // 3 * num_points].view(batch_size, -1, num_points)
+            torch.baddbmm(squared_norms, block, points_t, alpha=-2, out=block_products)
+            indices = block_products.argmin(dim=2)
+            nearest = torch.gather(points, 1, indices.unsqueeze(2).expand(-1, -1, 3))
+            distances[:, start : start + step] = torch.linalg.norm(block - nearest, dim=2)
+        return distances
+
+    def nearest_distances(self, queries, points, points_kd_tree=None):
+        """Returns the distance of every query point to its nearest neighbor in `points`."""
+        distances = self.nearest_tensor_distances(self.to_tensor(queries)[None], self.to_tensor(points)[None])
+        return distances[0].double().cpu().numpy()
+
+    def batch_nearest_distances(self, queries, points, points_kd_trees=None):
+        """Runs `nearest_distances` for every pair of query and point sets."""
+        if len(set(len(q) for q in queries)) > 1 or len(set(len(p) for p in points)) > 1:
+            return [self.nearest_distances(q, p) for q, p in zip(queries, points)]
+        distances = self.nearest_tensor_distances(
+            torch.stack([self.to_tensor(q) for q in queries]), torch.stack([self.to_tensor(p) for p in points])
+        )
+        return list(distances.double().cpu().numpy())
+
+
+backends = {KDTreeBackend.name: KDTreeBackend, TorchBackend.name: TorchBackend}
+
+
+def get_backend(backend=None, device=None):
+    """
+    Returns the metric backend called `backend` ("kdtree" or "torch", the KD-tree if None), placed
+    on `device` if it is the torch backend. Backend instances are returned unchanged.
+    """
+    if backend is None:
+        backend = KDTreeBackend.name
+    if not isinstance(backend, str):
+        return backend
+    if backend not in backends:
+        raise ValueError(f"Unknown metric backend '{backend}', choose one of {list(backends)}")
+    if backend == TorchBackend.name:
+        return TorchBackend(device)
+    return backends[backend]()
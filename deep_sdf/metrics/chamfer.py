@@ -2,78 +2,122 @@
 # Copyright 2004-present Facebook. All Rights Reserved.
 
 import numpy as np
-import scipy
-from scipy.spatial import cKDTree as KDTree
-import trimesh
-import robust_laplacian
 from deep_sdf.utils import scale_to_unit_sphere
+from deep_sdf.metrics.backends import get_backend
+from deep_sdf.metrics.emd import sliced_emd
+from deep_sdf.metrics.gt_cache import get_gt_points
+from deep_sdf.metrics.iou import compute_iou, compute_mesh_occupancy, get_gt_occupancy, get_query_points
+from deep_sdf.metrics.sampling import sample_surface
 
 
-def compute_trimesh_chamfer(gt_points, gen_mesh, offset, scale, num_mesh_samples=30000, curvature_sampling=0.):
+def compute_trimesh_chamfer(
+    gt_points, gen_mesh, offset, scale, num_mesh_samples=30000, curvature_sampling=0., backend=None
+):
     """This function computes a symmetric chamfer distance, i.e. the sum of both chamfers.
 
     gt_points: trimesh.points.PointCloud of just points, sampled from the surface (see
-               compute_metrics.py for more documentation)
+               compute_metrics.py for more documentation), or the filename of one. Point clouds
+               given by filename are cached together with their KD-tree (see gt_cache).
     gen_mesh: trimesh.base.Trimesh of output mesh from whichever autoencoding reconstruction
               method (see compute_metrics.py for more)
+    curvature_sampling: weight of the face curvature versus the face area when sampling gen_mesh
+              (see sampling.SurfaceSampler)
+    backend: the metric backend computing the nearest neighbor distances (see backends.get_backend)
     """
-    try:
-        # compute laplacian 
-        l, m = robust_laplacian.mesh_laplacian(np.array(gen_mesh.vertices), np.array(gen_mesh.faces))
-        minv = scipy.sparse.diags(1 / m.diagonal())
-        Lap = -minv.dot(l)
-        
-        # compute mean curvature for vertices. Clip at median
-        curvatures = np.linalg.norm(Lap.dot(gen_mesh.vertices), axis=1)
-        curvatures = np.clip(curvatures, np.percentile(curvatures, 0.00), np.percentile(curvatures, 50))
-
-        # create face weights proportional to area and mean face curvature
-        face_curvatures = curvatures[gen_mesh.faces].mean(axis=1)
-        face_areas = trimesh.triangles.area(gen_mesh.triangles)
-        face_curvatures = np.interp(face_curvatures,
-                                    (face_curvatures.min(), face_curvatures.max()),
-                                    (0, 1))
-        face_areas = np.interp(face_areas,
-                            (face_areas.min(), face_areas.max()),
-                            (0, 1))
-        weights = curvature_sampling * face_curvatures + (1 - curvature_sampling) * face_areas
-        
-        # sample points with appropriate weighting
-        gen_points_sampled = trimesh.sample.sample_surface(gen_mesh, num_mesh_samples, face_weight=weights)[0]
-    except IndexError as e:
-        raise IndexError
+    return compute_chamfer(
+        *sample_trimesh_chamfer_points(gt_points, gen_mesh, offset, scale, num_mesh_samples, curvature_sampling),
+        backend,
+    )
+
+
+def sample_trimesh_chamfer_points(gt_points, gen_mesh, offset, scale, num_mesh_samples=30000, curvature_sampling=0.):
+    """
+    Returns the normalized points sampled from gen_mesh, the GT points and their cached KD-tree
+    (None unless gt_points is a filename) compared by compute_trimesh_chamfer, to be passed to
+    compute_chamfer or compute_chamfer_batch.
+    """
+    # sample points with appropriate weighting
+    gen_points_sampled = sample_surface(gen_mesh, num_mesh_samples, curvature_sampling)
 
     gen_points_sampled = gen_points_sampled / scale - offset
 
     # only need numpy array of points
-    gt_points_np = gt_points.vertices
+    if isinstance(gt_points, str):
+        gt_points_np, gt_kd_tree = get_gt_points(gt_points, num_mesh_samples)
+    else:
+        gt_points_np, gt_kd_tree = gt_points.vertices, None
 
-    return compute_chamfer(gen_points_sampled, gt_points_np)
+    return gen_points_sampled, gt_points_np, gt_kd_tree
 
 
-def compute_chamfer(gen_points_sampled, gt_points_sampled) -> float:
+def compute_chamfer(gen_points_sampled, gt_points_sampled, gt_points_kd_tree=None, backend=None) -> float:
     """This function computes a symmetric chamfer distance, i.e. the sum of both chamfers.
 
     gen_points_sampled: np.array of points sampled from the generated mesh surface.
     gt_points_sampled: np.array of points sampled from the GT mesh surface.
+    gt_points_kd_tree: KDTree of gt_points_sampled, built here if not given.
+    backend: the metric backend computing the nearest neighbor distances (see backends.get_backend).
     """
+    backend = get_backend(backend)
     # one direction
-    gen_points_kd_tree = KDTree(gen_points_sampled)
-    one_distances, one_vertex_ids = gen_points_kd_tree.query(gt_points_sampled)
-    gt_to_gen_chamfer = np.mean(np.square(one_distances))
+    one_distances = backend.nearest_distances(gt_points_sampled, gen_points_sampled)
 
     # other direction
-    gt_points_kd_tree = KDTree(gt_points_sampled)
-    two_distances, two_vertex_ids = gt_points_kd_tree.query(gen_points_sampled)
+    two_distances = backend.nearest_distances(gen_points_sampled, gt_points_sampled, gt_points_kd_tree)
+
+    return combine_chamfer(one_distances, two_distances)
+
+
+def combine_chamfer(one_distances, two_distances):
+    gt_to_gen_chamfer = np.mean(np.square(one_distances))
     gen_to_gt_chamfer = np.mean(np.square(two_distances))
 
     return float(gt_to_gen_chamfer + gen_to_gt_chamfer), np.concatenate((one_distances, two_distances), axis=0)
 
 
-def compute_trimesh_iou():
-    # TODO
-    pass
+def compute_chamfer_batch(gen_points_sampled, gt_points_sampled, gt_points_kd_trees=None, backend=None):
+    """Runs compute_chamfer for lists of generated and GT points, computing all pairs at once."""
+    backend = get_backend(backend)
+    one_distances = backend.batch_nearest_distances(gt_points_sampled, gen_points_sampled)
+    two_distances = backend.batch_nearest_distances(gen_points_sampled, gt_points_sampled, gt_points_kd_trees)
+    return [combine_chamfer(one, two) for one, two in zip(one_distances, two_distances)]
+
+
+def compute_hausdorff(gen_points_sampled, gt_points_sampled, gt_points_kd_tree=None, backend=None) -> float:
+    """This function computes the symmetric Hausdorff distance, i.e. the larger of both directions."""
+    _, all_distances = compute_chamfer(gen_points_sampled, gt_points_sampled, gt_points_kd_tree, backend)
+    return float(np.max(all_distances))
+
+
+def compute_trimesh_iou(gt_mesh, gen_mesh, offset=0., scale=1., num_points=100000, bound=1.0, device=None) -> float:
+    """This function computes the volumetric intersection over union of two meshes.
+
+    gt_mesh: trimesh.base.Trimesh of the GT mesh, or its filename. The occupancy of GT meshes given
+             by filename is cached (see gt_cache).
+    gen_mesh: trimesh.base.Trimesh of output mesh, normalized like in compute_trimesh_chamfer.
+    The occupancy of both meshes is tested at the same uniform query points in the normalized
+    cube [-bound, bound]^3 with their winding numbers (see iou.compute_winding_numbers).
+    """
+    points = get_query_points(num_points, bound)
+    gt_occupancy = get_gt_occupancy(
+        gt_mesh, points / scale - offset, f"{num_points}:{bound}:{np.asarray(offset).tolist()}:{float(scale)}", device
+    )
+    gen_occupancy = compute_mesh_occupancy(gen_mesh, points, device)
+    return float(compute_iou(gen_occupancy, gt_occupancy))
+
+
+def compute_trimesh_emd(gt_points, gen_mesh, offset, scale, num_mesh_samples=30000, num_projections=256) -> float:
+    """This function computes an approximate earth mover's distance (see emd.sliced_emd).
+
+    gt_points: trimesh.points.PointCloud of the GT surface samples, or the filename of one (see
+               compute_trimesh_chamfer).
+    gen_mesh: trimesh.base.Trimesh of output mesh, normalized like in compute_trimesh_chamfer.
+    """
+    gen_points_sampled = sample_surface(gen_mesh, num_mesh_samples) / scale - offset
+
+    if isinstance(gt_points, str):
+        gt_points_np, _ = get_gt_points(gt_points, num_mesh_samples)
+    else:
+        gt_points_np = gt_points.vertices
 
-def compute_trimesh_emd():
-    # TODO
-    pass
\ No newline at end of file
+    return sliced_emd(gen_points_sampled, gt_points_np, num_projections)
@@ -1,7 +1,33 @@
+import numpy as np
+import torch
 from scipy.spatial.distance import cdist
 from scipy.optimize import linear_sum_assignment
 
 def emd(X, Y):
     d = cdist(X, Y)
     assignment = linear_sum_assignment(d)
-    return d[assignment].sum() / min(len(X), len(Y))
\ No newline at end of file
+    return d[assignment].sum() / min(len(X), len(Y))
+
+@torch.no_grad()
+def sliced_emd(X, Y, num_projections=256, seed=0, device=None):
+    """
+    Approximates the EMD of the point sets X and Y (N x 3, or B x N x 3 for a batch of pairs) by
+    the sliced Wasserstein distance: the mean over random directions of the EMD of the points
+    projected onto them, which is exact in 1D after sorting. It runs in O(N log N) instead of
+    the O(N^3) of the assignment in `emd`, and is a lower bound of it. Larger point sets are
+    subsampled to the size of the smaller ones.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    X = torch.as_tensor(np.asarray(X), dtype=torch.float32, device=device)
+    Y = torch.as_tensor(np.asarray(Y), dtype=torch.float32, device=device)
+    batched = X.dim() == 3
+    X, Y = (X, Y) if batched else (X[None], Y[None])
+    num_points = min(X.shape[1], Y.shape[1])
+    X, Y = (P[:, torch.randperm(P.shape[1], generator=generator)[:num_points].to(P.device)] for P in (X, Y))
+
+    directions = torch.randn(3, num_projections, generator=generator).to(X.device)
+    directions /= torch.linalg.norm(directions, dim=0, keepdim=True)
+    X_projected, _ = torch.sort(X @ directions, dim=1)
+    Y_projected, _ = torch.sort(Y @ directions, dim=1)
+    distances = (X_projected - Y_projected).abs().mean((1, 2)).cpu().numpy()
+    return distances if batched else float(distances[0])
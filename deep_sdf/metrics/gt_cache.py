@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import collections
+import hashlib
+import logging
+import os
+import threading
+import numpy as np
+import trimesh
+from scipy.spatial import cKDTree as KDTree
+from deep_sdf.utils import as_mesh
+
+
+gt_cache_subdir = ".gt_cache"
+
+
+class GTCache:
+    """
+    Caches the points sampled from GT meshes (or read from GT point clouds) together with their
+    KD-trees, so repeated evaluations of the same shapes neither reload and resample the GT nor
+    rebuild the tree, and other arrays computed from GT files (see get_cached). Entries are keyed
+    by the path, its modification time and the number of samples (or the key of the array). The
+    `max_entries` most recently used entries are kept in memory, and the arrays are also stored
+    as .npz in a '.gt_cache' directory next to the GT files (if `disk` is set), so other
+    processes and later runs get the same samples.
+    """
+
+    def __init__(self, max_entries=256, disk=True):
+        self.max_entries = max_entries
+        self.disk = disk
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_cache_filename(self, path, key):
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}:{key}"
+        name = os.path.splitext(os.path.basename(path))[0]
+        return os.path.join(
+            os.path.dirname(path), gt_cache_subdir, f"{name}_{hashlib.sha1(key.encode()).hexdigest()[:16]}.npz"
+        )
+
+    def load_points(self, path, num_samples):
+        """Returns the vertices of a point cloud or `num_samples` points sampled from the surface of a mesh."""
+        gt = trimesh.load(path)
+        if isinstance(gt, trimesh.points.PointCloud):
+            return np.asarray(gt.vertices)
+        return trimesh.sample.sample_surface(as_mesh(gt), num_samples)[0]
+
+    def get(self, path, num_samples=30000):
+        """Returns the GT points of `path` and their KD-tree."""
+        return self.get_cached(
+            path, num_samples, "points", lambda: self.load_points(path, num_samples), lambda points: (points, KDTree(points))
+        )
+
+    def get_cached(self, path, key, name, load, build=None):
+        """
+        Returns the array `load()` computed from the GT file `path`, cached under `key`, or
+        `build(array)` if given. Only the array is stored on disk, as `name` in the .npz file.
+        """
+        cache_filename = self.get_cache_filename(path, key)
+        with self.lock:
+            if cache_filename in self.entries:
+                self.entries.move_to_end(cache_filename)
+                return self.entries[cache_filename]
+
+        array = None
+        if self.disk and os.path.isfile(cache_filename):
+            try:
+                array = np.load(cache_filename)[name]
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Could not read the GT cache {cache_filename}: {e}")
+        if array is None:
+            array = load()
+            if self.disk:
+                self.save_array(cache_filename, name, array)
+
+        entry = array if build is None else build(array)
+        with self.lock:
+            self.entries[cache_filename] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def save_array(self, cache_filename, name, array):
+        tmp_filename = f"{cache_filename}.tmp{os.getpid()}.npz"
+        try:
+            os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+            np.savez(tmp_filename, **{name: array})
+            os.replace(tmp_filename, cache_filename)
+        except OSError as e:
+            logging.warning(f"Could not write the GT cache {cache_filename}: {e}")
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Shared by all metrics of a process.
+gt_cache = GTCache()
+
+
+def get_gt_points(path, num_samples=30000):
+    """Returns the cached GT points of the mesh or point cloud at `path` and their KD-tree."""
+    return gt_cache.get(path, num_samples)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import math
+import numpy as np
+import scipy.ndimage
+import torch
+import trimesh
+from deep_sdf.metrics.gt_cache import gt_cache
+from deep_sdf.utils import as_mesh
+
+
+def get_query_points(num_points=100000, bound=1.0, seed=0):
+    """Returns the shared IoU query points, drawn uniformly from the cube [-bound, bound]^3 with a fixed seed."""
+    return np.random.default_rng(seed).uniform(-bound, bound, (num_points, 3))
+
+
+@torch.no_grad()
+def compute_winding_numbers(mesh, points, device=None, block_size=None):
+    """
+    Returns the generalized winding number of `mesh` at every point, the sum of the solid angles of
+    all faces seen from the point divided by 4 pi. It is 1 inside and 0 outside a closed mesh and
+    degrades gracefully for meshes with holes. The points x faces solid angles are computed for at
+    most `block_size` pairs at a time (2^20 on the CPU, 2^24 on the GPU).
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+    if block_size is None:
+        block_size = 2 ** 24 if device.type == "cuda" else 2 ** 20
+    triangles = torch.tensor(np.asarray(mesh.triangles), dtype=torch.float32, device=device)
+    points = torch.as_tensor(np.asarray(points), dtype=torch.float32, device=device)
+    step = max(1, block_size // len(triangles))
+    winding_numbers = []
+    for start in range(0, len(points), step):
+        # Triangle corners relative to the points, points x faces x 3 x 3
+        corners = triangles[None] - points[start : start + step, None, None]
+        a, b, c = corners.unbind(2)
+        la, lb, lc = (torch.linalg.norm(v, dim=2) for v in (a, b, c))
+        det = (torch.cross(a, b, dim=2) * c).sum(2)
+        denominator = la * lb * lc + (a * b).sum(2) * lc + (b * c).sum(2) * la + (c * a).sum(2) * lb
+        winding_numbers.append(torch.atan2(det, denominator).sum(1) / (2 * math.pi))
+    return torch.cat(winding_numbers).cpu().numpy()
+
+
+def compute_mesh_occupancy(mesh, points, device=None, resolution=128):
+    """
+    Returns whether every point lies inside `mesh`. Meshes with holes (such as many ShapeNet
+    meshes and reconstructions clipped at the grid boundary) get the winding number test at all
+    points. For watertight meshes, the surface is voxelized with `resolution` voxels along the
+    longest side of its bounding box and the voxels enclosed by it are filled. Points in or next
+    to surface voxels get the exact winding number test, all other points the occupancy of their
+    voxel.
+    """
+    points = np.asarray(points)
+    if not mesh.is_watertight:
+        return compute_winding_numbers(mesh, points, device) > 0.5
+    occupancy = np.zeros(len(points), dtype=bool)
+    voxels = mesh.voxelized(mesh.extents.max() / resolution)
+    near_surface_voxels = scipy.ndimage.binary_dilation(voxels.matrix)
+    filled_voxels = voxels.copy().fill().matrix
+
+    indices = voxels.points_to_indices(points)
+    in_grid = np.all((indices >= 0) & (indices < voxels.shape), axis=1)
+    indices = tuple(indices[in_grid].T)
+    occupancy[in_grid] = filled_voxels[indices]
+    near_surface = np.zeros(len(points), dtype=bool)
+    near_surface[in_grid] = near_surface_voxels[indices]
+    if near_surface.any():
+        occupancy[near_surface] = compute_winding_numbers(mesh, points[near_surface], device) > 0.5
+    return occupancy
+
+
+def get_gt_occupancy(gt_mesh, points, key=None, device=None):
+    """
+    Returns the occupancy of the GT mesh (or its filename) at `points`. For filenames, it is
+    cached under `key` (see gt_cache), which must identify the points.
+    """
+    if not isinstance(gt_mesh, str):
+        return compute_mesh_occupancy(gt_mesh, points, device)
+    return gt_cache.get_cached(
+        gt_mesh,
+        f"occupancy:{key}",
+        "occupancy",
+        lambda: compute_mesh_occupancy(as_mesh(trimesh.load(gt_mesh)), points, device),
+    )
+
+
+@torch.no_grad()
+def compute_decoder_occupancy(decoder, latents, points, max_batch=2 ** 18):
+    """
+    Returns the K x P occupancy of the K latent codes at the P points, where the SDF predicted
+    by the decoder is negative. All codes are evaluated in the same forward passes.
+    """
+    device = next(decoder.parameters()).device
+    latents = torch.stack([latent.reshape(-1) for latent in latents]).to(device)
+    points = torch.as_tensor(np.asarray(points), dtype=torch.float32, device=device)
+    step = max(1, max_batch // len(latents))
+    occupancy = []
+    for start in range(0, len(points), step):
+        xyz = points[start : start + step].unsqueeze(0).expand(len(latents), -1, -1)
+        sdf = decoder(latents, xyz).reshape(len(latents), -1)
+        occupancy.append(sdf < 0)
+    return torch.cat(occupancy, 1).cpu().numpy()
+
+
+def compute_iou(occupancy, gt_occupancy):
+    """Returns the intersection over union of boolean occupancies along their last axis."""
+    intersection = np.logical_and(occupancy, gt_occupancy).sum(-1)
+    union = np.logical_or(occupancy, gt_occupancy).sum(-1)
+    return np.where(union > 0, intersection / np.maximum(union, 1), 1.0)
+
+
+def compute_decoder_iou(decoder, latents, gt_meshes, num_points=100000, bound=1.0, max_batch=2 ** 18, device=None):
+    """
+    Returns the IoU of the shapes of all latent codes with their GT meshes (or filenames), with the
+    occupancy of the shapes given by the sign of the decoded SDF. The shapes share the query
+    points, so the occupancies of all codes are decoded together and the GT occupancies of
+    filenames are cached.
+    """
+    points = get_query_points(num_points, bound)
+    occupancy = compute_decoder_occupancy(decoder, latents, points, max_batch)
+    key = f"{num_points}:{bound}"
+    gt_occupancy = np.stack([get_gt_occupancy(gt_mesh, points, key, device) for gt_mesh in gt_meshes])
+    return compute_iou(occupancy, gt_occupancy)
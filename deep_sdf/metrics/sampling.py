@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+import numpy as np
+import scipy
+import trimesh
+import robust_laplacian
+
+
+def normalize_weights(weights):
+    return np.interp(weights, (weights.min(), weights.max()), (0, 1))
+
+
+def compute_face_curvatures(mesh):
+    """Returns the mean curvature of every face of `mesh`, clipped at the median and scaled to [0, 1]."""
+    # compute laplacian
+    l, m = robust_laplacian.mesh_laplacian(np.array(mesh.vertices), np.array(mesh.faces))
+    minv = scipy.sparse.diags(1 / m.diagonal())
+    Lap = -minv.dot(l)
+
+    # compute mean curvature for vertices. Clip at median
+    curvatures = np.linalg.norm(Lap.dot(mesh.vertices), axis=1)
+    curvatures = np.clip(curvatures, np.percentile(curvatures, 0.00), np.percentile(curvatures, 50))
+
+    return normalize_weights(curvatures[mesh.faces].mean(axis=1))
+
+
+class SurfaceSampler:
+    """
+    Samples points from the surface of generated meshes with face weights proportional to a blend
+    of face area and mean face curvature. Without curvature weight, the weights are the face areas
+    and the Laplacian is never built. Otherwise, the face curvatures of the `max_entries` most
+    recently sampled meshes are cached, keyed by the hash of their vertices and faces.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.face_curvatures = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_face_curvatures(self, mesh):
+        key = hash(mesh)
+        with self.lock:
+            if key in self.face_curvatures:
+                self.face_curvatures.move_to_end(key)
+                return self.face_curvatures[key]
+        face_curvatures = compute_face_curvatures(mesh)
+        with self.lock:
+            self.face_curvatures[key] = face_curvatures
+            while len(self.face_curvatures) > self.max_entries:
+                self.face_curvatures.popitem(last=False)
+        return face_curvatures
+
+    def get_face_weights(self, mesh, curvature_sampling=0.):
+        face_areas = normalize_weights(trimesh.triangles.area(mesh.triangles))
+        if curvature_sampling == 0.:
+            return face_areas
+        return curvature_sampling * self.get_face_curvatures(mesh) + (1 - curvature_sampling) * face_areas
+
+    def sample(self, mesh, num_samples, curvature_sampling=0.):
+        weights = self.get_face_weights(mesh, curvature_sampling)
+        return trimesh.sample.sample_surface(mesh, num_samples, face_weight=weights)[0]
+
+    def clear(self):
+        with self.lock:
+            self.face_curvatures.clear()
+
+
+# Shared by all metrics of a process.
+surface_sampler = SurfaceSampler()
+
+
+def sample_surface(mesh, num_samples, curvature_sampling=0.):
+    """Returns `num_samples` points sampled from `mesh`, weighting faces by area and curvature (see SurfaceSampler)."""
+    return surface_sampler.sample(mesh, num_samples, curvature_sampling)
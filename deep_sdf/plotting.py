@@ -54,18 +54,17 @@ if not os.name == "nt":
 
 def plot_train_stats(loss_hists: list, psnr_hist=None, step_hist=None, labels=None, save_path="") -> plt.figure:
     fig, ax = plt.subplots(1, 1, figsize=(5, 4))
-    if not step_hist:
-        step_hist = list(range(len(loss_hists[0])))
 
     fig.suptitle(f"Training curves {save_path}")
     for i, loss_hist in enumerate(loss_hists):
         label = f"Loss: {labels[i]}" if labels else "Loss"
-        ax.plot(step_hist, loss_hist, c="orange", label=label)
+        # Loss histories can have different lengths, e.g. if an optimization stopped early.
+        ax.plot(step_hist or list(range(len(loss_hist))), loss_hist, c="orange", label=label)
     ax.set_xlabel("Iteration")
     ax.set_ylabel("Loss")
     if psnr_hist:
         ax2 = ax[0].twinx()
-        ax2.plot(step_hist, psnr_hist, c="g", label="PSNR")
+        ax2.plot(step_hist or list(range(len(psnr_hist))), psnr_hist, c="g", label="PSNR")
         ax2.set_ylabel("PSNR")
     fig.legend()
 
@@ -776,16 +775,8 @@ def plot_lat_interpolation(
 
     arch = __import__("networks." + specs["NetworkArch"], fromlist=["Decoder"])
     latent_size = specs["CodeLength"]
-    decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"])
-    decoder = torch.nn.DataParallel(decoder)
-
-    saved_model_state = torch.load(
-        os.path.join(
-            exp_dir, ws.model_params_subdir, str(checkpoint) + ".pth"
-        )
-    )
-    decoder.load_state_dict(saved_model_state["model_state_dict"])
-    decoder = decoder.module.cuda()
+    decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"]).cuda()
+    ws.load_model_parameters(exp_dir, str(checkpoint), decoder)
     
     with torch.no_grad():
         mesh = deep_sdf.mesh.create_mesh(
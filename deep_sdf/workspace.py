@@ -2,13 +2,19 @@
 # Copyright 2004-present Facebook. All Rights Reserved.
 
 import json
+import logging
 import os
+import queue
+import threading
 import torch
 
+from deep_sdf.utils import get_device
+
 model_params_subdir = "ModelParameters"
 optimizer_params_subdir = "OptimizerParameters"
 latent_codes_subdir = "LatentCodes"
 logs_filename = "Logs.pth"
+log_records_filename = "Logs.jsonl"
 tb_logs_dir = "TensorBoard"
 tb_logs_train_reconstructions = "ReconstructionsTrain"
 tb_logs_test_reconstructions = "ReconstructionsTest"
@@ -37,7 +43,157 @@ def load_experiment_specifications(experiment_directory: str) -> dict:
     return json.load(open(filename))
 
 
-def load_model_parameters(experiment_directory, checkpoint, decoder):
+def snapshot_to_cpu(obj):
+    """Copies all tensors in `obj` (nested in dicts, lists and tuples) to host memory."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def save_atomically(obj, filename):
+    """Saves `obj` under a temporary name first, so `filename` is never left half-written."""
+    tmp_filename = filename + ".tmp"
+    torch.save(obj, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def append_lines(lines, filename):
+    with open(filename, "a") as f:
+        f.writelines(line + "\n" for line in lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints and logs on a background thread, in the order they were submitted. `save`
+    snapshots the object to host memory before returning, so training can go on modifying its
+    state while the file is written. With `background=False`, everything is written right away.
+    Errors of the background thread are raised by the next call.
+    """
+
+    def __init__(self, background=True):
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = None
+        if background:
+            self.thread = threading.Thread(target=self._run, name="CheckpointWriter", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                job[0](*job[1:])
+            except Exception as e:
+                logging.error(f"Writing a checkpoint failed: {e}")
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _submit(self, *job):
+        self._raise_error()
+        if self.thread is None:
+            job[0](*job[1:])
+        else:
+            self.queue.put(job)
+
+    def save(self, obj, filename):
+        self._submit(save_atomically, snapshot_to_cpu(obj), filename)
+
+    def append_lines(self, lines, filename):
+        self._submit(append_lines, list(lines), filename)
+
+    def flush(self):
+        """Waits until everything submitted so far is written."""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+def get_log_records_filename(experiment_directory):
+    return os.path.join(experiment_directory, log_records_filename)
+
+
+def write_log_records(experiment_directory, lines):
+    """Replaces the JSON log records of an experiment, e.g. to drop the epochs after the checkpoint a run continues from."""
+    filename = get_log_records_filename(experiment_directory)
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        f.writelines(line + "\n" for line in lines)
+    os.replace(tmp_filename, filename)
+
+
+def load_logs(experiment_directory):
+    """
+    Returns the training logs of an experiment as a dict with the per-batch 'loss' and the per-epoch
+    'learning_rate', 'timing', 'latent_magnitude' and 'param_magnitude' up to the logged 'epoch'.
+    Reads the append-only Logs.jsonl with one record per epoch, or the Logs.pth of older experiments.
+    """
+    filename = get_log_records_filename(experiment_directory)
+    if not os.path.isfile(filename):
+        legacy_filename = os.path.join(experiment_directory, logs_filename)
+        if not os.path.isfile(legacy_filename):
+            raise Exception('log file "{}" does not exist'.format(filename))
+        return torch.load(legacy_filename)
+
+    logs = {"epoch": 0, "loss": [], "learning_rate": [], "timing": [], "latent_magnitude": [], "param_magnitude": {}}
+    with open(filename, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line is incomplete if training was killed while appending it.
+                logging.warning(f"Skipping a corrupt record in {filename}")
+                continue
+            logs["epoch"] = record["epoch"]
+            logs["loss"].extend(record["loss"])
+            logs["learning_rate"].append(record["learning_rate"])
+            logs["timing"].append(record["timing"])
+            logs["latent_magnitude"].append(record["latent_magnitude"])
+            for name, magnitude in record["param_magnitude"].items():
+                logs["param_magnitude"].setdefault(name, []).append(magnitude)
+    return logs
+
+
+def match_state_dict_prefix(state_dict, module):
+    """Add or strip the "module." prefix of a (Distributed)DataParallel wrapper.
+
+    Checkpoints are saved from the unwrapped decoder, but older ones were saved
+    through DataParallel; either kind loads into a wrapped or an unwrapped module.
+    """
+
+    prefix = "module."
+    wrapped = isinstance(
+        module, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)
+    )
+    saved_wrapped = len(state_dict) > 0 and all(k.startswith(prefix) for k in state_dict)
+
+    if wrapped and not saved_wrapped:
+        return {prefix + k: v for k, v in state_dict.items()}
+    if saved_wrapped and not wrapped:
+        return {k[len(prefix):]: v for k, v in state_dict.items()}
+    return state_dict
+
+
+def load_model_parameters(experiment_directory, checkpoint, decoder, device=None):
 
     filename = os.path.join(
         experiment_directory, model_params_subdir, checkpoint + ".pth"
@@ -46,14 +202,14 @@ def load_model_parameters(experiment_directory, checkpoint, decoder):
     if not os.path.isfile(filename):
         raise Exception('model state dict "{}" does not exist'.format(filename))
 
-    data = torch.load(filename)
+    data = torch.load(filename, map_location=device)
 
-    decoder.load_state_dict(data["model_state_dict"])
+    decoder.load_state_dict(match_state_dict_prefix(data["model_state_dict"], decoder))
 
     return data["epoch"]
 
 
-def build_decoder(experiment_directory, experiment_specs):
+def build_decoder(experiment_directory, experiment_specs, device=None):
 
     arch = __import__(
         "networks." + experiment_specs["NetworkArch"], fromlist=["Decoder"]
@@ -61,26 +217,33 @@ def build_decoder(experiment_directory, experiment_specs):
 
     latent_size = experiment_specs["CodeLength"]
 
-    decoder = arch.Decoder(latent_size, **experiment_specs["NetworkSpecs"]).cuda()
+    if device is None:
+        device = get_device(specs=experiment_specs)
+
+    decoder = arch.Decoder(latent_size, **experiment_specs["NetworkSpecs"]).to(device)
 
     return decoder
 
 
 def load_decoder(
-    experiment_directory, experiment_specs, checkpoint, data_parallel=True
+    experiment_directory, experiment_specs, checkpoint, data_parallel=True, device=None
 ):
 
-    decoder = build_decoder(experiment_directory, experiment_specs)
+    if device is None:
+        device = get_device(specs=experiment_specs)
 
-    if data_parallel:
+    decoder = build_decoder(experiment_directory, experiment_specs, device)
+
+    # DataParallel only makes sense for CUDA devices.
+    if data_parallel and device.type == "cuda":
         decoder = torch.nn.DataParallel(decoder)
 
-    epoch = load_model_parameters(experiment_directory, checkpoint, decoder)
+    epoch = load_model_parameters(experiment_directory, checkpoint, decoder, device)
 
     return (decoder, epoch)
 
 
-def load_latent_vectors(experiment_directory, checkpoint):
+def load_latent_vectors(experiment_directory, checkpoint, device=None):
 
     filename = os.path.join(
         experiment_directory, latent_codes_subdir, checkpoint + ".pth"
@@ -92,7 +255,10 @@ def load_latent_vectors(experiment_directory, checkpoint):
             + " for checkpoint '{}'".format(experiment_directory, checkpoint)
         )
 
-    data = torch.load(filename)
+    if device is None:
+        device = get_device()
+
+    data = torch.load(filename, map_location=device)
 
     if isinstance(data["latent_codes"], torch.Tensor):
 
@@ -100,7 +266,7 @@ def load_latent_vectors(experiment_directory, checkpoint):
 
         lat_vecs = []
         for i in range(num_vecs):
-            lat_vecs.append(data["latent_codes"][i].cuda())
+            lat_vecs.append(data["latent_codes"][i].to(device))
 
         return lat_vecs
 
@@ -2,10 +2,14 @@
 # Copyright 2004-present Facebook. All Rights Reserved.
 
 import argparse
+import concurrent.futures
 import logging
+import multiprocessing
 import json
 import numpy as np
 import os
+import sqlite3
+import torch
 import trimesh
 
 import deep_sdf
@@ -14,20 +18,163 @@ if not os.name == "nt":
     # We do not import this on Windows.
     import pytorch3d
 
-def evaluate(experiment_directory, checkpoint, data_dir, split_filename, curvature_sampling=0.):
+def get_evaluation_filename(
+    experiment_directory, checkpoint, split_filename, curvature_sampling, extension, metric_backend=None
+):
+    filename = os.path.join(
+            ws.get_evaluation_dir(experiment_directory, checkpoint, True),
+            "chamfer"
+        )
+    filename += "_on_train_set" if "train" in split_filename else ""
+    filename += "" if curvature_sampling == 0. else f"_{curvature_sampling:.3f}_curvature"
+    filename += "" if metric_backend in (None, "kdtree") else f"_{metric_backend}"
+    return filename + extension
+
+
+class ResultsDatabase:
+    """
+    Append-only SQLite store of the per-shape evaluation results. Every result is committed as
+    soon as it arrives, keyed by the shape and the modification time of its reconstructed mesh, so
+    an interrupted evaluation resumes where it stopped and a re-reconstructed mesh is evaluated
+    again.
+    """
+
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "shape TEXT NOT NULL, mesh_mtime_ns INTEGER NOT NULL, chamfer_dist REAL, "
+            "percentile_90 REAL, percentile_95 REAL, normal_consistency REAL, "
+            "PRIMARY KEY (shape, mesh_mtime_ns))"
+        )
+        self.connection.commit()
+
+    def get(self, shape, mesh_mtime_ns):
+        return self.connection.execute(
+            "SELECT chamfer_dist, percentile_90, percentile_95, normal_consistency FROM results "
+            "WHERE shape = ? AND mesh_mtime_ns = ?",
+            (shape, mesh_mtime_ns),
+        ).fetchone()
+
+    def add(self, shape, mesh_mtime_ns, results):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)", (shape, mesh_mtime_ns, *results)
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def init_evaluation_worker(log_level):
+    logging.getLogger().setLevel(log_level)
+    # The workers already run in parallel.
+    torch.set_num_threads(1)
+
+
+def load_shape(
+    reconstructed_mesh_filename,
+    ground_truth_samples_filename,
+    normalization_params_filename,
+    curvature_sampling,
+):
+    """
+    Returns the points sampled from the reconstruction, the GT points and their KD-tree compared
+    by the Chamfer distance (see sample_trimesh_chamfer_points), and the normal consistency.
+    """
+    # Loaded through the GT cache, together with its KD-tree.
+    ground_truth_points = ground_truth_samples_filename
+    reconstruction = trimesh.load(reconstructed_mesh_filename)
+
+    normalization_params = np.load(normalization_params_filename)
+
+    points = deep_sdf.metrics.chamfer.sample_trimesh_chamfer_points(
+        ground_truth_points,
+        reconstruction,
+        normalization_params["offset"],
+        normalization_params["scale"],
+        curvature_sampling=curvature_sampling,
+    )
+    normal_consistency = deep_sdf.metrics.compute_metric(gen_mesh=reconstruction, metric="normal_consistency")
+    return points, normal_consistency
+
+
+def summarize_shape(chamfer_dist, all_dists, normal_consistency):
+    """Returns the Chamfer distance, its 90th and 95th percentiles and the normal consistency."""
+    percentiles = np.percentile(all_dists, [90, 95])
+
+    logging.debug("chamfer distance: " + str(chamfer_dist))
+
+    return float(chamfer_dist), float(percentiles[0]), float(percentiles[1]), float(normal_consistency)
+
+
+def evaluate_shape(*args):
+    """Evaluates a shape (see load_shape) with the KD-tree backend, see summarize_shape."""
+    points, normal_consistency = load_shape(*args)
+    return summarize_shape(*deep_sdf.metrics.chamfer.compute_chamfer(*points), normal_consistency)
+
+
+def evaluate_shape_batch(tasks, backend, add_results):
+    """
+    Evaluates the shapes of the (shape, mesh_mtime_ns, load_shape arguments) `tasks`, computing
+    their Chamfer distances together with compute_chamfer_batch on `backend`.
+    """
+    loaded = []
+    for shape, mesh_mtime_ns, args in tasks:
+        try:
+            loaded.append((shape, mesh_mtime_ns, load_shape(*args)))
+        except Exception as e:
+            logging.error(f"Evaluation of {shape} failed: {e}")
+    if not loaded:
+        return
+    gen_points, gt_points, gt_kd_trees = zip(*[points for _, _, (points, _) in loaded])
+    try:
+        chamfers = deep_sdf.metrics.chamfer.compute_chamfer_batch(gen_points, gt_points, gt_kd_trees, backend)
+    except Exception as e:
+        logging.error(f"Evaluation of {', '.join(shape for shape, _, _ in loaded)} failed: {e}")
+        return
+    for (shape, mesh_mtime_ns, (_, normal_consistency)), chamfer in zip(loaded, chamfers):
+        add_results(shape, mesh_mtime_ns, lambda: summarize_shape(*chamfer, normal_consistency))
+
+
+def evaluate(
+    experiment_directory,
+    checkpoint,
+    data_dir,
+    split_filename,
+    curvature_sampling=0.,
+    num_workers=0,
+    metric_backend=None,
+    metric_device=None,
+    metric_batch_size=16,
+):
+    """
+    Evaluates the reconstructions of the split in `num_workers` processes (in this process if 0).
+    `metric_backend` and `metric_device` select how the Chamfer distances are computed (see
+    deep_sdf.metrics.backends). The torch backend evaluates groups of `metric_batch_size` shapes
+    at once in this process instead, so it has the device and all CPU threads to itself.
+    Results are streamed into a SQLite database next to the CSV, shapes whose reconstructed mesh
+    has not changed since they were last evaluated are skipped, and the CSV is written from the
+    database at the end. Both files are named after the curvature sampling and the metric
+    backend (unless it is the KD-tree), whose results differ.
+    """
 
     with open(split_filename, "r") as f:
         split = json.load(f)
-        
 
-    chamfer_results = []
+    database = ResultsDatabase(
+        get_evaluation_filename(
+            experiment_directory, checkpoint, split_filename, curvature_sampling, ".sqlite", metric_backend
+        )
+    )
+
+    shapes = []
+    tasks = []
 
     for dataset in split:
         for class_name in split[dataset]:
             for instance_name in split[dataset][class_name]:
-                logging.debug(
-                    "evaluating " + os.path.join(dataset, class_name, instance_name)
-                )
+                shape = os.path.join(dataset, class_name, instance_name)
                 checkpoint_ = f"{checkpoint}_on_train_set" if "train" in split_filename else checkpoint
                 reconstructed_mesh_filename = ws.get_reconstructed_mesh_filename(
                     experiment_directory, checkpoint_, dataset, class_name, instance_name
@@ -58,43 +205,78 @@ def evaluate(experiment_directory, checkpoint, data_dir, split_filename, curvatu
                 )
 
                 logging.debug(
-                    "normalization params are " + ground_truth_samples_filename
+                    "normalization params are " + normalization_params_filename
                 )
 
-                ground_truth_points = trimesh.load(ground_truth_samples_filename)
-                reconstruction = trimesh.load(reconstructed_mesh_filename)
+                if not os.path.isfile(reconstructed_mesh_filename):
+                    logging.error(f"Missing reconstruction of {shape}")
+                    continue
+                mesh_mtime_ns = os.stat(reconstructed_mesh_filename).st_mtime_ns
+                shapes.append((shape, mesh_mtime_ns))
+                if database.get(shape, mesh_mtime_ns) is not None:
+                    logging.debug(f"{shape} was already evaluated")
+                    continue
+                tasks.append(
+                    (
+                        shape,
+                        mesh_mtime_ns,
+                        (
+                            reconstructed_mesh_filename,
+                            ground_truth_samples_filename,
+                            normalization_params_filename,
+                            curvature_sampling,
+                        ),
+                    )
+                )
 
-                normalization_params = np.load(normalization_params_filename)
+    logging.info(f"{len(shapes) - len(tasks)} of {len(shapes)} shapes were already evaluated")
 
-                chamfer_dist, all_dists = deep_sdf.metrics.chamfer.compute_trimesh_chamfer(
-                    ground_truth_points,
-                    reconstruction,
-                    normalization_params["offset"],
-                    normalization_params["scale"],
-                    curvature_sampling=curvature_sampling
-                )
-                percentiles = np.percentile(all_dists, [90, 95])
-                normal_consistency = deep_sdf.metrics.compute_metric(gen_mesh=reconstruction, metric="normal_consistency")
+    def add_results(shape, mesh_mtime_ns, evaluation):
+        try:
+            database.add(shape, mesh_mtime_ns, evaluation())
+            logging.debug("evaluated " + shape)
+        except Exception as e:
+            logging.error(f"Evaluation of {shape} failed: {e}")
 
-                logging.debug("chamfer distance: " + str(chamfer_dist))
+    if metric_backend not in (None, "kdtree"):
+        backend = deep_sdf.metrics.get_backend(metric_backend, metric_device)
+        for start in range(0, len(tasks), metric_batch_size):
+            evaluate_shape_batch(tasks[start : start + metric_batch_size], backend, add_results)
+    elif num_workers > 0 and tasks:
+        with concurrent.futures.ProcessPoolExecutor(
+            num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_evaluation_worker,
+            initargs=(logging.getLogger().level,),
+        ) as executor:
+            futures = {
+                executor.submit(evaluate_shape, *args): (shape, mesh_mtime_ns) for shape, mesh_mtime_ns, args in tasks
+            }
+            for future in concurrent.futures.as_completed(futures):
+                add_results(*futures[future], future.result)
+    else:
+        for shape, mesh_mtime_ns, args in tasks:
+            add_results(shape, mesh_mtime_ns, lambda: evaluate_shape(*args))
 
-                chamfer_results.append(
-                    (os.path.join(dataset, class_name, instance_name), (chamfer_dist, percentiles), normal_consistency)
-                )
+    chamfer_results = []
+    for shape, mesh_mtime_ns in shapes:
+        results = database.get(shape, mesh_mtime_ns)
+        if results is not None:
+            chamfer_results.append((shape, results))
+    database.close()
+    if len(chamfer_results) < len(shapes):
+        logging.error(f"{len(shapes) - len(chamfer_results)} shapes could not be evaluated")
 
-    output_filename = os.path.join(
-            ws.get_evaluation_dir(experiment_directory, checkpoint, True),
-            "chamfer"
-        )
-    output_filename += "_on_train_set" if "train" in split_filename else ""
-    output_filename += f".csv" if curvature_sampling == 0. else f"_{curvature_sampling:.3f}_curvature.csv"
+    output_filename = get_evaluation_filename(
+        experiment_directory, checkpoint, split_filename, curvature_sampling, ".csv", metric_backend
+    )
     logging.info(split_filename)
     logging.info(output_filename)
     with open(output_filename,"w",) as f:
         # semicolon-separated CSV file
         f.write("shape;chamfer_dist;90th_percentile;95th_percentile;normal_consistency\n")
-        for result in chamfer_results:
-            f.write("{};{};{};{}\n".format(result[0], result[1][0], result[1][1][0], result[1][1][1], result[2]))
+        for shape, results in chamfer_results:
+            f.write("{};{};{};{};{}\n".format(shape, *results))
 
 
 if __name__ == "__main__":
@@ -137,6 +319,36 @@ if __name__ == "__main__":
         required=False,
         help="Amount of sampling wrt mesh curvature. 0 means smapling wrt. face area, 1 wrt. face curvature.",
     )
+    arg_parser.add_argument(
+        "--workers",
+        "-j",
+        dest="num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="The number of worker processes evaluating shapes in parallel with the kdtree backend, 0 to "
+        + "evaluate in this process.",
+    )
+    arg_parser.add_argument(
+        "--metric_backend",
+        dest="metric_backend",
+        default="kdtree",
+        choices=["kdtree", "torch"],
+        help="Compute the Chamfer distances with scipy KD-trees in --workers processes or by brute force in "
+        + "torch, in batches of --metric_batch_size shapes.",
+    )
+    arg_parser.add_argument(
+        "--metric_batch_size",
+        dest="metric_batch_size",
+        type=int,
+        default=16,
+        help="The number of shapes whose Chamfer distances the torch backend computes at once.",
+    )
+    arg_parser.add_argument(
+        "--metric_device",
+        dest="metric_device",
+        default=None,
+        help="The device of the torch metric backend. Defaults to CUDA if available.",
+    )
 
     deep_sdf.add_common_args(arg_parser)
 
@@ -152,7 +364,11 @@ if __name__ == "__main__":
             args.checkpoint,
             args.data_source,
             args.split_filename,
-            curvature_sampling
+            curvature_sampling,
+            args.num_workers,
+            args.metric_backend,
+            args.metric_device,
+            args.metric_batch_size,
         )
     except ValueError as ve:
         logging.error(f"Could not cast {args.curvature_sampling} to float" + str(ve.args))
@@ -11,7 +11,10 @@ import deep_sdf
 import deep_sdf.workspace as ws
 
 
-def code_to_mesh(experiment_directory, checkpoint, keep_normalized=False):
+def code_to_mesh(
+    experiment_directory, checkpoint, keep_normalized=False, device=None, num_threads=None, use_compile=True,
+    refinement_levels=0,
+):
 
     specs_filename = os.path.join(experiment_directory, "specs.json")
 
@@ -22,27 +25,19 @@ def code_to_mesh(experiment_directory, checkpoint, keep_normalized=False):
 
     specs = json.load(open(specs_filename))
 
+    device = deep_sdf.configure_device(device, num_threads, specs)
+
     arch = __import__("networks." + specs["NetworkArch"], fromlist=["Decoder"])
 
     latent_size = specs["CodeLength"]
 
-    decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"])
-
-    decoder = torch.nn.DataParallel(decoder)
-
-    saved_model_state = torch.load(
-        os.path.join(experiment_directory, ws.model_params_subdir, checkpoint + ".pth")
-    )
-    print(saved_model_state["model_state_dict"].keys())
-    saved_model_epoch = saved_model_state["epoch"]
-
-    decoder.load_state_dict(saved_model_state["model_state_dict"])
+    decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"]).to(device)
 
-    decoder = decoder.module.cuda()
+    saved_model_epoch = ws.load_model_parameters(experiment_directory, checkpoint, decoder, device)
 
     decoder.eval()
 
-    latent_vectors = ws.load_latent_vectors(experiment_directory, checkpoint).cuda()
+    latent_vectors = ws.load_latent_vectors(experiment_directory, checkpoint, device).to(device)
 
     train_split_file = specs["TrainSplit"]
 
@@ -55,6 +50,10 @@ def code_to_mesh(experiment_directory, checkpoint, keep_normalized=False):
 
     print(len(instance_filenames), " vs ", len(latent_vectors))
 
+    mesh_filenames = []
+    offsets = []
+    scales = []
+
     for i, latent_vector in enumerate(latent_vectors):
 
         dataset_name, class_name, instance_name = instance_filenames[i].split("/")
@@ -91,16 +90,22 @@ def code_to_mesh(experiment_directory, checkpoint, keep_normalized=False):
             offset = normalization_params["offset"]
             scale = normalization_params["scale"]
 
-        with torch.no_grad():
-            deep_sdf.mesh.create_mesh(
-                decoder,
-                latent_vector,
-                mesh_filename,
-                N=256,
-                max_batch=int(2 ** 18),
-                offset=offset,
-                scale=scale,
-            )
+        mesh_filenames.append(mesh_filename)
+        offsets.append(offset)
+        scales.append(scale)
+
+    with torch.no_grad():
+        deep_sdf.mesh.create_meshes(
+            decoder,
+            latent_vectors,
+            mesh_filenames,
+            N=256,
+            max_batch=int(2 ** 18),
+            offsets=offsets,
+            scales=scales,
+            use_compile=use_compile,
+            refinement_levels=refinement_levels,
+        )
 
 
 if __name__ == "__main__":
@@ -132,9 +137,15 @@ if __name__ == "__main__":
         help="If set, keep the meshes in the normalized scale.",
     )
     deep_sdf.add_common_args(arg_parser)
+    deep_sdf.add_device_args(arg_parser)
+    deep_sdf.add_compile_args(arg_parser)
+    deep_sdf.add_meshing_args(arg_parser)
 
     args = arg_parser.parse_args()
 
     deep_sdf.configure_logging(args)
 
-    code_to_mesh(args.experiment_directory, args.checkpoint, args.keep_normalized)
+    code_to_mesh(
+        args.experiment_directory, args.checkpoint, args.keep_normalized, args.device, args.num_threads,
+        not args.no_compile, args.refinement_levels,
+    )
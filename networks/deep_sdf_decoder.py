@@ -4,6 +4,7 @@
 import torch.nn as nn
 import torch
 import torch.nn.functional as F
+from networks.modules import factored_linear
 
 
 class Decoder(nn.Module):
@@ -29,6 +30,10 @@ class Decoder(nn.Module):
         #and do it later if needed
         dims = [latent_size + 3] + dims + [1]
 
+        if 0 in latent_in:
+            # The input already holds the latent code and xyz, and lin0 takes it only once.
+            raise ValueError("latent_in counts from layer 1, the input of layer 0 is always the latent code and xyz")
+
         self.num_layers = len(dims)
         self.norm_layers = norm_layers
         self.latent_in = latent_in
@@ -72,8 +77,11 @@ class Decoder(nn.Module):
         self.dropout = dropout
         self.th = nn.Tanh()
 
-    # input: N x (L+3)
-    def forward(self, input):
+    # input: N x (L+3), or K x L latent codes if xyz is given
+    def forward(self, input, xyz=None):
+        if xyz is not None:
+            return self.forward_factored(input, xyz)
+
         xyz = input[:, -3:]
 
         if input.shape[1] > 3 and self.latent_dropout:
@@ -109,3 +117,53 @@ class Decoder(nn.Module):
             x = self.th(x)
 
         return x
+
+    def forward_factored(self, latent_vecs, xyz):
+        """
+        Same as forward on the concatenated input, but the latent codes are not repeated for
+        every query point. Their contribution to the first and the latent_in layers is computed
+        once per shape and broadcast over its points.
+
+        latent_vecs: K x L
+        xyz: K x P x 3, or P x 3 if all K shapes are queried at the same points
+        Returns (K*P) x 1, ordered like the output for the concatenated input.
+        """
+        num_shapes = latent_vecs.shape[0]
+        if xyz.dim() == 2:
+            xyz = xyz.unsqueeze(0).expand(num_shapes, -1, -1)
+
+        if self.latent_dropout:
+            # NOTE: the dropout mask is drawn per shape instead of per query point.
+            x = F.dropout(latent_vecs, p=0.2, training=self.training)
+        else:
+            x = latent_vecs
+        x = factored_linear(self.lin0, [x, xyz])
+
+        for layer in range(0, self.num_layers - 1):
+            if layer > 0:
+                lin = getattr(self, "lin" + str(layer))
+                if layer in self.latent_in:
+                    x = factored_linear(lin, [x, latent_vecs, xyz])
+                elif self.xyz_in_all:
+                    x = factored_linear(lin, [x, xyz])
+                else:
+                    x = lin(x)
+            # last layer Tanh
+            if layer == self.num_layers - 2 and self.use_tanh:
+                x = self.tanh(x)
+            if layer < self.num_layers - 2:
+                if (
+                    self.norm_layers is not None
+                    and layer in self.norm_layers
+                    and not self.weight_norm
+                ):
+                    bn = getattr(self, "bn" + str(layer))
+                    x = bn(x)
+                x = self.relu(x)
+                if self.dropout is not None and layer in self.dropout:
+                    x = F.dropout(x, p=self.dropout_prob, training=self.training)
+
+        if hasattr(self, "th"):
+            x = self.th(x)
+
+        return x.reshape(-1, 1)
@@ -1,5 +1,6 @@
 import torch.nn as nn
 import torch
+from torch.nn.utils.weight_norm import WeightNorm
 
 class Sine(nn.Module):
     """
@@ -11,7 +12,9 @@ class Sine(nn.Module):
 
     def forward(self, input):
         # See paper sec. 3.2, final paragraph, and supplement Sec. 1.5 for discussion of factor 30
-        return torch.sin(30 * input)
+        # Always in fp32: with autocast, the scaled argument would lose most of its precision.
+        with torch.autocast(input.device.type, enabled=False):
+            return torch.sin(30 * input.float()).to(input.dtype)
 
 
 class Encoding3D(nn.Module):
@@ -34,8 +37,45 @@ class Encoding3D(nn.Module):
         # Sec. 4, second paragraph: 
         # gamma = [a1 cos(2pi * b1^T @ v), a1 sin(2pi * b1^T @ v), ...]
         # Output shape is 2*m = 2*encoding_features
-        input_proj = 2 * torch.pi * input @ self.B.T#.to(input.device)
-        output = torch.concatenate((torch.sin(input_proj), torch.cos(input_proj)), dim=-1)
+        # Always in fp32, the projections can be large for large sigma (see Sine).
+        with torch.autocast(input.device.type, enabled=False):
+            input_proj = 2 * torch.pi * input.float() @ self.B.T.float()#.to(input.device)
+            output = torch.concatenate((torch.sin(input_proj), torch.cos(input_proj)), dim=-1)
         return output
     
 
+
+
+def get_linear_weight(lin):
+    """
+    Returns the current weight matrix of a linear layer. The weight attribute of layers wrapped
+    with nn.utils.weight_norm is only refreshed when the layer is called, so it is recomputed here.
+    """
+    for hook in lin._forward_pre_hooks.values():
+        if isinstance(hook, WeightNorm):
+            return hook.compute_weight(lin)
+    return lin.weight
+
+
+def factored_linear(lin, inputs):
+    """
+    Evaluates `lin` on the concatenation of `inputs` along the last dimension without building
+    the concatenation. Every input is either per point (K x P x C) or per shape (K x C). Per-shape
+    inputs like latent codes are projected once per shape and broadcast over its P points.
+    Returns K x P x out_features.
+    """
+    weight = get_linear_weight(lin)
+    per_shape = 0. if lin.bias is None else lin.bias
+    per_point = 0.
+    start = 0
+    for x in inputs:
+        end = start + x.shape[-1]
+        if x.dim() == 2:
+            per_shape = per_shape + nn.functional.linear(x, weight[:, start:end])
+        else:
+            per_point = per_point + nn.functional.linear(x, weight[:, start:end])
+        start = end
+    assert start == weight.shape[1], f"INPUT WIDTH {start} DOES NOT MATCH LAYER WIDTH {weight.shape[1]}"
+    if isinstance(per_shape, torch.Tensor) and per_shape.dim() == 2:
+        per_shape = per_shape.unsqueeze(1)
+    return per_point + per_shape
@@ -2,7 +2,7 @@ import torch.nn as nn
 import torch
 import torch.nn.functional as F
 import numpy as np
-from networks.modules import Sine, Encoding3D
+from networks.modules import Sine, Encoding3D, factored_linear
 
 
 def sine_init(m):
@@ -80,10 +80,18 @@ class Decoder(nn.Module):
             module.encoding.B = module.encoding.B.to(*args, **kwargs)
         return module
 
-    def forward(self, input_x):
+    def forward(self, input_x, xyz=None):
         """
-        input: N x (L+3)
+        input: N x (L+3), or K x L latent codes if xyz is given
+        xyz: K x P x 3, or P x 3 if all K shapes are queried at the same points
         """
+        if xyz is not None:
+            num_shapes = input_x.shape[0]
+            if xyz.dim() == 2:
+                xyz = xyz.unsqueeze(0).expand(num_shapes, -1, -1)
+            xyz_encoded = self.encoding(xyz) if self.encoding_features > 1 else None
+            return self.decoder.forward_factored(input_x, xyz, xyz_encoded)
+
         xyz = input_x[:, -3:]
         latent_vecs = input_x[:, :-3]
         xyz_encoded = self.encoding(xyz) if self.encoding_features > 1 else None
@@ -236,6 +244,62 @@ class SirenDecoder(nn.Module):
 
         return x
 
+    def forward_factored(self, latent_vecs, xyz, xyz_encoded):
+        """
+        Same as forward, but the latent codes are not repeated for every query point. Their
+        contribution to the first and the latent_in layers is computed once per shape.
+
+        latent_vecs: K x L
+        xyz: K x P x 3
+        xyz_encoded: K x P x 2*encoding_features
+        Returns (K*P) x 1, ordered like the output of forward.
+        """
+        num_shapes, num_points = xyz.shape[0], xyz.shape[1]
+        if latent_vecs is not None and self.latent_dropout:
+            # NOTE: the dropout mask is drawn per shape instead of per query point.
+            latent_vecs = F.dropout(latent_vecs, p=0.2, training=self.training)
+
+        def xyz_input(i):
+            return xyz if self.xyz_input_dims[i] == 3 else xyz_encoded
+
+        x = factored_linear(self.lin0, [latent_vecs, xyz_input(0)])
+
+        for i in range(self.num_layers-1):
+            if i > 0:
+                inputs = [x]
+                if i in self.latent_in:
+                    inputs.append(latent_vecs)
+                if i in self.xyz_in:
+                    inputs.append(xyz_input(i))
+                lin = getattr(self, f"lin{i}")
+                x = factored_linear(lin, inputs) if len(inputs) > 1 else lin(x)
+
+            if i < self.num_layers - 2:
+                # If not the last layer.
+                if i in self.norm_layers and not self.weight_norm:
+                    bn = getattr(self, f"bn{i}")
+                    x = bn(x.reshape(num_shapes * num_points, -1)).reshape(num_shapes, num_points, -1)
+                if self.nonlinearity == "sine_relu_line":
+                    x_relu = self.nl[0](x)
+                    x_sine = self.nl[1](x)
+                    nl_line = getattr(self, "nl_line" + str(i))
+                    x = nl_line * x_sine + (1 - nl_line) * x_relu
+                elif self.nonlinearity == "sine_relu_plane":
+                    x_relu = self.nl[0](x)
+                    x_sine = self.nl[1](x)
+                    nl_plane = getattr(self, "nl_plane" + str(i))
+                    x = nl_plane[:, 0] * x_relu + nl_plane[:, 1] * x_sine
+                else:
+                    x = self.nl(x)
+                if self.dropout and i in self.dropout:
+                    x = F.dropout(x, p=self.dropout_prob, training=self.training)
+
+        # Last layer.
+        if hasattr(self, "tanh"):      
+            x = self.tanh(x)
+
+        return x.reshape(-1, 1)
+
 
 # Testing.
 if __name__ == "__main__":
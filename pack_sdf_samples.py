@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+
+import deep_sdf
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(
+        description="Packs the SDF samples of a split into flat memory-mappable arrays that are "
+        + "read by deep_sdf.data.PackedSDFSamples. Set the 'PackedDataSource' key of the "
+        + "experiment specifications to the output directory to train on them."
+    )
+    arg_parser.add_argument(
+        "--data",
+        "-d",
+        dest="data_source",
+        required=True,
+        help="The SdfSamples directory with the .npz files and labels.pt.",
+    )
+    arg_parser.add_argument(
+        "--split",
+        "-s",
+        dest="split_filename",
+        required=True,
+        help="The split to pack.",
+    )
+    arg_parser.add_argument(
+        "--output",
+        "-o",
+        dest="packed_dir",
+        required=True,
+        help="The directory to write the packed samples to.",
+    )
+    arg_parser.add_argument(
+        "--workers",
+        dest="num_workers",
+        default=8,
+        type=int,
+        help="Number of threads that load the .npz files.",
+    )
+    deep_sdf.add_common_args(arg_parser)
+
+    args = arg_parser.parse_args()
+
+    deep_sdf.configure_logging(args)
+
+    with open(args.split_filename, "r") as f:
+        split = json.load(f)
+
+    deep_sdf.data.pack_sdf_samples(args.data_source, split, args.packed_dir, num_workers=args.num_workers)
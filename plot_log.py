@@ -5,7 +5,6 @@ import logging
 import matplotlib.pyplot as plt
 import numpy as np
 import os
-import torch
 import deep_sdf
 import deep_sdf.workspace as ws
 
@@ -17,7 +16,7 @@ def running_mean(x, N):
 
 def load_logs(experiment_directory, type):
 
-    logs = torch.load(os.path.join(experiment_directory, ws.logs_filename))
+    logs = ws.load_logs(experiment_directory)
 
     logging.info("latest epoch is {}".format(logs["epoch"]))
 
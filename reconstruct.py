@@ -13,6 +13,22 @@ from deep_sdf import data, utils, mesh
 import deep_sdf.workspace as ws
 
 
+def has_converged(losses, grad_norm=None, window=100, rtol=1e-3, grad_norm_tol=None):
+    """
+    Convergence criterion of the latent code optimization. The optimization has converged if the
+    mean loss of the last `window` iterations improved by less than `rtol` relative to the window
+    before, or if the norm of the latent code gradient dropped below `grad_norm_tol`. Either check
+    is disabled by setting it to None.
+    """
+    if grad_norm_tol is not None and grad_norm is not None and grad_norm < grad_norm_tol:
+        return True
+    if not window or rtol is None or len(losses) < 2 * window:
+        return False
+    previous = sum(losses[-2 * window : -window]) / window
+    current = sum(losses[-window:]) / window
+    return previous - current < rtol * abs(previous)
+
+
 def reconstruct(
     decoder,
     num_iterations,
@@ -24,7 +40,17 @@ def reconstruct(
     lr=5e-4,
     l2reg=False,
     return_loss_hist=False,
+    device=None,
+    convergence_window=100,
+    convergence_rtol=1e-3,
+    grad_norm_tol=None,
 ):
+    """
+    Fits a latent code to the SDF samples `test_sdf`. The learning rate drops tenfold halfway
+    through, or earlier once has_converged at the initial learning rate. The optimization stops
+    once has_converged on the losses since the drop, so the fine-tuning at the lower learning
+    rate always runs. The number of iterations performed is the length of the loss history.
+    """
     def adjust_learning_rate(
         initial_lr, optimizer, num_iterations, decreased_by, adjust_lr_every
     ):
@@ -34,11 +60,15 @@ def reconstruct(
 
     decreased_by = 10
     adjust_lr_every = int(num_iterations / 2)
+    lr_drop = adjust_lr_every
+
+    if device is None:
+        device = utils.get_module_device(decoder)
 
     if type(stat) == type(0.1):
-        latent = torch.ones(1, latent_size).normal_(mean=0, std=stat).cuda()
+        latent = torch.ones(1, latent_size).normal_(mean=0, std=stat).to(device)
     else:
-        latent = torch.normal(stat[0].detach(), stat[1].detach()).cuda()
+        latent = torch.normal(stat[0].detach(), stat[1].detach()).to(device)
 
     latent.requires_grad = True
 
@@ -53,25 +83,18 @@ def reconstruct(
         decoder.eval()
         sdf_data = data.unpack_sdf_samples_from_ram(
             test_sdf, num_samples
-        ).cuda()
-        xyz = sdf_data[:, 0:3]
+        ).to(device)
+        xyz = sdf_data[:, 0:3].unsqueeze(0)
         sdf_gt = sdf_data[:, 3].unsqueeze(1)
 
         sdf_gt = torch.clamp(sdf_gt, -clamp_dist, clamp_dist)
 
-        adjust_learning_rate(lr, optimizer, e, decreased_by, adjust_lr_every)
+        # Shifted by an early learning rate drop.
+        adjust_learning_rate(lr, optimizer, e + adjust_lr_every - lr_drop, decreased_by, adjust_lr_every)
 
         optimizer.zero_grad()
 
-        latent_inputs = latent.expand(num_samples, -1)
-
-        inputs = torch.cat([latent_inputs, xyz], 1).cuda()
-
-        pred_sdf = decoder(inputs)
-
-        # TODO: why is this needed?
-        if e == 0:
-            pred_sdf = decoder(inputs)
+        pred_sdf = decoder(latent, xyz)
 
         pred_sdf = torch.clamp(pred_sdf, -clamp_dist, clamp_dist)
 
@@ -88,11 +111,128 @@ def reconstruct(
         loss_num = loss.cpu().data.numpy()
         all_losses.append(loss_num)
 
+        # Every learning rate phase is tested on its own losses.
+        phase_start = lr_drop if e >= lr_drop else 0
+        grad_norm = latent.grad.norm().item() if grad_norm_tol is not None else None
+        if has_converged(
+            all_losses[phase_start:], grad_norm, convergence_window, convergence_rtol, grad_norm_tol
+        ):
+            if e >= lr_drop:
+                logging.debug(f"converged after {e + 1} iterations")
+                break
+            lr_drop = e + 1
+
     if return_loss_hist:
         return all_losses, latent
     return loss_num, latent
 
 
+def reconstruct_batched(
+    decoder,
+    num_iterations,
+    latent_size,
+    test_sdfs,
+    stat,
+    clamp_dist,
+    num_samples=30000,
+    lr=5e-4,
+    l2reg=False,
+    return_loss_hist=False,
+    device=None,
+    convergence_window=100,
+    convergence_rtol=1e-3,
+    grad_norm_tol=None,
+):
+    """
+    Same as reconstruct, but optimizes the latent codes of all shapes in `test_sdfs` concurrently
+    against the shared decoder. Every shape has its own loss, its own Adam state and learning rate
+    schedule, so the result is the same as calling reconstruct for each of them. `num_iterations`
+    is either an int or a list with the iteration budget of every shape; a shape leaves the block
+    once its budget is used up or it has converged.
+
+    Returns a list of losses (or loss histories) and a list of 1 x L latent codes.
+    """
+    decreased_by = 10
+    num_shapes = len(test_sdfs)
+    if isinstance(num_iterations, int):
+        num_iterations = [num_iterations] * num_shapes
+    adjust_lr_every = [int(n / 2) for n in num_iterations]
+    lr_drop = list(adjust_lr_every)
+
+    if device is None:
+        device = utils.get_module_device(decoder)
+
+    latents = []
+    for _ in range(num_shapes):
+        if type(stat) == type(0.1):
+            latent = torch.ones(1, latent_size).normal_(mean=0, std=stat).to(device)
+        else:
+            latent = torch.normal(stat[0].detach(), stat[1].detach()).to(device)
+        latent.requires_grad = True
+        latents.append(latent)
+
+    # One parameter group per shape so that every shape has its own learning rate. Shapes that are
+    # not part of an iteration have no gradient and are skipped by Adam.
+    optimizer = torch.optim.Adam([{"params": [latent]} for latent in latents], lr=lr)
+
+    all_losses = [[] for _ in range(num_shapes)]
+    converged = [False] * num_shapes
+
+    decoder.eval()
+    for e in range(max(num_iterations)):
+        active = [i for i in range(num_shapes) if e < num_iterations[i] and not converged[i]]
+        if not active:
+            break
+
+        sdf_data = torch.stack(
+            [data.unpack_sdf_samples_from_ram(test_sdfs[i], num_samples) for i in active]
+        ).to(device)
+        xyz = sdf_data[:, :, 0:3]
+        sdf_gt = torch.clamp(sdf_data[:, :, 3], -clamp_dist, clamp_dist)
+
+        for i in active:
+            exponent = (e + adjust_lr_every[i] - lr_drop[i]) // adjust_lr_every[i]
+            optimizer.param_groups[i]["lr"] = lr * ((1 / decreased_by) ** exponent)
+
+        optimizer.zero_grad()
+
+        latent = torch.cat([latents[i] for i in active], 0)
+
+        pred_sdf = decoder(latent, xyz).reshape(len(active), -1)
+
+        pred_sdf = torch.clamp(pred_sdf, -clamp_dist, clamp_dist)
+
+        loss = torch.mean(torch.abs(pred_sdf - sdf_gt), dim=1)
+        if l2reg:
+            loss = loss + 1e-4 * torch.mean(latent.pow(2), dim=1)
+        # The shapes do not share parameters, so the gradient of the sum is the gradient of every
+        # shape's own loss.
+        loss.sum().backward()
+        optimizer.step()
+
+        loss = loss.detach().cpu().numpy()
+        for j, i in enumerate(active):
+            all_losses[i].append(loss[j])
+            # Like in reconstruct, per learning rate phase.
+            phase_start = lr_drop[i] if e >= lr_drop[i] else 0
+            grad_norm = latents[i].grad.norm().item() if grad_norm_tol is not None else None
+            if has_converged(
+                all_losses[i][phase_start:], grad_norm, convergence_window, convergence_rtol, grad_norm_tol
+            ):
+                if e >= lr_drop[i]:
+                    converged[i] = True
+                else:
+                    lr_drop[i] = e + 1
+
+        if e % 50 == 0:
+            logging.debug(f"{e}: {len(active)} shapes, mean loss {loss.mean()}")
+
+    latents = [latent.detach() for latent in latents]
+    if return_loss_hist:
+        return all_losses, latents
+    return [losses[-1] for losses in all_losses], latents
+
+
 if __name__ == "__main__":
 
     arg_parser = argparse.ArgumentParser(
@@ -135,20 +275,62 @@ if __name__ == "__main__":
         default=800,
         help="The number of iterations of latent code optimization to perform.",
     )
+    arg_parser.add_argument(
+        "--convergence_window",
+        dest="convergence_window",
+        default=100,
+        type=int,
+        help="Drop the learning rate of a shape early once its mean loss over this many iterations "
+        + "improved by less than --convergence_rtol, and stop its optimization once that holds again "
+        + "at the lower learning rate. Set to 0 to always run all iterations.",
+    )
+    arg_parser.add_argument(
+        "--convergence_rtol",
+        dest="convergence_rtol",
+        default=1e-3,
+        type=float,
+        help="The relative loss improvement below which the optimization is considered converged.",
+    )
+    arg_parser.add_argument(
+        "--grad_norm_tol",
+        dest="grad_norm_tol",
+        default=None,
+        type=float,
+        help="If set, also stop the optimization of a shape once the norm of its latent code "
+        + "gradient drops below this value.",
+    )
     arg_parser.add_argument(
         "--skip",
         dest="skip",
         action="store_true",
         help="Skip meshes which have already been reconstructed.",
     )
+    arg_parser.add_argument(
+        "--batch_size",
+        dest="batch_size",
+        default=1,
+        type=int,
+        help="Number of shapes whose latent codes are optimized concurrently. Shapes are "
+        + "reconstructed one after another if 1 (this is the default).",
+    )
+    arg_parser.add_argument(
+        "--mesh_batch",
+        dest="mesh_batch",
+        default=8,
+        type=int,
+        help="Number of reconstructed shapes whose meshes are created together.",
+    )
     utils.add_common_args(arg_parser)
+    utils.add_device_args(arg_parser)
+    utils.add_compile_args(arg_parser)
+    utils.add_meshing_args(arg_parser)
 
     args = arg_parser.parse_args()
 
     utils.configure_logging(args)
 
     def empirical_stat(latent_vecs, indices):
-        lat_mat = torch.zeros(0).cuda()
+        lat_mat = torch.zeros(0).to(device)
         for ind in indices:
             lat_mat = torch.cat([lat_mat, latent_vecs[ind]], 0)
         mean = torch.mean(lat_mat, 0)
@@ -164,24 +346,17 @@ if __name__ == "__main__":
 
     specs = json.load(open(specs_filename))
 
+    device = utils.configure_device(args.device, args.num_threads, specs)
+
     arch = __import__("networks." + specs["NetworkArch"], fromlist=["Decoder"])
 
     latent_size = specs["CodeLength"]
 
-    decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"])
-
-    decoder = torch.nn.DataParallel(decoder)
+    decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"]).to(device)
 
-    saved_model_state = torch.load(
-        os.path.join(
-            args.experiment_directory, ws.model_params_subdir, args.checkpoint + ".pth"
-        )
+    saved_model_epoch = ws.load_model_parameters(
+        args.experiment_directory, args.checkpoint, decoder, device
     )
-    saved_model_epoch = saved_model_state["epoch"]
-
-    decoder.load_state_dict(saved_model_state["model_state_dict"])
-
-    decoder = decoder.module.cuda()
 
     with open(args.split_filename, "r") as f:
         split = json.load(f)
@@ -219,19 +394,38 @@ if __name__ == "__main__":
     if not os.path.isdir(reconstruction_codes_dir):
         os.makedirs(reconstruction_codes_dir)
 
-    for ii, npz in enumerate(npz_filenames):
+    # Meshes are created in batches of several shapes (see mesh.create_meshes).
+    pending_latents = []
+    pending_mesh_filenames = []
+
+    def create_pending_meshes():
+        if not pending_latents:
+            return
+        start = time.time()
+        with torch.no_grad():
+            mesh.create_meshes(
+                decoder,
+                pending_latents,
+                pending_mesh_filenames,
+                N=256,
+                max_batch=int(2 ** 18),
+                shapes_per_batch=args.mesh_batch,
+                use_compile=not args.no_compile,
+                refinement_levels=args.refinement_levels,
+            )
+        logging.info("total time: {}".format(time.time() - start))
+        pending_latents.clear()
+        pending_mesh_filenames.clear()
+
+    # Collect the shapes to reconstruct first, they are optimized in blocks of args.batch_size.
+    jobs = []
+    for npz in npz_filenames:
 
         if "npz" not in npz:
             continue
 
         #full_filename = os.path.join(args.data_source, ws.sdf_samples_subdir, npz)
 
-        full_filename = npz
-
-        logging.debug("loading {}".format(npz))
-
-        data_sdf = data.read_sdf_samples_into_ram(full_filename)
-
         for k in range(repeat):
 
             if rerun > 1:
@@ -254,31 +448,71 @@ if __name__ == "__main__":
             ):
                 continue
 
+            jobs.append((npz, mesh_filename, latent_filename))
+
+    for ii in range(0, len(jobs), args.batch_size):
+        block = jobs[ii : ii + args.batch_size]
+
+        data_sdfs = []
+        for npz, _, _ in block:
+            full_filename = npz
+
+            logging.debug("loading {}".format(npz))
+
+            data_sdf = data.read_sdf_samples_into_ram(full_filename)
+
             logging.info("reconstructing {}".format(npz))
 
             data_sdf[0] = data_sdf[0][torch.randperm(data_sdf[0].shape[0])]
             data_sdf[1] = data_sdf[1][torch.randperm(data_sdf[1].shape[0])]
+            data_sdfs.append(data_sdf)
 
-            start = time.time()
-            err, latent = reconstruct(
+        start = time.time()
+        if args.batch_size > 1:
+            loss_hists, latents = reconstruct_batched(
                 decoder,
                 int(args.iterations),
                 latent_size,
-                data_sdf,
+                data_sdfs,
                 0.01,  # [emp_mean,emp_var],
                 0.1,
                 num_samples=8000,
                 lr=5e-3,
                 l2reg=True,
+                return_loss_hist=True,
+                convergence_window=args.convergence_window,
+                convergence_rtol=args.convergence_rtol,
+                grad_norm_tol=args.grad_norm_tol,
             )
-            logging.debug("reconstruct time: {}".format(time.time() - start))
-            err_sum += err
-            logging.debug("current_error avg: {}".format((err_sum / (ii + 1))))
-            logging.debug(ii)
+        else:
+            loss_hist, latent = reconstruct(
+                decoder,
+                int(args.iterations),
+                latent_size,
+                data_sdfs[0],
+                0.01,  # [emp_mean,emp_var],
+                0.1,
+                num_samples=8000,
+                lr=5e-3,
+                l2reg=True,
+                return_loss_hist=True,
+                convergence_window=args.convergence_window,
+                convergence_rtol=args.convergence_rtol,
+                grad_norm_tol=args.grad_norm_tol,
+            )
+            loss_hists, latents = [loss_hist], [latent]
+        logging.debug("reconstruct time: {}".format(time.time() - start))
+        for (npz, _, _), loss_hist in zip(block, loss_hists):
+            logging.info("{}: {} iterations, loss {}".format(npz, len(loss_hist), loss_hist[-1]))
+        err_sum += sum(loss_hist[-1] for loss_hist in loss_hists)
+        logging.debug("current_error avg: {}".format((err_sum / (ii + len(block)))))
+        logging.debug(ii)
 
-            logging.debug("latent: {}".format(latent.detach().cpu().numpy()))
+        decoder.eval()
 
-            decoder.eval()
+        for (npz, mesh_filename, latent_filename), latent in zip(block, latents):
+
+            logging.debug("latent: {}".format(latent.detach().cpu().numpy()))
 
             if not os.path.exists(os.path.dirname(mesh_filename)):
                 os.makedirs(os.path.dirname(mesh_filename))
@@ -286,14 +520,15 @@ if __name__ == "__main__":
             logging.info("Mesh File Name: {}".format(mesh_filename))
 
             if not save_latvec_only:
-                start = time.time()
-                with torch.no_grad():
-                    mesh.create_mesh(
-                        decoder, latent, mesh_filename, N=256, max_batch=int(2 ** 18)
-                    )
-                logging.info("total time: {}".format(time.time() - start))
+                pending_latents.append(latent.detach())
+                pending_mesh_filenames.append(mesh_filename)
 
             if not os.path.exists(os.path.dirname(latent_filename)):
                 os.makedirs(os.path.dirname(latent_filename))
 
             torch.save(latent.unsqueeze(0), latent_filename)
+
+        if len(pending_latents) >= args.mesh_batch:
+            create_pending_meshes()
+
+    create_pending_meshes()
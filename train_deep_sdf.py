@@ -14,6 +14,8 @@ import json
 import time
 import copy
 import random
+import concurrent.futures
+import multiprocessing
 import numpy as np
 
 import deep_sdf
@@ -31,21 +33,23 @@ temp_reg = 20 # change this?
 w_cls = 0.5
 threshold = 0.5
 
-def save_model(experiment_directory, filename, decoder, epoch):
+def save_model(experiment_directory, filename, decoder, epoch, writer=None):
 
     model_params_dir = ws.get_model_params_dir(experiment_directory, True)
 
-    torch.save(
+    save = ws.save_atomically if writer is None else writer.save
+    save(
         {"epoch": epoch, "model_state_dict": decoder.state_dict()},
         os.path.join(model_params_dir, filename),
     )
 
 
-def save_optimizer(experiment_directory, filename, optimizer, epoch):
+def save_optimizer(experiment_directory, filename, optimizer, epoch, writer=None):
 
     optimizer_params_dir = ws.get_optimizer_params_dir(experiment_directory, True)
 
-    torch.save(
+    save = ws.save_atomically if writer is None else writer.save
+    save(
         {"epoch": epoch, "optimizer_state_dict": optimizer.state_dict()},
         os.path.join(optimizer_params_dir, filename),
     )
@@ -62,20 +66,22 @@ def load_optimizer(experiment_directory, filename, optimizer):
             'optimizer state dict "{}" does not exist'.format(full_filename)
         )
 
-    data = torch.load(full_filename)
+    # The optimizer moves its state to the devices of the parameters itself.
+    data = torch.load(full_filename, map_location="cpu")
 
     optimizer.load_state_dict(data["optimizer_state_dict"])
 
     return data["epoch"]
 
 
-def save_latent_vectors(experiment_directory, filename, latent_vec, epoch):
+def save_latent_vectors(experiment_directory, filename, latent_vec, epoch, writer=None):
 
     latent_codes_dir = ws.get_latent_codes_dir(experiment_directory, True)
 
     all_latents = latent_vec.state_dict()
 
-    torch.save(
+    save = ws.save_atomically if writer is None else writer.save
+    save(
         {"epoch": epoch, "latent_codes": all_latents},
         os.path.join(latent_codes_dir, filename),
     )
@@ -91,7 +97,7 @@ def load_latent_vectors(experiment_directory, filename, lat_vecs):
     if not os.path.isfile(full_filename):
         raise Exception('latent state file "{}" does not exist'.format(full_filename))
 
-    data = torch.load(full_filename)
+    data = torch.load(full_filename, map_location="cpu")
 
     if isinstance(data["latent_codes"], torch.Tensor):
 
@@ -115,6 +121,26 @@ def load_latent_vectors(experiment_directory, filename, lat_vecs):
     return data["epoch"]
 
 
+def get_log_records(loss_log, lr_log, timing_log, lat_mag_log, param_mag_log, first_epoch, last_epoch):
+    """Returns one JSON record per epoch from `first_epoch` to `last_epoch`, as stored in Logs.jsonl."""
+
+    iters_per_epoch = len(loss_log) // max(len(lr_log), 1)
+
+    return [
+        json.dumps(
+            {
+                "epoch": epoch,
+                "loss": loss_log[(epoch - 1) * iters_per_epoch : epoch * iters_per_epoch],
+                "learning_rate": lr_log[epoch - 1],
+                "timing": timing_log[epoch - 1],
+                "latent_magnitude": float(lat_mag_log[epoch - 1]),
+                "param_magnitude": {n: float(m[epoch - 1]) for n, m in param_mag_log.items()},
+            }
+        )
+        for epoch in range(first_epoch, last_epoch + 1)
+    ]
+
+
 def save_logs(
     experiment_directory,
     loss_log,
@@ -122,30 +148,25 @@ def save_logs(
     timing_log,
     lat_mag_log,
     param_mag_log,
+    logged_epoch,
     epoch,
+    writer=None,
 ):
+    """Appends the records of the epochs after `logged_epoch` up to `epoch` to Logs.jsonl."""
 
-    torch.save(
-        {
-            "epoch": epoch,
-            "loss": loss_log,
-            "learning_rate": lr_log,
-            "timing": timing_log,
-            "latent_magnitude": lat_mag_log,
-            "param_magnitude": param_mag_log,
-        },
-        os.path.join(experiment_directory, ws.logs_filename),
+    records = get_log_records(
+        loss_log, lr_log, timing_log, lat_mag_log, param_mag_log, logged_epoch + 1, epoch
     )
+    filename = ws.get_log_records_filename(experiment_directory)
+    if writer is None:
+        ws.append_lines(records, filename)
+    else:
+        writer.append_lines(records, filename)
 
 
 def load_logs(experiment_directory):
 
-    full_filename = os.path.join(experiment_directory, ws.logs_filename)
-
-    if not os.path.isfile(full_filename):
-        raise Exception('log file "{}" does not exist'.format(full_filename))
-
-    data = torch.load(full_filename)
+    data = ws.load_logs(experiment_directory)
 
     return (
         data["loss"],
@@ -191,7 +212,217 @@ def append_parameter_magnitudes(param_mag_log, model):
         param_mag_log[name].append(param.data.norm().item())
 
 
-def main_function(experiment_directory: str, continue_from, batch_split: int):
+def evaluate_train_shapes(decoder, latents, names, mesh_filenames, gt_path, grid_res, refinement_levels=0):
+    """Meshes the learned latent codes of training shapes and computes the Chamfer distances to their GT meshes."""
+    start = time.time()
+    with torch.no_grad():
+        train_meshes = mesh.create_meshes(
+            decoder,
+            latents,
+            mesh_filenames,
+            N=grid_res,
+            max_batch=int(2 ** 18),
+            return_trimesh=True,
+            refinement_levels=refinement_levels,
+        )
+    logging.debug("[Train eval] Total time to create training meshes: {}".format(time.time() - start))
+
+    chamfer_dists = []
+    chamfer_dists_all = []
+    for save_name, train_mesh in zip(names, train_meshes):
+        if train_mesh is not None:
+            gt_mesh_path = f"{gt_path}/{save_name}.obj"
+            cd, cd_all = metrics.compute_metric(gt_mesh=gt_mesh_path, gen_mesh=train_mesh, metric="chamfer")
+            chamfer_dists.append(cd)
+            chamfer_dists_all.append(cd_all)
+
+    return {
+        "chamfer_dists": chamfer_dists,
+        "chamfer_dists_all": chamfer_dists_all,
+        "seconds": time.time() - start,
+        "num_shapes": len(names),
+    }
+
+
+def evaluate_test_shapes(
+    decoder, sdf_filenames, names, mesh_filenames, gt_path, grid_res, latent_size, num_iterations, refinement_levels=0
+):
+    """Reconstructs the latent codes of test shapes from their SDF samples, meshes them and computes the Chamfer distances."""
+    eval_test_time_start = time.time()
+    test_err_sum = 0.
+    test_loss_hists = []
+    test_latents = []
+    for test_fpath in sdf_filenames:
+        test_sdf_samples = deep_sdf.data.read_sdf_samples_into_ram(test_fpath)
+        test_sdf_samples[0] = test_sdf_samples[0][torch.randperm(test_sdf_samples[0].shape[0])]
+        test_sdf_samples[1] = test_sdf_samples[1][torch.randperm(test_sdf_samples[1].shape[0])]
+
+        start = time.time()
+        test_loss_hist, test_latent = reconstruct.reconstruct(
+            decoder,
+            num_iterations,
+            latent_size,
+            test_sdf_samples,
+            0.01,  # [emp_mean,emp_var],
+            0.1,
+            num_samples=8000,
+            lr=5e-3,
+            l2reg=True,
+            return_loss_hist=True
+        )
+        logging.debug("[Test eval] Total reconstruction time: {} ({} iterations)".format(time.time() - start, len(test_loss_hist)))
+        if not np.isnan(test_loss_hist[-1]):
+            test_err_sum += test_loss_hist[-1]
+        test_loss_hists.append(test_loss_hist)
+        test_latents.append(test_latent.detach().cpu())
+
+        del test_sdf_samples
+
+    start = time.time()
+    with torch.no_grad():
+        test_meshes = mesh.create_meshes(
+            decoder,
+            test_latents,
+            mesh_filenames,
+            N=grid_res,
+            max_batch=int(2 ** 18),
+            return_trimesh=True,
+            refinement_levels=refinement_levels,
+        )
+    logging.debug("[Test eval] Total time to create test meshes: {}".format(time.time() - start))
+
+    chamfer_dists = []
+    chamfer_dists_all = []
+    for save_name, test_mesh in zip(names, test_meshes):
+        if test_mesh is not None:
+            gt_mesh_path = f"{gt_path}/{save_name}.obj"
+            cd, cd_all = metrics.compute_metric(gt_mesh=gt_mesh_path, gen_mesh=test_mesh, metric="chamfer")
+            chamfer_dists.append(cd)
+            chamfer_dists_all.append(cd_all)
+
+    return {
+        "chamfer_dists": chamfer_dists,
+        "chamfer_dists_all": chamfer_dists_all,
+        "loss_hists": test_loss_hists,
+        "latents": test_latents,
+        "test_err_sum": test_err_sum,
+        "names": names,
+        "seconds": time.time() - eval_test_time_start,
+    }
+
+
+def log_train_evaluation(summary_writer, epoch, results):
+    chamfer_dists = results["chamfer_dists"]
+    if chamfer_dists:
+        logging.debug(f"Chamfer distance mean: {sum(chamfer_dists)/len(chamfer_dists)} from {chamfer_dists}.")            
+        summary_writer.add_scalar("Mean Chamfer Dist/train", sum(chamfer_dists)/len(chamfer_dists), epoch)
+        fig, percentiles = plotting.plot_dist_violin(np.concatenate(results["chamfer_dists_all"], axis=0))
+        summary_writer.add_figure("CD Percentiles/train dists", fig, global_step=epoch)
+        for p in [75, 90, 99]:
+            if p in percentiles:
+                summary_writer.add_scalar(f"CD Percentiles/train {p}th", percentiles[p], global_step=epoch)
+    summary_writer.add_scalar("Time/train eval per shape (sec)", results["seconds"]/results["num_shapes"], epoch)
+
+
+def log_test_evaluation(summary_writer, epoch, results):
+    chamfer_dists = results["chamfer_dists"]
+    num_shapes = len(results["names"])
+    if chamfer_dists:
+        logging.debug(f"Test Chamfer distance mean: {sum(chamfer_dists)/len(chamfer_dists)} from {chamfer_dists}.")            
+        summary_writer.add_scalar("Mean Chamfer Dist/test", sum(chamfer_dists)/len(chamfer_dists), epoch)
+        summary_writer.add_scalar("Loss/test", results["test_err_sum"]/num_shapes, epoch)
+        summary_writer.add_scalar("Iterations/test reconstruction mean", np.mean([len(h) for h in results["loss_hists"]]), epoch)
+        mlm = torch.mean(torch.norm(torch.cat(results["latents"], dim=0), dim=1))
+        summary_writer.add_scalar("Mean Latent Magnitude/test", mlm, global_step=epoch)
+        fig = plotting.plot_train_stats(loss_hists=results["loss_hists"], labels=results["names"])
+        summary_writer.add_figure("Loss/test optimization curves", fig, epoch)
+        fig, percentiles = plotting.plot_dist_violin(np.concatenate(results["chamfer_dists_all"], axis=0))
+        summary_writer.add_figure("CD Percentiles/test dists", fig, global_step=epoch)
+        for p in [75, 90, 99]:
+            if p in percentiles:
+                summary_writer.add_scalar(f"CD Percentiles/test {p}th", percentiles[p], global_step=epoch)
+    summary_writer.add_scalar("Time/test eval per shape (sec)", results["seconds"]/num_shapes, epoch)
+
+
+# The decoder of an evaluation worker process.
+evaluation_decoder = None
+
+
+def init_evaluation_worker(experiment_directory, specs, device, num_threads, log_level):
+    global evaluation_decoder
+    # Replaces the handlers that importing the modules or an early logging call may have set up.
+    logging.basicConfig(level=log_level, format="DeepSdfComp - %(levelname)s - %(message)s", force=True)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    evaluation_decoder = ws.build_decoder(experiment_directory, specs, torch.device(device))
+    evaluation_decoder.eval()
+
+
+def run_evaluation(evaluate, decoder_state, kwargs):
+    evaluation_decoder.load_state_dict(decoder_state)
+    return evaluate(evaluation_decoder, **kwargs)
+
+
+class EvaluationService:
+    """
+    Runs the train and test evaluations during training. With `num_workers` > 0, they run in
+    worker processes instead of blocking the training loop: `submit` snapshots the decoder weights
+    to host memory and returns right away, and `poll` writes the results of the evaluations that
+    finished in the meantime to TensorBoard at the epoch they were submitted for. The workers run
+    on `device`, which may be the CPU while training runs on the GPU.
+    """
+
+    def __init__(self, experiment_directory, specs, device, num_workers=0, num_threads=None):
+        self.executor = None
+        self.pending = []
+        if num_workers > 0:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_evaluation_worker,
+                initargs=(experiment_directory, specs, str(device), num_threads, logging.getLogger().level),
+            )
+            logging.info(f"Evaluating in {num_workers} worker process(es) on {device}")
+
+    def submit(self, evaluate, log, decoder, epoch, **kwargs):
+        """Runs `evaluate(decoder, **kwargs)` and then `log(summary_writer, epoch, results)`."""
+        if self.executor is None:
+            self.pending.append((epoch, log, evaluate(decoder, **kwargs)))
+            return
+        decoder_state = ws.snapshot_to_cpu(getattr(decoder, "module", decoder).state_dict())
+        kwargs = ws.snapshot_to_cpu(kwargs)
+        self.pending.append((epoch, log, self.executor.submit(run_evaluation, evaluate, decoder_state, kwargs)))
+
+    def poll(self, summary_writer, wait=False):
+        """Logs the results of finished evaluations. With `wait`, waits for all of them."""
+        pending = []
+        for epoch, log, results in self.pending:
+            if isinstance(results, concurrent.futures.Future):
+                if not (wait or results.done()):
+                    pending.append((epoch, log, results))
+                    continue
+                try:
+                    results = results.result()
+                except Exception as e:
+                    logging.error(f"Evaluation of epoch {epoch} failed: {e}")
+                    continue
+            log(summary_writer, epoch, results)
+        self.pending = pending
+
+    def close(self, summary_writer):
+        self.poll(summary_writer, wait=True)
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class NullSummaryWriter:
+    """Stands in for the SummaryWriter on all but the main process of distributed training."""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def main_function(experiment_directory: str, continue_from, batch_split: int, device=None, num_threads=None):
 
    
     
@@ -201,6 +432,12 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
 
     logging.info("Experiment description: \n" + str(specs["Description"]))
 
+    device = utils.configure_device(device, num_threads, specs)
+    # Set when launched with torchrun, every process trains on a shard of the shapes.
+    device = deep_sdf.init_distributed(device)
+    distributed = deep_sdf.is_distributed()
+    is_main = deep_sdf.is_main_process()
+
     data_source = specs["DataSource"]
     train_split_file = specs["TrainSplit"]
     test_split_file = specs["TestSplit"]
@@ -226,18 +463,24 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
     lr_schedules = lr_scheduling.get_learning_rate_schedules(specs)
 
     grad_clip = get_spec_with_default(specs, "GradientClipNorm", None)
+    precision = get_spec_with_default(specs, "Precision", "fp32")
+    autocast, grad_scaler = utils.get_precision(precision, device)
+    logging.info(f"Training in {precision} precision")
     if grad_clip is not None:
         logging.debug("clipping gradients to max norm {}".format(grad_clip))
 
+    # Snapshots the state to host memory and writes it on a background thread.
+    checkpoint_writer = ws.CheckpointWriter(background=get_spec_with_default(specs, "AsyncCheckpointing", True))
+
     def save_latest(epoch):
-        save_model(experiment_directory, "latest.pth", decoder, epoch)
-        save_optimizer(experiment_directory, "latest.pth", optimizer_all, epoch)
-        save_latent_vectors(experiment_directory, "latest.pth", lat_vecs, epoch)
+        save_model(experiment_directory, "latest.pth", checkpoint_decoder, epoch, checkpoint_writer)
+        save_optimizer(experiment_directory, "latest.pth", optimizer_all, epoch, checkpoint_writer)
+        save_latent_vectors(experiment_directory, "latest.pth", lat_vecs, epoch, checkpoint_writer)
 
     def save_checkpoints(epoch):
-        save_model(experiment_directory, str(epoch) + ".pth", decoder, epoch)
-        save_optimizer(experiment_directory, str(epoch) + ".pth", optimizer_all, epoch)
-        save_latent_vectors(experiment_directory, str(epoch) + ".pth", lat_vecs, epoch)
+        save_model(experiment_directory, str(epoch) + ".pth", checkpoint_decoder, epoch, checkpoint_writer)
+        save_optimizer(experiment_directory, str(epoch) + ".pth", optimizer_all, epoch, checkpoint_writer)
+        save_latent_vectors(experiment_directory, str(epoch) + ".pth", lat_vecs, epoch, checkpoint_writer)
 
     # def signal_handler(sig, frame):
     #     logging.info("Stopping early...")
@@ -248,7 +491,7 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
             param_group["lr"] = lr_schedules[i].get_learning_rate(epoch, loss_log)
 
     def empirical_stat(latent_vecs, indices):
-        lat_mat = torch.zeros(0).cuda()
+        lat_mat = torch.zeros(0).to(device)
         for ind in indices:
             lat_mat = torch.cat([lat_mat, latent_vecs[ind]], 0)
         mean = torch.mean(lat_mat, 0)
@@ -270,11 +513,22 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
 
     code_bound = get_spec_with_default(specs, "CodeBound", None)
 
-    decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"]).cuda()
+    decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"]).to(device)
 
-    logging.info("training with {} GPU(s)".format(torch.cuda.device_count()))
+    if distributed:
+        decoder = torch.nn.parallel.DistributedDataParallel(
+            decoder, device_ids=[device] if device.type == "cuda" else None
+        )
+    elif device.type == "cuda":
+        logging.info("training with {} GPU(s)".format(torch.cuda.device_count()))
+        decoder = torch.nn.DataParallel(decoder)
+    else:
+        logging.info("training on the CPU with {} threads".format(torch.get_num_threads()))
 
-    decoder = torch.nn.DataParallel(decoder)
+    # Evaluation only runs on the main process, so it must not go through DistributedDataParallel.
+    eval_decoder = decoder.module if distributed else decoder
+    # Checkpoints hold the unwrapped parameter names so that they load on any device.
+    checkpoint_decoder = getattr(decoder, "module", decoder)
 
     num_epochs = specs["NumEpochs"]
     log_frequency = get_spec_with_default(specs, "LogFrequency", 100)
@@ -287,26 +541,62 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
     if not os.path.exists(torus_path): 
         logging.error(f"Running w/o validation, since the specified Torus path does not exist: {torus_path}")
         torus_path = None
+    packed_data_source = get_spec_with_default(specs, "PackedDataSource", None)
     load_ram = get_spec_with_default(specs, "LoadDatasetIntoRAM", False)
-    if load_ram:
-        logging.info(f"Loading SDF samples into memory because LoadDatasetIntoRAM=true")
-    sdf_dataset = deep_sdf.data.SDFSamples(
-        data_source, train_split, num_samp_per_scene, load_ram=load_ram
-    )
+    if packed_data_source is not None:
+        logging.info(f"Reading memory-mapped SDF samples from {packed_data_source}")
+        sdf_dataset = deep_sdf.data.PackedSDFSamples(
+            packed_data_source, train_split, num_samp_per_scene
+        )
+    else:
+        if load_ram:
+            logging.info(f"Loading SDF samples into memory because LoadDatasetIntoRAM=true")
+        sdf_dataset = deep_sdf.data.SDFSamples(
+            data_source,
+            train_split,
+            num_samp_per_scene,
+            load_ram=load_ram,
+            num_load_workers=get_spec_with_default(specs, "LoadDatasetWorkers", 8),
+            ram_cache=get_spec_with_default(specs, "LoadDatasetCache", True),
+            lazy_load=get_spec_with_default(specs, "LoadDatasetLazily", False),
+        )
 
-    num_data_loader_threads = get_spec_with_default(specs, "DataLoaderThreads", 1)
-    logging.debug("loading data with {} threads".format(num_data_loader_threads))
-    
-    sdf_loader = data_utils.DataLoader(
-        sdf_dataset,
-        batch_size=scene_per_batch,
-        shuffle=True,
-        num_workers=num_data_loader_threads,
-        drop_last=True,         # to avoid unstable gradients in last batch
-    )
+    if get_spec_with_default(specs, "DeviceSampler", False):
+        # Keeps all samples on the training device and draws every batch with one gather.
+        logging.info(f"Sampling batches on {device} because DeviceSampler=true")
+        sdf_loader = deep_sdf.data.DeviceSDFSampler(
+            sdf_dataset,
+            num_samp_per_scene,
+            scene_per_batch,
+            device,
+            rank=deep_sdf.get_rank(),
+            world_size=deep_sdf.get_world_size(),
+        )
+        sdf_sampler = None
+    else:
+        num_data_loader_threads = get_spec_with_default(specs, "DataLoaderThreads", 1)
+        if isinstance(sdf_dataset, deep_sdf.data.SDFSamples) and sdf_dataset.loads_lazily():
+            # Workers would load every shape again each epoch and never complete the RAM cache.
+            logging.info("Loading data in the main process because LoadDatasetLazily=true and the cache is incomplete")
+            num_data_loader_threads = 0
+        logging.debug("loading data with {} threads".format(num_data_loader_threads))
+
+        # Every process draws its batches from a different shard of the shapes.
+        sdf_sampler = data_utils.distributed.DistributedSampler(sdf_dataset) if distributed else None
+        sdf_loader = data_utils.DataLoader(
+            sdf_dataset,
+            batch_size=scene_per_batch,
+            shuffle=sdf_sampler is None,
+            sampler=sdf_sampler,
+            num_workers=num_data_loader_threads,
+            drop_last=True,         # to avoid unstable gradients in last batch
+        )
+
+    batch_times = deep_sdf.utils.TimingHistogram(num_slots=1)
 
     # Get train evaluation settings.
     eval_grid_res = get_spec_with_default(specs, "EvalGridResolution", 256)
+    eval_refinement_levels = get_spec_with_default(specs, "EvalRefinementLevels", 0)
     eval_train_scene_num = get_spec_with_default(specs, "EvalTrainSceneNumber", 10)
     eval_train_frequency = get_spec_with_default(specs, "EvalTrainFrequency", 200)
     eval_train_scene_idxs = random.sample(range(len(sdf_dataset)), min(eval_train_scene_num, len(sdf_dataset)))
@@ -329,13 +619,20 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
 
     logging.debug(decoder)
 
-    lat_vecs = torch.nn.Embedding(num_scenes, latent_size, max_norm=code_bound)
+    # With sparse gradients, the cost of a step scales with the batch instead of the number of shapes.
+    sparse_latents = get_spec_with_default(specs, "SparseLatentOptimizer", False)
+    lat_vecs = torch.nn.Embedding(num_scenes, latent_size, max_norm=code_bound, sparse=sparse_latents)
     torch.nn.init.normal_(
         lat_vecs.weight.data,
         0.0,
         get_spec_with_default(specs, "CodeInitStdDev", 1.0) / math.sqrt(latent_size),
     )
 
+    if distributed:
+        # Every process keeps a copy of all codes on its device and applies the same updates.
+        lat_vecs = lat_vecs.to(device)
+        deep_sdf.broadcast_latent_vectors(lat_vecs)
+
     logging.debug(
         "initialized with mean magnitude {}".format(
             get_mean_latent_vector_magnitude(lat_vecs)
@@ -344,18 +641,31 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
 
     loss_l1 = torch.nn.L1Loss(reduction="sum")
 
-    optimizer_all = torch.optim.Adam(
-        [{
-            "params": decoder.parameters(),
-            "lr": lr_schedules[0].get_learning_rate(0),
-        },
-        {
-            "params": lat_vecs.parameters(),
-            "lr": lr_schedules[1].get_learning_rate(0),
-        }]
+    optimizer_all = utils.build_training_optimizer(
+        decoder,
+        lat_vecs,
+        lr_schedules[0].get_learning_rate(0),
+        lr_schedules[1].get_learning_rate(0),
     )
 
-    summary_writer = SummaryWriter(log_dir=os.path.join(experiment_directory, ws.tb_logs_dir))
+    if is_main:
+        summary_writer = SummaryWriter(log_dir=os.path.join(experiment_directory, ws.tb_logs_dir))
+    else:
+        summary_writer = NullSummaryWriter()
+
+    num_eval_workers = get_spec_with_default(specs, "EvalWorkers", 0) if is_main else 0
+    if distributed and is_main and num_eval_workers == 0:
+        # Evaluating in the main process would block the other processes in their next collective
+        # call for longer than the collective timeout.
+        logging.info("Evaluating in a worker process because training is distributed")
+        num_eval_workers = 1
+    evaluation_service = EvaluationService(
+        experiment_directory,
+        specs,
+        utils.get_device(get_spec_with_default(specs, "EvalDevice", None) or device),
+        num_eval_workers,
+        get_spec_with_default(specs, "EvalNumThreads", None),
+    )
 
     loss_log = []               # per-batch
     loss_log_epoch = []         # per-epoch
@@ -363,6 +673,8 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
     lat_mag_log = []
     timing_log = []
     param_mag_log = {}
+    # The last epoch whose logs are in Logs.jsonl.
+    logged_epoch = 0
 
     start_epoch = 1
 
@@ -375,7 +687,7 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
         )
 
         model_epoch = ws.load_model_parameters(
-            experiment_directory, continue_from, decoder
+            experiment_directory, continue_from, checkpoint_decoder, device
         )
 
         optimizer_epoch = load_optimizer(
@@ -404,6 +716,14 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
 
         start_epoch = model_epoch + 1
 
+        # Drops the logs of epochs after the checkpoint and converts the logs of older experiments.
+        logged_epoch = len(lr_log)
+        if is_main:
+            ws.write_log_records(
+                experiment_directory,
+                get_log_records(loss_log, lr_log, timing_log, lat_mag_log, param_mag_log, 1, logged_epoch),
+            )
+
         logging.debug("loaded")
 
     logging.info("starting from epoch {}".format(start_epoch))
@@ -421,6 +741,9 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
         )
     )
     
+    SNN_Loss = loss.FusedSNNLoss(temp)
+    SNN_Loss_Reg = loss.FusedSNNLoss(temp_reg, threshold)
+
     try:
         train_chamfer_dists_log = []
         test_chamfer_dists_log = []
@@ -443,8 +766,15 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
             decoder.train()
 
             adjust_learning_rate(lr_schedules, optimizer_all, epoch, loss_log_epoch)
+            if sdf_sampler is not None:
+                sdf_sampler.set_epoch(epoch)
+            batch_times.reset()
+            if hasattr(sdf_dataset, "item_times"):
+                sdf_dataset.item_times.reset()
+            TIME = time.time()
             for sdf_data, indices, labels, filenames in sdf_loader:
-                # logging.debug(f"time for dataloading: {(time.time() - TIME)*1000:.3f} ms"); TIME = time.time()
+                # Time the training loop waited for this batch.
+                batch_times.add(time.time() - TIME)
                 # Process the input data
                 sdf_data = sdf_data.reshape(-1, 4)
 
@@ -465,8 +795,8 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
                 labels_cls = labels_cls.to(torch.float32)
                 labels_reg = labels_reg.to(torch.float32)
 
-                labels_cls = labels_cls.to(torch.device("cuda"))
-                labels_reg = labels_reg.to(torch.device("cuda"))
+                labels_cls = labels_cls.to(device)
+                labels_reg = labels_reg.to(device)
 
                 #logging.info(f"labels_cls shape: {labels_cls.shape}")
                 #logging.info(f"labels_cls data type: {labels_cls.dtype}")
@@ -482,6 +812,11 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
 
                 xyz = torch.chunk(xyz, batch_split)
 
+                if distributed:
+                    shape_indices = indices.to(device)
+                    all_shape_indices = deep_sdf.all_gather_cat(shape_indices)
+                    deep_sdf.renorm_latent_vectors(lat_vecs, all_shape_indices)
+
                 indices_z = torch.chunk(indices, batch_split)
                 
                 indices = torch.chunk(
@@ -490,8 +825,8 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
                 )
 
                 #labels_cls = labels_cls.chunk(labels_cls.unsqueeze(-1).repeat(1, num_samp_per_scene).view(-1), batch_split)
-                labels_cls = torch.chunk(labels_cls, batch_split)
-                labels_reg = torch.chunk(labels_reg, batch_split)
+                labels_cls_chunks = torch.chunk(labels_cls, batch_split)
+                labels_reg_chunks = torch.chunk(labels_reg, batch_split)
 
                 sdf_gt = torch.chunk(sdf_gt, batch_split)
 
@@ -507,14 +842,16 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
                 optimizer_all.zero_grad()
 
                 for i in range(batch_split):
-                    z = lat_vecs(indices_z[i])
-                    batch_vecs = z.unsqueeze(1).repeat(1, num_samp_per_scene, 1).view(-1, latent_size)
+                    z = lat_vecs(indices_z[i].to(lat_vecs.weight.device))
+                    if distributed:
+                        # Only all-reduce the decoder gradients after the last sub-batch.
+                        decoder.require_backward_grad_sync = i == batch_split - 1
                     #print(f"Batch vecs device: {batch_vecs[i].device}")
                     #print(f"z vecs device: {z[i].device}")
                     #batch_vecs = lat_vecs(indices[i])
                     #z_for_c_loss = lat_vecs(indices_z[i])
-                    labels_cls = labels_cls[i].unsqueeze(-1)
-                    labels_reg = labels_reg[i].unsqueeze(-1)
+                    labels_cls = labels_cls_chunks[i].unsqueeze(-1)
+                    labels_reg = labels_reg_chunks[i].unsqueeze(-1)
 
                     #logging.info(f"batch_vecs shape: {batch_vecs.shape}")
                     #logging.info(f"latent vecs z (for loss) shape: {z_for_c_loss.shape}")
@@ -525,24 +862,28 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
                     #logging.info(f"labels_cls: {labels_cls}")
                     #logging.info(f"filename: {filenames}")
 
-                    input = torch.cat([batch_vecs, xyz[i]], dim=1)
-                    #print(f"input device: {input.device}")
-                    
+                    # The decoder projects every latent code once and broadcasts it over
+                    # the samples of its scene instead of taking a per-sample copy.
+                    input = (z.to(device), xyz[i].to(device).reshape(z.shape[0], -1, 3))
+
                     # NN optimization
-                    pred_sdf = decoder(input)
+                    with autocast():
+                        pred_sdf = decoder(*input)
+                    # The losses are computed in fp32.
+                    pred_sdf = pred_sdf.float()
 
                     if enforce_minmax:
                         pred_sdf = torch.clamp(pred_sdf, minT, maxT)
-                    chunk_loss = loss_l1(pred_sdf, sdf_gt[i].cuda()) / num_sdf_samples
+                    chunk_loss = loss_l1(pred_sdf, sdf_gt[i].to(device)) / num_sdf_samples
                     sdf_loss_tb += chunk_loss.item()
 
                     if do_code_regularization:
-                        l2_size_loss = torch.sum(torch.norm(batch_vecs, dim=1))
+                        l2_size_loss = num_samp_per_scene * torch.sum(torch.norm(z, dim=1))
                         reg_loss = (
                             code_reg_lambda * min(1, epoch / 100) * l2_size_loss
                         ) / num_sdf_samples
                     
-                        chunk_loss = chunk_loss + reg_loss.cuda()
+                        chunk_loss = chunk_loss + reg_loss.to(device)
                         reg_loss_tb += reg_loss.item()
                     
                     summary_writer.add_scalar("Loss/train_vanilla", chunk_loss, global_step=epoch)
@@ -555,15 +896,13 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
 
                     if guided_contrastive_loss:
                         #Classification Loss
-                        SNN_Loss = loss.SNNLoss(temp)
-                        loss_snn = SNN_Loss(z, labels_cls)
+                        loss_snn = SNN_Loss(z.to(device), labels_cls)
                         chunk_loss += loss_snn * w_cls
                         #print(loss_snn.item())
                         snnl += loss_snn.item()
                         
                         #Regression Loss
-                        SNN_Loss_Reg = loss.SNNRegLoss(temp_reg, threshold)
-                        loss_snn_reg = SNN_Loss_Reg(z, labels_reg)
+                        loss_snn_reg = SNN_Loss_Reg(z.to(device), labels_reg)
                         chunk_loss += loss_snn_reg * w_cls
                         #print(loss_snn.item())
                         snnl_reg += loss_snn_reg.item()
@@ -572,19 +911,19 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
                     if attribute_loss:
                         loss_attr = loss.AttributeLoss()
                         #cls
-                        loss_attr_cls = loss_attr(z[:,0], labels_cls)
+                        loss_attr_cls = loss_attr(z[:,0].to(device), labels_cls)
                         chunk_loss += loss_attr_cls * w_cls
                         attr_loss += loss_attr_cls.item()
                         
                         #reg
-                        loss_attr_reg = loss_attr(z[:,1], labels_reg)
+                        loss_attr_reg = loss_attr(z[:,1].to(device), labels_reg)
                         chunk_loss += loss_attr_reg * w_cls
                         #print(corr_loss.item())
                         #loss_attribute_cls += loss_attr_cls.item()
                         #loss_attribute_reg += loss_attr_reg.item()
                         attr_loss_reg += loss_attr_reg.item()
                         
-                    chunk_loss.backward()
+                    grad_scaler.scale(chunk_loss).backward()
 
                     batch_loss_tb += chunk_loss.item()
                     # Print batch loss
@@ -601,17 +940,29 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
                 epoch_snnl_reg.append(snnl_reg)
                 epoch_attr_reg.append(attr_loss_reg)
 
+                if distributed:
+                    deep_sdf.sync_latent_gradients(lat_vecs, shape_indices, all_shape_indices)
+
                 if grad_clip is not None:
 
+                    grad_scaler.unscale_(optimizer_all)
                     torch.nn.utils.clip_grad_norm_(decoder.parameters(), grad_clip, norm_type=2)
 
-                optimizer_all.step()
+                grad_scaler.step(optimizer_all)
+                grad_scaler.update()
+                TIME = time.time()
 
             # LOG EPOCH
             seconds_elapsed = time.time() - epoch_time_start
             timing_log.append(seconds_elapsed)
+            # Log data loading times.
+            logging.debug(f"Waiting for batches: {batch_times.summary()}")
+            summary_writer.add_scalar("Time/batch loading (ms)", batch_times.mean()*1000, global_step=epoch)
+            if hasattr(sdf_dataset, "item_times") and sdf_dataset.item_times.count() > 0:
+                logging.debug(f"Getting items: {sdf_dataset.item_times.summary()}")
+                summary_writer.add_scalar("Time/item loading (ms)", sdf_dataset.item_times.mean()*1000, global_step=epoch)
             # Log epoch losses.
-            epoch_loss = sum(epoch_losses)/len(epoch_losses)
+            epoch_loss = deep_sdf.all_reduce_mean(sum(epoch_losses)/len(epoch_losses))
             loss_log_epoch.append(epoch_loss)
             summary_writer.add_scalar("Loss/train", epoch_loss, global_step=epoch)
             summary_writer.add_scalar("Loss/train_sdf", sum(epoch_sdf_losses)/len(epoch_sdf_losses), global_step=epoch)
@@ -637,13 +988,14 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
             summary_writer.add_scalar("Mean Latent Magnitude/train", mlm, global_step=epoch)
             append_parameter_magnitudes(param_mag_log, decoder)
 
-            print(f"Epoch Loss: {epoch_loss}")
-            if guided_contrastive_loss:
-                print(f"SNNL Loss: {sum(epoch_snnl)/len(epoch_snnl)}")
-                print(f"SNNL Reg Loss: {sum(epoch_snnl_reg)/len(epoch_snnl_reg)}")
-            if attribute_loss:
-                print(f"Attribute Loss: {sum(epoch_attr)/len(epoch_attr)}")
-                print(f"Attribute Reg Loss: {sum(epoch_attr_reg)/len(epoch_attr_reg)}")
+            if is_main:
+                print(f"Epoch Loss: {epoch_loss}")
+                if guided_contrastive_loss:
+                    print(f"SNNL Loss: {sum(epoch_snnl)/len(epoch_snnl)}")
+                    print(f"SNNL Reg Loss: {sum(epoch_snnl_reg)/len(epoch_snnl_reg)}")
+                if attribute_loss:
+                    print(f"Attribute Loss: {sum(epoch_attr)/len(epoch_attr)}")
+                    print(f"Attribute Reg Loss: {sum(epoch_attr_reg)/len(epoch_attr_reg)}")
 
             # Log weights and gradient flow.
             grad_norms = []
@@ -659,10 +1011,10 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
             summary_writer.add_scalar(f"GradsNorm/allLatParams.grad", torch.norm(lat_vecs.weight.grad.detach(), p=2).item(), global_step=epoch)
 
             # Save checkpoint.
-            if epoch in checkpoints:
+            if epoch in checkpoints and is_main:
                 save_checkpoints(epoch)
 
-            if epoch % log_frequency == 0:
+            if epoch % log_frequency == 0 and is_main:
                 save_latest(epoch)
                 save_logs(
                     experiment_directory,
@@ -671,133 +1023,78 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
                     timing_log,
                     lat_mag_log,
                     param_mag_log,
-                    epoch,
+                    logged_epoch,
+                    len(lr_log),
+                    checkpoint_writer,
                 )
+                logged_epoch = len(lr_log)
             
             # EVALUATION 
+            # Submitted by the main process only, in distributed training always to worker processes.
             logging.info(f"Torus path: {torus_path}")
-            if torus_path is not None:
+            if torus_path is not None and is_main:
                 logging.info(f"Starting evaluation at epoch {epoch}...")
                 # Only if the path to the GT meshes exists.
                 if epoch % eval_train_frequency == 0:
                     logging.info(f"Train Evaluation Started...")
                     # Training-set evaluation: Reconstruct mesh from learned latent and compute metrics.
-                    chamfer_dists = []
-                    chamfer_dists_all = []
-                    eval_train_time_start = time.time()
+                    save_names = []
+                    mesh_filenames = []
                     for index in eval_train_scene_idxs:
-                        lat_vec = lat_vecs(torch.LongTensor([index])).cuda()
                         save_name = os.path.basename(sdf_dataset.npyfiles[index]).split(".npz")[0]
                         path = os.path.join(experiment_directory, ws.tb_logs_dir, ws.tb_logs_train_reconstructions, save_name)
                         if not os.path.exists(path):
                             os.makedirs(path)
-
-                        start = time.time()
-                        with torch.no_grad():
-                            train_mesh = mesh.create_mesh(
-                                decoder, 
-                                lat_vec, 
-                                N=eval_grid_res, 
-                                max_batch=int(2 ** 18), 
-                                filename=os.path.join(path, f"epoch={epoch}"),
-                                return_trimesh=True,
-                            )
-                        logging.debug("[Train eval] Total time to create training mesh: {}".format(time.time() - start))
-
-                        if train_mesh is not None:
-                            gt_mesh_path = f"{torus_path}/{save_name}.obj"
-                            cd, cd_all = metrics.compute_metric(gt_mesh=gt_mesh_path, gen_mesh=train_mesh, metric="chamfer")
-                            chamfer_dists.append(cd)
-                            chamfer_dists_all.append(cd_all)
-                        
-                        del train_mesh, save_name
-
-                    if chamfer_dists:
-                        logging.debug(f"Chamfer distance mean: {sum(chamfer_dists)/len(chamfer_dists)} from {chamfer_dists}.")            
-                        summary_writer.add_scalar("Mean Chamfer Dist/train", sum(chamfer_dists)/len(chamfer_dists), epoch)
-                        fig, percentiles = plotting.plot_dist_violin(np.concatenate(chamfer_dists_all, axis=0))
-                        summary_writer.add_figure("CD Percentiles/train dists", fig, global_step=epoch)
-                        for p in [75, 90, 99]:
-                            if p in percentiles:
-                                summary_writer.add_scalar(f"CD Percentiles/train {p}th", percentiles[p], global_step=epoch)
-                    summary_writer.add_scalar("Time/train eval per shape (sec)", (time.time()-eval_train_time_start)/len(eval_test_filenames), epoch)
-                    # End of eval train.
+                        save_names.append(save_name)
+                        mesh_filenames.append(os.path.join(path, f"epoch={epoch}"))
+
+                    with torch.no_grad():
+                        train_latents = lat_vecs(torch.LongTensor(eval_train_scene_idxs).to(lat_vecs.weight.device))
+                    evaluation_service.submit(
+                        evaluate_train_shapes,
+                        log_train_evaluation,
+                        eval_decoder,
+                        epoch,
+                        latents=train_latents,
+                        names=save_names,
+                        mesh_filenames=mesh_filenames,
+                        gt_path=torus_path,
+                        grid_res=eval_grid_res,
+                        refinement_levels=eval_refinement_levels,
+                    )
                 
                 if epoch % eval_test_frequency == 0:
                     logging.info(f"Test Evaluation Started...")
                     # Test-set evaluation: Reconstruct latent and mesh from GT sdf values and compute metrics.
-                    eval_test_time_start = time.time()
-                    test_err_sum = 0.
-                    chamfer_dists = []
-                    chamfer_dists_all = []
-                    test_loss_hists = []
                     mesh_label_names = []
-                    test_latents = []
+                    test_fpaths = []
+                    mesh_filenames = []
                     for test_fname in eval_test_filenames:
                         save_name = os.path.basename(test_fname).split(".npz")[0]
                         mesh_label_names.append(save_name)
                         path = os.path.join(experiment_directory, ws.tb_logs_dir, ws.tb_logs_test_reconstructions, save_name)
                         if not os.path.exists(path):
                             os.makedirs(path)
-                        test_fpath = os.path.join(data_source, ws.sdf_samples_subdir, test_fname)
-                        test_sdf_samples = deep_sdf.data.read_sdf_samples_into_ram(test_fpath)
-                        test_sdf_samples[0] = test_sdf_samples[0][torch.randperm(test_sdf_samples[0].shape[0])]
-                        test_sdf_samples[1] = test_sdf_samples[1][torch.randperm(test_sdf_samples[1].shape[0])]
-
-                        start = time.time()
-                        test_loss_hist, test_latent = reconstruct.reconstruct(
-                            decoder,
-                            int(eval_test_optimization_steps),
-                            latent_size,
-                            test_sdf_samples,
-                            0.01,  # [emp_mean,emp_var],
-                            0.1,
-                            num_samples=8000,
-                            lr=5e-3,
-                            l2reg=True,
-                            return_loss_hist=True
-                        )
-                        logging.debug("[Test eval] Total reconstruction time: {}".format(time.time() - start))
-                        if not np.isnan(test_loss_hist[-1]):
-                            test_err_sum += test_loss_hist[-1]
-                        test_loss_hists.append(test_loss_hist)
-                        test_latents.append(test_latent)
-
-                        start = time.time()
-                        with torch.no_grad():
-                            test_mesh = mesh.create_mesh(
-                                decoder, 
-                                test_latent, 
-                                N=eval_grid_res, 
-                                max_batch=int(2 ** 18), 
-                                filename=os.path.join(path, f"epoch={epoch}"),
-                                return_trimesh=True,
-                            )
-                        logging.debug("[Test eval] Total time to create test mesh: {}".format(time.time() - start))
-
-                        if test_mesh is not None:
-                            gt_mesh_path = f"{torus_path}/{save_name}.obj"
-                            cd, cd_all = metrics.compute_metric(gt_mesh=gt_mesh_path, gen_mesh=test_mesh, metric="chamfer")
-                            chamfer_dists.append(cd)
-                            chamfer_dists_all.append(cd_all)
-
-                        del test_sdf_samples, test_mesh
-
-                    if chamfer_dists:
-                        logging.debug(f"Test Chamfer distance mean: {sum(chamfer_dists)/len(chamfer_dists)} from {chamfer_dists}.")            
-                        summary_writer.add_scalar("Mean Chamfer Dist/test", sum(chamfer_dists)/len(chamfer_dists), epoch)
-                        summary_writer.add_scalar("Loss/test", test_err_sum/len(eval_test_filenames), epoch)
-                        mlm = torch.mean(torch.norm(torch.cat(test_latents, dim=0), dim=1))
-                        summary_writer.add_scalar("Mean Latent Magnitude/test", mlm, global_step=epoch)
-                        fig = plotting.plot_train_stats(loss_hists=test_loss_hists, labels=mesh_label_names)
-                        summary_writer.add_figure("Loss/test optimization curves", fig, epoch)
-                        fig, percentiles = plotting.plot_dist_violin(np.concatenate(chamfer_dists_all, axis=0))
-                        summary_writer.add_figure("CD Percentiles/test dists", fig, global_step=epoch)
-                        for p in [75, 90, 99]:
-                            if p in percentiles:
-                                summary_writer.add_scalar(f"CD Percentiles/test {p}th", percentiles[p], global_step=epoch)
-                    summary_writer.add_scalar("Time/test eval per shape (sec)", (time.time()-eval_test_time_start)/len(eval_test_filenames), epoch)
-                    # End of eval test.
+                        test_fpaths.append(os.path.join(data_source, ws.sdf_samples_subdir, test_fname))
+                        mesh_filenames.append(os.path.join(path, f"epoch={epoch}"))
+
+                    evaluation_service.submit(
+                        evaluate_test_shapes,
+                        log_test_evaluation,
+                        eval_decoder,
+                        epoch,
+                        sdf_filenames=test_fpaths,
+                        names=mesh_label_names,
+                        mesh_filenames=mesh_filenames,
+                        gt_path=torus_path,
+                        grid_res=eval_grid_res,
+                        latent_size=latent_size,
+                        num_iterations=int(eval_test_optimization_steps),
+                        refinement_levels=eval_refinement_levels,
+                    )
+
+                # Log the evaluations that finished in the meantime.
+                evaluation_service.poll(summary_writer)
 
             summary_writer.add_scalar("Time/epoch (min)", (time.time()-epoch_time_start)/60, epoch)
             summary_writer.flush() 
@@ -806,6 +1103,9 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
     except KeyboardInterrupt as e:
         logging.error(f"Received KeyboardInterrupt. Cleaning up and ending training.")
     finally:
+        # Wait for the last checkpoints to be written and evaluations to finish.
+        checkpoint_writer.close()
+        evaluation_service.close(summary_writer)
         # Calculate model size.
         param_size = 0
         param_cnt = 0
@@ -843,9 +1143,10 @@ def main_function(experiment_directory: str, continue_from, batch_split: int):
             "best_test_cd" : min(test_chamfer_dists_log) if len(test_chamfer_dists_log) else -1,
         }
         summary_writer.add_hparams(writer_hparams, train_results, run_name='.')
-        summary_writer.add_graph(decoder, input)        
+        summary_writer.add_graph(eval_decoder, input)        
         summary_writer.flush()    
         summary_writer.close()
+        deep_sdf.cleanup_distributed()
         # End of training.
 
 if __name__ == "__main__":
@@ -883,9 +1184,10 @@ if __name__ == "__main__":
     )
 
     deep_sdf.add_common_args(arg_parser)
+    deep_sdf.add_device_args(arg_parser)
 
     args = arg_parser.parse_args()
 
     deep_sdf.configure_logging(args)
 
-    main_function(args.experiment_directory, args.continue_from, int(args.batch_split))
+    main_function(args.experiment_directory, args.continue_from, int(args.batch_split), args.device, args.num_threads)